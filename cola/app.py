@@ -275,8 +275,9 @@ def application_start(context, view):
     view.show()
     view.raise_()
 
-    # Scan for the first time
-    task = _start_update_thread(context.model)
+    # Scan for the first time in the background so that git-cola
+    # starts up as quickly as possible
+    context.model.refresh(update_index=True)
 
     # Start the inotify thread
     inotify.start()
@@ -292,7 +293,7 @@ def application_start(context, view):
     # All done, cleanup
     inotify.stop()
     QtCore.QThreadPool.globalInstance().waitForDone()
-    del task
+    context.model.scheduler.wait()
 
     pattern = utils.tmp_file_pattern()
     for filename in glob.glob(pattern):
@@ -338,28 +339,15 @@ def new_model(app, repo, prompt=False):
             sys.exit(-1)
         valid = model.set_worktree(gitdir)
 
+    # Observers touch widgets, so background refreshes notify them
+    # in the GUI thread
+    model.dispatcher = qtutils.Dispatcher()
+
     # Finally, go to the root of the git repo
     os.chdir(model.git.worktree())
     return model
 
 
-def _start_update_thread(model):
-    """Update the model in the background
-
-    git-cola should startup as quickly as possible.
-
-    """
-    class UpdateTask(QtCore.QRunnable):
-        def run(self):
-            model.update_status(update_index=True)
-
-    # Hold onto a reference to prevent PyQt from dereferencing
-    task = UpdateTask()
-    QtCore.QThreadPool.globalInstance().start(task)
-
-    return task
-
-
 def _send_msg():
     if git.GIT_COLA_TRACE == 'trace':
         msg = ('info: Trace enabled.  '
@@ -369,9 +357,9 @@ def _send_msg():
         Interaction.log(msg)
 
 
-def _update_files():
+def _update_files(paths):
     # Respond to inotify updates
-    cmds.do(cmds.Refresh)
+    cmds.do(cmds.RefreshPaths, paths)
 
 
 class ApplicationContext(object):
@@ -225,7 +225,7 @@ class Archive(BaseCommand):
             cmd.append('--prefix=' + self.prefix)
         cmd.append(self.ref)
         proc = core.start_command(cmd, stdout=fp)
-        out, err = proc.communicate()
+        out, err = core.communicate(proc)
         fp.close()
         status = proc.returncode
         Interaction.log_status(status, out or '', err or '')
@@ -908,7 +908,7 @@ class Rescan(Command):
     """Rescan for changes"""
 
     def do(self):
-        self.model.update_status()
+        self.model.refresh()
 
 
 class Refresh(Command):
@@ -921,7 +921,18 @@ class Refresh(Command):
         return N_('Refresh')
 
     def do(self):
-        self.model.update_status(update_index=True)
+        self.model.refresh(update_index=True)
+
+
+class RefreshPaths(Command):
+    """Refresh the status of paths that changed on disk"""
+
+    def __init__(self, paths):
+        Command.__init__(self)
+        self.paths = paths
+
+    def do(self):
+        self.model.refresh((self.model.refresh_files,), paths=self.paths)
 
 
 class RunConfigAction(Command):
@@ -998,7 +1009,7 @@ class RunConfigAction(Command):
                                err and (N_('Errors: %s') % err) or '')
 
         if not opts.get('background') and not opts.get('norescan'):
-            self.model.update_status()
+            self.model.refresh()
         return status
 
 
@@ -1166,7 +1177,7 @@ class Tag(Command):
 
         Interaction.log_status(status, log_msg, err)
         if status == 0:
-            self.model.update_status()
+            self.model.refresh((self.model.refresh_refs,))
         return (status, output, err)
 
 
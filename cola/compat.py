@@ -25,6 +25,14 @@ try:
 except ImportError:
     import urllib
 
+try:
+    # Python 3
+    from urllib import request as urllib_request
+    from urllib import error as urllib_error
+except ImportError:
+    import urllib2 as urllib_request
+    urllib_error = urllib_request
+
 
 def setenv(key, value):
     """Compatibility wrapper for setting environment variables
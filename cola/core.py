@@ -12,6 +12,7 @@ import itertools
 import platform
 import subprocess
 
+from cola import profiler
 from cola.decorators import interruptable
 from cola.compat import ustr
 from cola.compat import PY2
@@ -91,7 +92,9 @@ def fwrite(fh, content, encoding=None):
 @interruptable
 def wait(proc):
     """Wait on a subprocess and retry when interrupted"""
-    return proc.wait()
+    status = proc.wait()
+    profiler.instance().finished(proc)
+    return status
 
 
 @interruptable
@@ -99,18 +102,48 @@ def readline(fh, encoding=None):
     return decode(fh.readline(), encoding=encoding)
 
 
+@interruptable
+def _read_bytes(fh, size):
+    return fh.read(size)
+
+
+def read_nul_tokens(fh, size=65536, encoding=None):
+    """Yield the NUL-terminated tokens from a filehandle as they are read
+
+    The filehandle is consumed in chunks so that large outputs can be
+    parsed without holding them in memory all at once.
+
+    """
+    tail = b''
+    while True:
+        chunk = _read_bytes(fh, size)
+        if not chunk:
+            break
+        tokens = (tail + chunk).split(b'\0')
+        tail = tokens.pop()
+        for token in tokens:
+            yield decode(token, encoding=encoding)
+    if tail:
+        yield decode(tail, encoding=encoding)
+
+
 @interruptable
 def start_command(cmd, cwd=None, add_env=None,
                   universal_newlines=False,
                   stdin=subprocess.PIPE,
                   stdout=subprocess.PIPE,
                   stderr=subprocess.PIPE,
+                  profile=None,
                   **extra):
     """Start the given command, and return a subprocess object.
 
     This provides a simpler interface to the subprocess module.
+    The command is timed until it is reaped by wait(), communicate() or
+    run_command(); `profile` is an optional dict of extra fields for
+    its profiler record.
 
     """
+    command = cmd
     env = None
     if add_env is not None:
         env = os.environ.copy()
@@ -136,14 +169,18 @@ def start_command(cmd, cwd=None, add_env=None,
         # the subprocess.
         cwd = None
 
-    return subprocess.Popen(cmd, bufsize=1, stdin=stdin, stdout=stdout,
+    proc = subprocess.Popen(cmd, bufsize=1, stdin=stdin, stdout=stdout,
                             stderr=stderr, cwd=cwd, env=env,
                             universal_newlines=universal_newlines, **extra)
+    profiler.instance().started(proc, command, **(profile or {}))
+    return proc
 
 
 @interruptable
 def communicate(proc):
-    return proc.communicate()
+    output, errors = proc.communicate()
+    profiler.instance().finished(proc, output, errors)
+    return (output, errors)
 
 
 def run_command(cmd, encoding=None, *args, **kwargs):
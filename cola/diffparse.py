@@ -1,7 +1,9 @@
 from __future__ import division, absolute_import, unicode_literals
 
+import bisect
 import os
 import re
+from array import array
 
 from cola import core
 from cola import gitcmds
@@ -59,21 +61,109 @@ class DiffSource(object):
                                    reverse=reverse)
 
 
+# Lines added or removed by a hunk
+_ADDED_LINE_RE = re.compile(r'^\+[^\n]*\n', re.MULTILINE)
+_REMOVED_LINE_RE = re.compile(r'^-', re.MULTILINE)
+_SIGN_RE = re.compile(r'^[+-]', re.MULTILINE)
+_SWAPPED_SIGNS = {'+': '-', '-': '+'}
+
+
+def reverse_lines(text):
+    """Swap the "+" and "-" markers of the lines of a hunk"""
+    return _SIGN_RE.sub(lambda match: _SWAPPED_SIGNS[match.group()], text)
+
+
+def reverse_header(header):
+    """Return the header of the reverse of a diff
+
+    The result matches the header printed by "git diff -R".  None is
+    returned for headers that cannot be reversed reliably, eg. copies.
+
+    """
+    if not header:
+        return header
+    lines = header.split('\n')
+    values = {}
+    for line in lines:
+        for prefix in ('--- ', '+++ ', 'rename from ', 'rename to ',
+                       'old mode ', 'new mode '):
+            if line.startswith(prefix):
+                values[prefix] = line[len(prefix):]
+    swapped = {
+        '--- ': '+++ ',
+        '+++ ': '--- ',
+        'rename from ': 'rename to ',
+        'rename to ': 'rename from ',
+        'old mode ': 'new mode ',
+        'new mode ': 'old mode ',
+    }
+    result = []
+    for line in lines:
+        if line.startswith('diff --git '):
+            line = _reverse_diff_git_line(line, values)
+            if line is None:
+                return None
+        elif line.startswith('index '):
+            fields = line.split(' ')
+            sha1s = fields[1].split('..')
+            if len(sha1s) != 2:
+                return None
+            fields[1] = '%s..%s' % (sha1s[1], sha1s[0])
+            line = ' '.join(fields)
+        elif line.startswith('new file mode '):
+            line = 'deleted file mode ' + line[len('new file mode '):]
+        elif line.startswith('deleted file mode '):
+            line = 'new file mode ' + line[len('deleted file mode '):]
+        elif line.startswith(('copy ', 'Binary ', 'GIT binary patch')):
+            return None
+        else:
+            for prefix, other in swapped.items():
+                if line.startswith(prefix):
+                    line = prefix + values[other]
+                    break
+        result.append(line)
+    return '\n'.join(result)
+
+
+def _reverse_diff_git_line(line, values):
+    names = line[len('diff --git '):]
+    if 'rename from ' in values and 'rename to ' in values:
+        return 'diff --git b/%s a/%s' % (values['rename to '],
+                                         values['rename from '])
+    for quote in ('', '"'):
+        # Both sides name the same path: a/<path> b/<path>
+        size = (len(names) - 5 - 4 * len(quote)) // 2
+        path = names[2+len(quote):2+len(quote)+size]
+        if names == '%sa/%s%s %sb/%s%s' % (quote, path, quote,
+                                           quote, path, quote):
+            return 'diff --git %sb/%s%s %sa/%s%s' % (quote, path, quote,
+                                                     quote, path, quote)
+    return None
+
+
 class DiffParser(object):
 
-    """Handles parsing diff for use by the interactive index editor."""
+    """Handles parsing diff for use by the interactive index editor.
+
+    The diff is kept as a single string along with the offsets of its
+    lines and hunks, so that hunks and partial patches are sliced out
+    of it rather than rebuilt line by line.  The reverse of a diff is
+    derived from the forward diff unless `derive_reverse` is False, in
+    which case git is asked for it.
+
+    """
 
     HEADER_RE = re.compile(r'^@@ -([0-9,]+) \+([0-9,]+) @@.*')
 
     def __init__(self, model, filename='',
                  cached=True, reverse=False,
-                 diff_source=None):
+                 diff_source=None, derive_reverse=True):
 
-        self._idx = -1
-        self._diffs = []
         self._diff_spans = []
         self._diff_offsets = []
         self._ranges = []
+        self._line_starts = array(str('l'))
+        self._hunk_lines = array(str('l'))
 
         self.config = gitcfg.instance()
         self.head = model.head
@@ -86,20 +176,35 @@ class DiffParser(object):
         self.filename = filename
         self.diff_source = diff_source or DiffSource()
 
-        (header, diff) = self.diff_source.get(self.head, self.amending,
-                                              filename, cached,
-                                              cached or reverse)
-        self.model = model
-        self.diff = diff
-        self.header = header
-        self.parse_diff(diff)
-
         # Always index into the non-reversed diff
         self.fwd_header, self.fwd_diff = \
                 self.diff_source.get(self.head,
                                      self.amending,
                                      filename,
                                      cached, False)
+        header = self.fwd_header
+        diff = self.fwd_diff
+        self.reversed = False
+        """Indicates that hunks are reversed from the parsed diff"""
+        if cached or reverse:
+            rev_header = None
+            # The bodies of deleted files start with their file mode,
+            # so only diffs holding nothing but hunks are reversed here
+            if derive_reverse and diff.startswith('@@'):
+                rev_header = reverse_header(header)
+            if rev_header is None:
+                header, diff = self.diff_source.get(self.head,
+                                                    self.amending,
+                                                    filename,
+                                                    cached, True)
+            else:
+                header = rev_header
+                self.reversed = True
+
+        self.model = model
+        self.diff = diff
+        self.header = header
+        self.parse_diff(diff)
 
     def write_diff(self,filename,which,selected=False,noop=False):
         """Writes a new diff corresponding to the user's selection."""
@@ -118,60 +223,83 @@ class DiffParser(object):
 
     def diffs(self):
         """Returns the list of diffs."""
-        return self._diffs
+        return [self._hunk(idx).split('\n')
+                for idx in range(len(self._ranges))]
+
+    def _lines(self, first, last):
+        """Return lines [first, last) of the diff, or None when empty"""
+        if first >= last:
+            return None
+        line_starts = self._line_starts
+        text = self.diff[line_starts[first]:line_starts[last]-1]
+        if self.reversed:
+            text = reverse_lines(text)
+        return text
+
+    def _hunk(self, idx):
+        """Return the text of a hunk"""
+        first = self._hunk_lines[idx]
+        header = self._lines(first, first + 1)
+        body = self._lines(first + 1, self._hunk_lines[idx+1])
+        if self.reversed:
+            match = self.HEADER_RE.match(header)
+            header = '@@ -%s +%s @@%s' % (match.group(2), match.group(1),
+                                          header[match.end(2)+len(' @@'):])
+        if body is None:
+            return header
+        return header + '\n' + body
 
     def diff_subset(self, diff, start, end):
         """Processes the diffs and returns a selected subset from that diff.
         """
+        first = self._hunk_lines[diff] + 1
+        last = self._hunk_lines[diff+1]
+        line_starts = self._line_starts
+        # |line1 |line2 |line3 |
+        #   |--selection--|
+        #   '-start       '-end
+        # The lines starting within the selection are selected, and so
+        # is the line holding its start (line1) unless only its newline
+        # is selected.
+        sel_first = bisect.bisect_left(line_starts, start)
+        sel_last = bisect.bisect_left(line_starts, end)
+        tail = bisect.bisect_right(line_starts, start) - 1
+        if tail < last and start < line_starts[tail+1] - 1:
+            sel_first = tail
+            sel_last = max(sel_last, tail + 1)
+        sel_first = min(max(sel_first, first), last)
+        sel_last = min(max(sel_last, sel_first), last)
+
         adds = 0
         deletes = 0
         existing = 0
-        newdiff = []
-        local_offset = 0
-        offset = self._diff_spans[diff][0]
-
-        ADD = '+'
-        DEL = '-'
-        NOP = ' '
-
-        for line in self._diffs[diff]:
-            line_start = offset + local_offset
-            local_offset += len(line) + 1 #\n
-            line_end = offset + local_offset
-            # |line1 |line2 |line3 |
-            #   |--selection--|
-            #   '-start       '-end
-
-            # selection has head of diff (line3)
-            has_head = start <= line_start and end > line_start and end <= line_end
-            # selection has all of diff (line2)
-            has_all = start <= line_start and end >= line_end
-            # selection has tail of diff (line1)
-            has_tail = start >= line_start and start < line_end - 1
-
-            action = line[0:1]
-            if has_head or has_all or has_tail:
-                newdiff.append(line)
-                if action == ADD:
-                    adds += 1
-                elif action == DEL:
-                    deletes += 1
-                elif action == NOP:
-                    existing += 1
-            else:
-                # Don't add new lines unless selected
-                if action == ADD:
-                    continue
-                elif action == DEL:
-                    # Don't remove lines unless selected
-                    newdiff.append(' ' + line[1:])
-                    existing += 1
-                elif action == NOP:
-                    newdiff.append(line)
-                    existing += 1
-                else:
-                    newdiff.append(line)
 
+        # Don't add new lines unless selected, and
+        # don't remove lines unless selected
+        unselected = []
+        for lines in (self._lines(first, sel_first),
+                      self._lines(sel_last, last)):
+            if lines is not None:
+                text = '\n' + lines
+                existing += text.count('\n ') + text.count('\n-')
+                if text.count('\n+') == text.count('\n'):
+                    lines = None
+                else:
+                    lines = _ADDED_LINE_RE.sub('', lines + '\n')
+                    lines = _REMOVED_LINE_RE.sub(' ', lines)[:-1]
+            unselected.append(lines)
+        before, after = unselected
+
+        selected = self._lines(sel_first, sel_last)
+        if selected is not None:
+            text = '\n' + selected
+            adds = text.count('\n+')
+            deletes = text.count('\n-')
+            existing += text.count('\n ')
+
+        newdiff = [None]
+        newdiff.extend([lines for lines in (before, selected, after)
+                        if lines is not None])
         diff_range = self._ranges[diff]
         begin_count = existing + deletes
         end_count = existing + adds
@@ -203,59 +331,74 @@ class DiffParser(object):
 
     def diff_for_offset(self, offset):
         """Returns the hunks for a particular offset."""
-        for idx, diff_offset in enumerate(self._diff_offsets):
-            if offset < diff_offset:
-                return (['\n'.join(self._diffs[idx])], [idx])
+        idx = bisect.bisect_right(self._diff_offsets, offset)
+        if idx < len(self._diff_offsets):
+            return ([self._hunk(idx)], [idx])
         return ([],[])
 
     def diffs_for_range(self, start, end):
         """Returns the hunks for a selected range."""
-        diffs = []
-        indices = []
-        for idx, span in enumerate(self._diff_spans):
-            has_end_of_diff = start >= span[0] and start < span[1]
-            has_all_of_diff = start <= span[0] and end >= span[1]
-            has_head_of_diff = end >= span[0] and end <= span[1]
-
-            selected_diff =(has_end_of_diff
-                    or has_all_of_diff
-                    or has_head_of_diff)
-            if selected_diff:
-                diff = '\n'.join(self._diffs[idx])
-                diffs.append(diff)
-                indices.append(idx)
-        return diffs, indices
+        # Hunks ending at the start are only selected by an empty range
+        if start == end:
+            first = bisect.bisect_left(self._diff_offsets, start)
+        else:
+            first = bisect.bisect_right(self._diff_offsets, start)
+        last = bisect.bisect_right(self._hunk_starts, end)
+        indices = list(range(first, last))
+        return [self._hunk(idx) for idx in indices], indices
 
     def parse_diff(self, diff):
         """Parses a diff and extracts headers, offsets, hunks, etc.
         """
-        total_offset = 0
-        self._idx = -1
-
-        for line in diff.split('\n'):
-            match = self.HEADER_RE.match(line)
-            if match:
-                self._ranges.append(Range(match.group(1), match.group(2)))
-                self._diffs.append([line])
-
-                line_len = len(line) + 1 #\n
-                self._diff_spans.append([total_offset,
-                                         total_offset + line_len])
-                total_offset += line_len
-                self._diff_offsets.append(total_offset)
-                self._idx += 1
-                continue
-
-            if self._idx < 0:
+        self.diff = diff
+        line_starts = self._line_starts = array(str('l'), [0])
+        find = diff.find
+        pos = find('\n')
+        while pos >= 0:
+            line_starts.append(pos + 1)
+            pos = find('\n', pos + 1)
+        line_starts.append(len(diff) + 1)
+        line_count = len(line_starts) - 1
+
+        hunk_lines = self._hunk_lines = array(str('l'))
+        self._ranges = []
+        match = self.HEADER_RE.match
+        pos = 0
+        while pos >= 0:
+            line = bisect.bisect_left(line_starts, pos)
+            header = diff[pos:line_starts[line+1]-1]
+            match_obj = match(header)
+            if match_obj:
+                if self.reversed:
+                    diff_range = Range(match_obj.group(2), match_obj.group(1))
+                else:
+                    diff_range = Range(match_obj.group(1), match_obj.group(2))
+                self._ranges.append(diff_range)
+                hunk_lines.append(line)
+            elif not hunk_lines:
                 errmsg = 'Malformed diff?: %s' % diff
                 raise AssertionError(errmsg)
+            pos = find('\n@@', pos)
+            if pos >= 0:
+                pos += 1
+        hunk_lines.append(line_count)
+
+        self._hunk_starts = [line_starts[line] for line in hunk_lines[:-1]]
+        self._diff_offsets = [line_starts[line] for line in hunk_lines[1:]]
+        self._diff_spans = [[begin, end] for (begin, end)
+                            in zip(self._hunk_starts, self._diff_offsets)]
 
-            line_len = len(line) + 1
-            total_offset += line_len
+    def _find_selection(self, selection, offset):
+        """Return the offset of the selected text, or -1
 
-            self._diffs[self._idx].append(line)
-            self._diff_spans[-1][-1] += line_len
-            self._diff_offsets[self._idx] += line_len
+        The cursor sits at one end of the selection, so text that occurs
+        more than once is found where the cursor is.
+
+        """
+        for start in (offset - len(selection), offset):
+            if start >= 0 and self.fwd_diff.startswith(selection, start):
+                return start
+        return self.fwd_diff.find(selection)
 
     def process_diff_selection(self, selected, offset, selection,
                                apply_to_worktree=False):
@@ -265,13 +408,13 @@ class DiffParser(object):
             # boo!  we work around that here.
             # I think this was win32-specific.  We might want to do
             # this on win32 only (TODO verify)
-            if selection not in self.fwd_diff:
+            start = self._find_selection(selection, offset)
+            if start < 0:
                 special_selection = selection.replace('\n', '\r\n')
-                if special_selection in self.fwd_diff:
-                    selection = special_selection
-                else:
+                start = self._find_selection(special_selection, offset)
+                if start < 0:
                     return 0, '', ''
-            start = self.fwd_diff.index(selection)
+                selection = special_selection
             end = start + len(selection)
             self.set_diffs_to_range(start, end)
         else:
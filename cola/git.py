@@ -1,19 +1,71 @@
 from __future__ import division, absolute_import, unicode_literals
 
+import binascii
 import functools
 import errno
 import os
 import sys
 import subprocess
 import threading
+import time
 from os.path import join
 
+try:
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
+
 from cola import core
 from cola.decorators import memoize
 from cola.interaction import Interaction
 
 
 INDEX_LOCK = threading.Lock()
+"""Serializes commands that write to .git/index (see is_index_writer())"""
+
+# Subcommands that only read from the repository.  These can run
+# concurrently with each other and with index writers because git
+# replaces .git/index atomically.  Some of them, eg. "diff" and
+# "describe --dirty", refresh the index when they can take index.lock,
+# so they run with GIT_OPTIONAL_LOCKS=0.  Everything else is serialized.
+READ_ONLY_COMMANDS = frozenset((
+    'blame',
+    'cat-file',
+    'check-attr',
+    'check-ignore',
+    'cherry',
+    'describe',
+    'diff',
+    'diff-files',
+    'diff-index',
+    'diff-tree',
+    'fmt-merge-msg',
+    'for-each-ref',
+    'format-patch',
+    'grep',
+    'log',
+    'ls-files',
+    'ls-remote',
+    'ls-tree',
+    'merge-base',
+    'name-rev',
+    'rev-list',
+    'rev-parse',
+    'shortlog',
+    'show',
+    'show-ref',
+    'var',
+    'version',
+    'whatchanged',
+))
+
+# "git config" and "git apply" only write when given these options
+_CONFIG_READ_OPTIONS = frozenset((
+    '-l', '--list', '--get', '--get-all', '--get-regexp', '--get-color',
+    '--get-colorbool', '--get-urlmatch',
+))
+_APPLY_INDEX_OPTIONS = frozenset(('--cached', '--index'))
 GIT_COLA_TRACE = core.getenv('GIT_COLA_TRACE', '')
 STATUS = 0
 STDOUT = 1
@@ -24,6 +76,25 @@ def dashify(s):
     return s.replace('_', '-')
 
 
+def is_index_writer(command):
+    """Return True when a command may write to .git/index
+
+    Commands that are not known to be read-only are treated as writers.
+
+    """
+    if len(command) < 2 or os.path.basename(command[0]) != 'git':
+        return True
+    subcommand = command[1]
+    if subcommand in READ_ONLY_COMMANDS:
+        return False
+    args = command[2:]
+    if subcommand == 'config':
+        return not [arg for arg in args if arg in _CONFIG_READ_OPTIONS]
+    if subcommand == 'apply':
+        return bool([arg for arg in args if arg in _APPLY_INDEX_OPTIONS])
+    return True
+
+
 def is_git_dir(d):
     """From git's setup.c:is_git_directory()."""
     if (core.isdir(d) and core.isdir(join(d, 'objects')) and
@@ -54,6 +125,270 @@ def read_git_file(path):
     return None
 
 
+def _startupinfo():
+    """Return extra Popen arguments that hide console windows on win32"""
+    extra = {}
+    if sys.platform == 'win32':
+        # If git-cola is invoked on Windows using "start pythonw git-cola",
+        # a console window will briefly flash on the screen each time
+        # git-cola invokes git, which is very annoying.  The code below
+        # prevents this by ensuring that any window will be hidden.
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags = subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = subprocess.SW_HIDE
+        extra['startupinfo'] = startupinfo
+    return extra
+
+
+class CatFile(object):
+    """A long-running "git cat-file --batch" or "--batch-check" process
+
+    Objects are requested by writing their names to the process' stdin.
+    The process is started on first use and restarted when it goes away.
+
+    """
+    def __init__(self, cwd=None, check=False):
+        self.cwd = cwd
+        self.check = check
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if self.check:
+            mode = '--batch-check'
+        else:
+            mode = '--batch'
+        cmd = ['git', 'cat-file', mode]
+        self._proc = core.start_command(cmd, cwd=self.cwd, **_startupinfo())
+        return self._proc
+
+    def query(self, name):
+        """Return (sha1, objtype, size, data) for an object name
+
+        `data` is None in "--batch-check" mode.
+        None is returned when the object does not exist.
+
+        """
+        # cat-file reads one object name per line
+        if not name or '\n' in name:
+            return None
+        with self._lock:
+            try:
+                return self._query(name)
+            except (IOError, OSError):
+                # The process died; restart it and try once more
+                self.close()
+                return self._query(name)
+
+    def _query(self, name):
+        proc = self._proc
+        if proc is None or proc.poll() is not None:
+            proc = self._start()
+        core.fwrite(proc.stdin, name + '\n')
+        proc.stdin.flush()
+        header = core.readline(proc.stdout)
+        if not header:
+            raise IOError('git cat-file exited unexpectedly')
+        # "<name> missing" or "<name> ambiguous", where the name may
+        # hold spaces
+        header = header.rstrip('\n')
+        if header.endswith(' missing') or header.endswith(' ambiguous'):
+            return None
+        fields = header.split()
+        if len(fields) != 3 or not fields[2].isdigit():
+            raise IOError('unexpected git cat-file output: %s' % header)
+        sha1, objtype, size = fields
+        size = int(size)
+        if self.check:
+            data = None
+        else:
+            data = _read_exactly(proc.stdout, size)
+            # Each object is followed by a newline
+            _read_exactly(proc.stdout, 1)
+        return (sha1, objtype, size, data)
+
+    def close(self):
+        """Stop the process; the next query() starts a new one"""
+        proc = self._proc
+        self._proc = None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            proc.kill()
+        except (AttributeError, OSError):
+            pass
+        try:
+            core.wait(proc)
+            proc.stdout.close()
+            proc.stderr.close()
+        except (IOError, OSError):
+            pass
+
+
+def _read_exactly(fh, size):
+    """Read exactly `size` bytes from a pipe"""
+    chunks = []
+    while size > 0:
+        chunk = fh.read(size)
+        if not chunk:
+            raise IOError('git cat-file exited unexpectedly')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class CatFilePool(object):
+    """A small pool of persistent "git cat-file" processes
+
+    Lookups borrow an idle process so that concurrent threads
+    do not serialize behind a single pipe.
+
+    """
+    def __init__(self, size=2, check=False):
+        self.size = size
+        self.check = check
+        self.cwd = None
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._workers = []
+
+    def _acquire(self):
+        while True:
+            worker = None
+            with self._lock:
+                try:
+                    worker = self._idle.get_nowait()
+                except queue.Empty:
+                    if len(self._workers) < self.size:
+                        worker = CatFile(cwd=self.cwd, check=self.check)
+                        self._workers.append(worker)
+                        return worker
+            if worker is None:
+                worker = self._idle.get()
+            if worker in self._workers:
+                return worker
+            # Stale worker from before the last reset()
+            worker.close()
+
+    def _release(self, worker):
+        if worker in self._workers:
+            self._idle.put(worker)
+        else:
+            # The pool was reset while the worker was busy
+            worker.close()
+
+    def query(self, name):
+        """Return (sha1, objtype, size, data) for an object, or None"""
+        worker = self._acquire()
+        try:
+            return worker.query(name)
+        finally:
+            self._release(worker)
+
+    def reset(self, cwd=None):
+        """Stop all processes; new ones are started on demand in `cwd`"""
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+            self.cwd = cwd
+        for worker in workers:
+            worker.close()
+
+
+def _read_token(fh):
+    """Read a NUL-terminated token from a pipe"""
+    chars = []
+    while True:
+        char = fh.read(1)
+        if not char:
+            raise IOError('git check-attr exited unexpectedly')
+        if char == b'\0':
+            return core.decode(b''.join(chars))
+        chars.append(char)
+
+
+class CheckAttr(object):
+    """A long-running "git check-attr -z --stdin" process
+
+    Paths are written to the process' stdin and the attributes are read
+    back, so resolving many paths does not start a process per path.
+    The process reads each .gitattributes file once, so it has to be
+    closed when they change.
+
+    """
+    batch_size = 128
+    """Paths written before reading their results back.  This keeps
+    git from blocking on a full stdout pipe while we write to stdin."""
+
+    def __init__(self, attrs, cwd=None):
+        self.attrs = tuple(attrs)
+        self.cwd = cwd
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        cmd = ['git', 'check-attr', '-z', '--stdin'] + list(self.attrs)
+        self._proc = core.start_command(cmd, cwd=self.cwd, **_startupinfo())
+        return self._proc
+
+    def query(self, paths):
+        """Return a dict mapping each path to a dict of attribute values
+
+        Values are as reported by git, eg. "unspecified" or "set".
+
+        """
+        paths = [path for path in paths if path and '\0' not in path]
+        result = {}
+        with self._lock:
+            for idx in range(0, len(paths), self.batch_size):
+                batch = paths[idx:idx+self.batch_size]
+                try:
+                    result.update(self._query(batch))
+                except (IOError, OSError):
+                    # The process died; restart it and try once more
+                    self.close()
+                    result.update(self._query(batch))
+        return result
+
+    def _query(self, paths):
+        proc = self._proc
+        if proc is None or proc.poll() is not None:
+            proc = self._start()
+        core.fwrite(proc.stdin, ''.join([path + '\0' for path in paths]))
+        proc.stdin.flush()
+        result = {}
+        # Each path is answered with "<path>\0<attr>\0<value>\0"
+        # for every attribute, in the order in which they were written
+        for path in paths:
+            values = result[path] = {}
+            for attr in self.attrs:
+                _read_token(proc.stdout)
+                name = _read_token(proc.stdout)
+                values[name] = _read_token(proc.stdout)
+        return result
+
+    def close(self):
+        """Stop the process; the next query() starts a new one"""
+        proc = self._proc
+        self._proc = None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            core.wait(proc)
+            proc.stdout.close()
+            proc.stderr.close()
+        except (IOError, OSError):
+            pass
+
+
 class Git(object):
     """
     The Git class manages communication with the Git binary
@@ -62,9 +397,14 @@ class Git(object):
         self._git_cwd = None #: The working directory used by execute()
         self._worktree = None
         self._git_file_path = None
+        self._batch = CatFilePool(check=False)
+        self._batch_check = CatFilePool(check=True)
+        self._check_attr = {}
+        self._check_attr_lock = threading.Lock()
         self.set_worktree(core.getcwd())
 
     def set_worktree(self, path):
+        self.reset_batch()
         self._git_dir = core.decode(path)
         self._git_file_path = None
         self._worktree = None
@@ -132,6 +472,83 @@ class Git(object):
         """Sets the current directory."""
         self._git_cwd = path
 
+    def reset_batch(self):
+        """Restart the persistent "git cat-file" processes"""
+        self._batch.reset()
+        self._batch_check.reset()
+        self.reset_attributes()
+
+    def reset_attributes(self):
+        """Restart the persistent "git check-attr" processes
+
+        This is needed after a .gitattributes file changes.
+
+        """
+        with self._check_attr_lock:
+            workers = list(self._check_attr.values())
+            self._check_attr = {}
+        for worker in workers:
+            worker.close()
+
+    def getcwd(self):
+        """Return the directory in which git commands are run"""
+        return self._git_cwd or core.getcwd()
+
+    def read_object(self, name):
+        """Return (sha1, objtype, data) for an object using "cat-file --batch"
+
+        `name` can be any object name understood by git, e.g. "HEAD:path".
+        The contents are returned as bytes.  None is returned for missing
+        objects.
+
+        """
+        pool = self._batch
+        if pool.cwd is None:
+            pool.cwd = self.getcwd()
+        result = pool.query(name)
+        if result is None:
+            return None
+        sha1, objtype, size, data = result
+        return (sha1, objtype, data)
+
+    def object_info(self, name):
+        """Return (sha1, objtype, size) using "cat-file --batch-check" """
+        pool = self._batch_check
+        if pool.cwd is None:
+            pool.cwd = self.getcwd()
+        result = pool.query(name)
+        if result is None:
+            return None
+        sha1, objtype, size, data = result
+        return (sha1, objtype, size)
+
+    def tree_entries(self, treeish):
+        """Return a list of (mode, objtype, sha1, name) for a tree object
+
+        The tree is read through the persistent "cat-file --batch" process.
+        None is returned when `treeish` does not name a tree.
+
+        """
+        result = self.read_object(treeish + '^{tree}')
+        if result is None or result[1] != 'tree':
+            return None
+        return parse_tree(result[2])
+
+    def check_attributes(self, paths, *attrs):
+        """Return {path: {attr: value}} using "check-attr --stdin"
+
+        `paths` are relative to the worktree.  The process for each set
+        of attributes is kept running between calls.
+
+        """
+        with self._check_attr_lock:
+            try:
+                worker = self._check_attr[attrs]
+            except KeyError:
+                worker = self._check_attr[attrs] = CheckAttr(
+                        attrs, cwd=self.getcwd())
+        return worker.query(paths)
+
     def __getattr__(self, name):
         git_cmd = functools.partial(self.git, name)
         setattr(self, name, git_cmd)
@@ -162,27 +579,36 @@ class Git(object):
         if not _cwd:
             _cwd = core.getcwd()
 
-        extra = {}
-        if sys.platform == 'win32':
-            # If git-cola is invoked on Windows using "start pythonw git-cola",
-            # a console window will briefly flash on the screen each time
-            # git-cola invokes git, which is very annoying.  The code below
-            # prevents this by ensuring that any window will be hidden.
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags = subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-            extra['startupinfo'] = startupinfo
+        extra = _startupinfo()
 
         # Start the process
-        # Guard against thread-unsafe .git/index.lock files
-        INDEX_LOCK.acquire()
-        status, out, err = core.run_command(command,
-                                            cwd=_cwd,
-                                            encoding=_encoding,
-                                            stdin=_stdin, stdout=_stdout, stderr=_stderr,
-                                            **extra)
-        # Let the next thread in
-        INDEX_LOCK.release()
+        # Guard against thread-unsafe .git/index.lock files.
+        # Read-only commands run concurrently; only writers are serialized.
+        index_writer = is_index_writer(command)
+        profile = {'index_writer': index_writer}
+        if index_writer:
+            if not INDEX_LOCK.acquire(False):
+                # Another thread is writing; record how long we waited
+                start = time.time()
+                INDEX_LOCK.acquire()
+                profile['lock_contended'] = True
+                profile['lock_wait'] = time.time() - start
+        else:
+            # Keep readers from refreshing the index behind the lock
+            extra['add_env'] = {'GIT_OPTIONAL_LOCKS': '0'}
+        try:
+            status, out, err = core.run_command(command,
+                                                cwd=_cwd,
+                                                encoding=_encoding,
+                                                stdin=_stdin,
+                                                stdout=_stdout,
+                                                stderr=_stderr,
+                                                profile=profile,
+                                                **extra)
+        finally:
+            # Let the next thread in
+            if index_writer:
+                INDEX_LOCK.release()
         if not _raw and out is not None:
             out = out.rstrip('\n')
 
@@ -243,6 +669,28 @@ class Git(object):
             sys.exit(1)
 
 
+def parse_tree(data):
+    """Parse a raw tree object into (mode, objtype, sha1, name) tuples"""
+    entries = []
+    offset = 0
+    end = len(data)
+    while offset < end:
+        space = data.index(b' ', offset)
+        nul = data.index(b'\0', space)
+        mode = data[offset:space].decode('ascii')
+        name = core.decode(data[space+1:nul])
+        sha1 = binascii.hexlify(data[nul+1:nul+21]).decode('ascii')
+        offset = nul + 21
+        if mode == '40000':
+            objtype = 'tree'
+        elif mode == '160000':
+            objtype = 'commit'
+        else:
+            objtype = 'blob'
+        entries.append((mode, objtype, sha1, name))
+    return entries
+
+
 @memoize
 def instance():
     """Return the Git singleton"""
@@ -1,9 +1,12 @@
 from __future__ import division, absolute_import, unicode_literals
 
+import collections
 import copy
 import fnmatch
 import os
 import re
+import threading
+import time
 from os.path import join
 
 from cola import core
@@ -24,6 +27,9 @@ _USER_CONFIG = core.expanduser(join('~', '.gitconfig'))
 _USER_XDG_CONFIG = core.expanduser(
         join(core.getenv('XDG_CONFIG_HOME', join('~', '.config')),
              'git', 'config'))
+_USER_XDG_ATTRIBUTES = core.expanduser(
+        join(core.getenv('XDG_CONFIG_HOME', join('~', '.config')),
+             'git', 'attributes'))
 
 def _stat_info():
     # Try /etc/gitconfig as a fallback for the system config
@@ -40,19 +46,35 @@ def _stat_info():
     return statinfo
 
 
-def _cache_key():
-    # Try /etc/gitconfig as a fallback for the system config
-    paths = ('/etc/gitconfig',
-             _USER_XDG_CONFIG,
-             _USER_CONFIG,
-             git.instance().git_path('config'))
-    mtimes = []
-    for path in paths:
+def _config_paths():
+    """Return the config files read by git, whether or not they exist"""
+    git_instance = git.instance()
+    return ('/etc/gitconfig',
+            _USER_XDG_CONFIG,
+            _USER_CONFIG,
+            git_instance.git_path('config'),
+            git_instance.git_path('config.worktree'))
+
+
+def _stamp(paths):
+    """Return a value that changes when any of the files change"""
+    stamp = []
+    for path in sorted(paths):
         try:
-            mtimes.append(core.stat(path).st_mtime)
+            st = core.stat(path)
+            stamp.append((path, st.st_mtime, st.st_size))
         except OSError:
-            continue
-    return mtimes
+            stamp.append((path, None, None))
+    return stamp
+
+
+# Maps the scopes reported by "git config --show-scope" to our categories
+_SCOPES = {
+    'system': 'system',
+    'global': 'user',
+    'local': 'repo',
+    'worktree': 'repo',
+}
 
 
 def _config_to_python(v):
@@ -89,6 +111,17 @@ class GitConfig(observable.Observable):
     message_user_config_changed = 'user_config_changed'
     message_repo_config_changed = 'repo_config_changed'
 
+    attr_cache_size = 4096
+    """The number of paths whose attributes are remembered"""
+
+    check_interval = 0.5
+    """Seconds between checks for changes to the config files
+
+    A single action typically looks up many values in a burst; they
+    share one round of stat calls instead of paying for it per lookup.
+
+    """
+
     def __init__(self):
         observable.Observable.__init__(self)
         self.git = git.instance()
@@ -98,11 +131,19 @@ class GitConfig(observable.Observable):
         self._user_or_system = {}
         self._repo = {}
         self._all = {}
-        self._cache_key = None
+        self._origins = {}
+        self._stamp = None
+        self._checked = 0.0
+        self._watched = set()
         self._configs = []
         self._config_files = {}
         self._value_cache = {}
-        self._attr_cache = {}
+        self._attr_cache = collections.OrderedDict()
+        self._attr_lock = threading.Lock()
+        self._attr_files = []
+        self._attr_index_stamp = None
+        self._attr_stamp = None
+        self._attr_checked = 0.0
         self._find_config_files()
 
     def reset(self):
@@ -112,11 +153,19 @@ class GitConfig(observable.Observable):
         self._user_or_system.clear()
         self._repo.clear()
         self._all.clear()
-        self._cache_key = None
+        self._origins.clear()
+        self._stamp = None
+        self._checked = 0.0
+        self._watched = set()
         self._configs = []
         self._config_files.clear()
         self._value_cache = {}
-        self._attr_cache = {}
+        with self._attr_lock:
+            self._attr_cache.clear()
+            self._attr_files = []
+            self._attr_index_stamp = None
+            self._attr_stamp = None
+            self._attr_checked = 0.0
         self._find_config_files()
 
     def user(self):
@@ -139,7 +188,7 @@ class GitConfig(observable.Observable):
         """
         # Try the git config in git's installation prefix
         statinfo = _stat_info()
-        self._configs = map(lambda x: x[1], statinfo)
+        self._configs = [x[1] for x in statinfo]
         self._config_files = {}
         for (cat, path, mtime) in statinfo:
             self._config_files[cat] = path
@@ -150,19 +199,43 @@ class GitConfig(observable.Observable):
             return
         self._read_configs()
 
+    def invalidate(self):
+        """Read the config files again on the next lookup"""
+        self._stamp = None
+
     def _cached(self):
         """
         Return True when the cache matches.
 
+        The files are checked at most once per check_interval.
         Updates the cache and returns False when the cache does not match.
 
         """
-        cache_key = _cache_key()
-        if self._cache_key is None or cache_key != self._cache_key:
-            self._cache_key = cache_key
+        now = time.time()
+        if (self._stamp is not None and
+                now - self._checked < self.check_interval):
+            return True
+        self._checked = now
+        stamp = _stamp(self._watched.union(_config_paths()))
+        if self._stamp is None or stamp != self._stamp:
+            self._stamp = stamp
             return False
         return True
 
+    def origin(self, key):
+        """Return the (category, origin) that a config value came from
+
+        The category is one of 'system', 'user', 'repo' or 'command'.
+        Returns None for unknown keys and when git is too old to report
+        the origins.
+
+        """
+        self.update()
+        try:
+            return self._get_with_fallback(self._origins, key)
+        except KeyError:
+            return None
+
     def _read_configs(self):
         """Read git config value into the system, user and repo dicts."""
         self._map.clear()
@@ -171,7 +244,54 @@ class GitConfig(observable.Observable):
         self._user_or_system.clear()
         self._repo.clear()
         self._all.clear()
+        self._origins.clear()
+
+        if BUILTIN_READER or not self._read_all_scopes():
+            self._read_config_files()
+
+        for dct in (self._system, self._user):
+            self._user_or_system.update(dct)
+
+    def _read_all_scopes(self):
+        """Read every scope, following includes, with a single git call
+
+        Returns False when git is too old to report the scopes.
+
+        """
+        status, out, err = self.git.config('--list', '--null',
+                                           '--show-origin', '--show-scope')
+        if status != 0:
+            return False
+        scopes = {
+            'system': self._system,
+            'user': self._user,
+            'repo': self._repo,
+        }
+        worktree = self.git.worktree() or ''
+        watched = set()
+        fields = out.split('\0')
+        # Each entry is "scope\0origin\0key\nvalue\0"
+        for idx in range(0, len(fields) - 2, 3):
+            scope, origin, line = fields[idx:idx+3]
+            if not line:
+                # the user has an invalid entry in their git config
+                continue
+            k, v = _config_key_value(line, '\n')
+            category = _SCOPES.get(scope, scope)
+            if origin.startswith('file:'):
+                origin = join(worktree, origin[len('file:'):])
+                watched.add(origin)
+            self._map[k.lower()] = k
+            self._origins[k] = (category, origin)
+            self._all[k] = v
+            dest = scopes.get(category)
+            if dest is not None:
+                dest[k] = v
+        self._watched = watched
+        return True
 
+    def _read_config_files(self):
+        """Read the system, user and repo config files one by one"""
         if 'system' in self._config_files:
             self._system.update(
                     self.read_config(self._config_files['system']))
@@ -184,9 +304,6 @@ class GitConfig(observable.Observable):
             self._repo.update(
                     self.read_config(self._config_files['repo']))
 
-        for dct in (self._system, self._user):
-            self._user_or_system.update(dct)
-
         for dct in (self._system, self._user, self._repo):
             self._all.update(dct)
 
@@ -286,12 +403,14 @@ class GitConfig(observable.Observable):
     def set_user(self, key, value):
         msg = self.message_user_config_changed
         self.git.config('--global', key, self.python_to_git(value))
+        self.invalidate()
         self.update()
         self.notify_observers(msg, key, value)
 
     def set_repo(self, key, value):
         msg = self.message_repo_config_changed
         self.git.config(key, self.python_to_git(value))
+        self.invalidate()
         self.update()
         self.notify_observers(msg, key, value)
 
@@ -320,29 +439,91 @@ class GitConfig(observable.Observable):
         return self.get_cached('cola.fileattributes', default=False)
 
     def file_encoding(self, path):
+        return self.file_encodings([path])[path]
+
+    def file_encodings(self, paths):
+        """Return a dict mapping paths to their encodings
+
+        Paths missing from the cache are resolved together by the
+        persistent "git check-attr" process.
+
+        """
+        gui_encoding = self.gui_encoding()
         if not self.is_per_file_attrs_enabled():
-            return self.gui_encoding()
-        cache = self._attr_cache
+            return dict([(path, gui_encoding) for path in paths])
+        result = {}
+        with self._attr_lock:
+            self._check_attr_files()
+            cache = self._attr_cache
+            missing = []
+            for path in paths:
+                try:
+                    # Move the path to the most recently used end
+                    encoding = result[path] = cache.pop(path)
+                    cache[path] = encoding
+                except KeyError:
+                    missing.append(path)
+            if missing:
+                found = self._file_encodings(missing)
+                for path in missing:
+                    encoding = result[path] = cache[path] = found.get(path)
+                while len(cache) > self.attr_cache_size:
+                    cache.popitem(last=False)
+        return dict([(path, encoding or gui_encoding)
+                     for (path, encoding) in result.items()])
+
+    def _file_encodings(self, paths):
+        """Return the encoding attribute for paths, or None when unset"""
+        result = {}
         try:
-            value = cache[path]
-        except KeyError:
-            value = cache[path] = (self._file_encoding(path) or
-                                   self.gui_encoding())
-        return value
-
-    def _file_encoding(self, path):
-        """Return the file encoding for a path"""
-        status, out, err = self.git.check_attr('encoding', '--', path)
-        if status != 0:
-            return None
-        header = '%s: encoding: ' % path
-        if out.startswith(header):
-            encoding = out[len(header):].strip()
+            attrs = self.git.check_attributes(paths, 'encoding')
+        except (IOError, OSError, ValueError):
+            return result
+        for path, values in attrs.items():
+            encoding = values.get('encoding')
             if (encoding != 'unspecified' and
                     encoding != 'unset' and
                     encoding != 'set'):
-                return encoding
-        return None
+                result[path] = encoding
+        return result
+
+    def _check_attr_files(self):
+        """Forget the cached attributes when a .gitattributes changes
+
+        The attributes files are found again when .git/index changes
+        and are checked at most once per check_interval.
+
+        """
+        now = time.time()
+        if (self._attr_stamp is not None and
+                now - self._attr_checked < self.check_interval):
+            return
+        self._attr_checked = now
+        index_stamp = _stamp([self.git.git_path('index')])
+        if index_stamp != self._attr_index_stamp:
+            self._attr_index_stamp = index_stamp
+            self._attr_files = self._find_attr_files()
+        stamp = _stamp(self._attr_files)
+        if stamp != self._attr_stamp:
+            self._attr_stamp = stamp
+            self._attr_cache.clear()
+            self.git.reset_attributes()
+
+    def _find_attr_files(self):
+        """Return the paths of the files that can define attributes"""
+        status, out, err = self.git.ls_files('-z', '--cached', '--others',
+                                             '--exclude-standard', '--',
+                                             '.gitattributes',
+                                             '*/.gitattributes')
+        worktree = self.git.worktree() or ''
+        paths = set([join(worktree, path) for path in out.split('\0') if path])
+        paths.add(self.git.git_path('info', 'attributes'))
+        global_attributes = self.get('core.attributesfile')
+        if global_attributes:
+            paths.add(core.expanduser(global_attributes))
+        else:
+            paths.add(_USER_XDG_ATTRIBUTES)
+        return paths
 
     def get_guitool_opts(self, name):
         """Return the guitool.<name> namespace as a dict
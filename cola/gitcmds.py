@@ -1,6 +1,7 @@
 """Provides commands and queries for Git."""
 from __future__ import division, absolute_import, unicode_literals
 
+import os
 import re
 from io import StringIO
 
@@ -73,6 +74,8 @@ class _current_branch:
 
 def clear_cache():
     _current_branch.key = None
+    _last_commits.head = None
+    _last_commits.commits = {}
 
 
 def current_branch():
@@ -182,9 +185,10 @@ def tracked_branch(branch=None, config=None):
     return None
 
 
-def untracked_files(git=git):
+def untracked_files(git=git, paths=None):
     """Returns a sorted list of untracked files."""
-    out = git.ls_files(z=True, others=True, exclude_standard=True)[STDOUT]
+    out = git.ls_files('--', z=True, others=True, exclude_standard=True,
+                       *(paths or []))[STDOUT]
     if out:
         return out[:-1].split('\0')
     return []
@@ -233,8 +237,135 @@ def sha1_diff(git, sha1, filename=None):
         return git.diff(sha1+'^!', filename, **common_diff_opts())[STDOUT]
 
 
+def commit_body(sha1, git=git):
+    """Return the body of a commit message, as with "git log --format=%b"
+
+    The commit is read through the persistent "cat-file --batch" process.
+
+    """
+    obj = git.read_object(sha1)
+    if obj is None or obj[1] != 'commit':
+        return log(git, '-1', sha1, '--', pretty='format:%b')
+    data = obj[2]
+    encoding = None
+    try:
+        headers, message = data.split(b'\n\n', 1)
+    except ValueError:
+        return ''
+    for header in headers.split(b'\n'):
+        if header.startswith(b'encoding '):
+            encoding = core.decode(header[len(b'encoding '):])
+    message = core.decode(message, encoding=encoding)
+    # The subject is the first paragraph; the body is everything after it
+    paragraphs = message.lstrip('\n').split('\n\n', 1)
+    if len(paragraphs) < 2:
+        return ''
+    return paragraphs[1].lstrip('\n')
+
+
+class _last_commits:
+    """Cache for last_commits(), valid until HEAD moves"""
+    head = None
+    commits = {}
+
+
+def last_commits(paths, git=git):
+    """Generate (path, info) for the last commit that touched each path
+
+    info is a (date, summary, author) tuple, or None for paths without
+    history.  Results are cached until HEAD moves; uncached paths are
+    resolved together by walk_last_commits().
+
+    """
+    status, head, err = git.rev_parse('HEAD')
+    if status != 0:
+        for path in paths:
+            yield path, None
+        return
+    if head != _last_commits.head:
+        _last_commits.head = head
+        _last_commits.commits = {}
+    commits = _last_commits.commits
+    pending = []
+    for path in paths:
+        if path in commits:
+            yield path, commits[path]
+        else:
+            pending.append(path)
+    for path, info in walk_last_commits(pending, ref=head, git=git):
+        commits[path] = info
+        yield path, info
+
+
+# Beyond this many paths the walk is limited to their common directory
+# so that the command line stays short
+MAX_PATHSPECS = 256
+
+
+def _paths_in_tree(paths, ref, git=git):
+    """Return the subset of paths that exist in ref's tree"""
+    cmd = ['git', '--literal-pathspecs', 'ls-tree', '-z', '--name-only',
+           ref, '--'] + list(paths)
+    status, out, err = core.run_command(cmd, cwd=git.getcwd())
+    if status != 0:
+        return set(paths)
+    return set(out.split('\0')) & set(paths)
+
+
+def walk_last_commits(paths, ref='HEAD', git=git):
+    """Find the last commit touching each path with one "git log" walk
+
+    Results are generated as soon as they are found and the walk stops
+    once every path has been seen.  Directories are resolved by the
+    files beneath them.  Paths missing from ref's tree are reported
+    without history up front so that they never force a full walk.
+
+    """
+    pending = set(paths)
+    if not pending:
+        return
+    if len(pending) <= MAX_PATHSPECS:
+        tracked = _paths_in_tree(pending, ref, git=git)
+        for path in sorted(pending - tracked):
+            yield path, None
+        pending = tracked
+        if not pending:
+            return
+        pathspecs = sorted(pending)
+    else:
+        # Limit the walk to the directory holding all of the paths
+        common = os.path.commonprefix([path.split('/')[:-1]
+                                       for path in pending])
+        pathspecs = common and ['/'.join(common)] or []
+    cmd = ['git', '--literal-pathspecs', 'log', '-z', '--name-only',
+           '--no-renames', '--no-color',
+           '--pretty=format:%x02%ar%x01%s%x01%an', ref, '--'] + pathspecs
+    proc = core.start_command(cmd, cwd=git.getcwd())
+    info = None
+    try:
+        for token in core.read_nul_tokens(proc.stdout):
+            if token.startswith('\x02'):
+                header, sep, token = token[1:].partition('\n')
+                info = tuple(header.split('\x01', 2))
+            path = token
+            while path and info is not None:
+                if path in pending:
+                    pending.remove(path)
+                    yield path, info
+                path = utils.dirname(path)
+            if not pending:
+                return
+        # Whatever is left has no history
+        for path in sorted(pending):
+            yield path, None
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        core.communicate(proc)
+
+
 def diff_info(sha1, git=git, filename=None):
-    decoded = log(git, '-1', sha1, '--', pretty='format:%b').strip()
+    decoded = commit_body(sha1, git=git).strip()
     if decoded:
         decoded += '\n\n'
     return decoded + sha1_diff(git, sha1, filename=filename)
@@ -412,27 +543,35 @@ def worktree_state(head='HEAD'):
            state.get('upstream_changed', []))
 
 
-def worktree_state_dict(head='HEAD', update_index=False, display_untracked=True):
+def worktree_state_dict(head='HEAD', update_index=False, display_untracked=True,
+                        paths=None):
     """Return a dict of files in various states of being
 
     :rtype: dict, keys are staged, unstaged, untracked, unmerged,
             changed_upstream, and submodule.
 
+    When `paths` is given only those paths are queried and
+    "upstream_changed" is left out of the result.
+
     """
     if update_index:
         git.update_index(refresh=True)
 
-    staged, unmerged, staged_submods = diff_index(head)
-    modified, modified_submods = diff_worktree()
-    untracked = display_untracked and untracked_files() or []
+    # "git status" only compares against HEAD so amend mode, which
+    # diffs against HEAD^, uses the diff-index/diff-files backend.
+    if head == 'HEAD' and version.check('status-porcelain-v2',
+                                        version.git_version()):
+        state = status_v2(display_untracked=display_untracked, paths=paths)
+        if state is not None:
+            return _worktree_state(head, paths, *state)
+
+    state = diff_state(head=head, display_untracked=display_untracked,
+                       paths=paths)
+    return _worktree_state(head, paths, *state)
 
-    # Remove unmerged paths from the modified list
-    unmerged_set = set(unmerged)
-    modified_set = set(modified)
-    modified_unmerged = modified_set.intersection(unmerged_set)
-    for path in modified_unmerged:
-        modified.remove(path)
 
+def _worktree_state(head, paths, staged, modified, unmerged, untracked,
+                    staged_submods, modified_submods):
     # All submodules
     submodules = staged_submods.union(modified_submods)
 
@@ -445,30 +584,134 @@ def worktree_state_dict(head='HEAD', update_index=False, display_untracked=True)
     staged.extend(list(staged_submods))
     modified.extend(list(modified_submods))
 
-    # Look for upstream modified files if this is a tracking branch
-    upstream_changed = diff_upstream(head)
-
     # Keep stuff sorted
     staged.sort()
     modified.sort()
     unmerged.sort()
     untracked.sort()
-    upstream_changed.sort()
 
-    return {'staged': staged,
-            'modified': modified,
-            'unmerged': unmerged,
-            'untracked': untracked,
-            'upstream_changed': upstream_changed,
-            'submodules': submodules}
+    state = {'staged': staged,
+             'modified': modified,
+             'unmerged': unmerged,
+             'untracked': untracked,
+             'submodules': submodules}
+
+    if paths is None:
+        # Look for upstream modified files if this is a tracking branch
+        upstream_changed = diff_upstream(head)
+        upstream_changed.sort()
+        state['upstream_changed'] = upstream_changed
+
+    return state
+
+
+def status_v2(display_untracked=True, paths=None, git=git):
+    """Read the worktree state using a single "git status --porcelain=v2"
+
+    Returns a tuple of (staged, modified, unmerged, untracked,
+    staged_submods, modified_submods), or None when git fails.
+
+    """
+    if display_untracked:
+        untracked_arg = '--untracked-files=all'
+    else:
+        untracked_arg = '--untracked-files=no'
+    cmd = ['git', 'status', '--porcelain=v2', '-z', untracked_arg, '--']
+    if paths:
+        cmd.extend(paths)
+    # "git status" refreshes the index when it can take index.lock,
+    # which would race with cola's own index writers
+    proc = core.start_command(cmd, cwd=git.getcwd(),
+                              add_env={'GIT_OPTIONAL_LOCKS': '0'})
+    state = parse_status_v2(core.read_nul_tokens(proc.stdout))
+    core.communicate(proc)
+    if proc.returncode != 0:
+        return None
+    return state
+
+
+def diff_state(head='HEAD', display_untracked=True, paths=None):
+    """Read the worktree state using "diff-index", "diff-files" and "ls-files"
+
+    Returns the same tuple as status_v2().
+
+    """
+    staged, unmerged, staged_submods = diff_index(head, paths=paths)
+    modified, modified_submods = diff_worktree(paths=paths)
+    untracked = display_untracked and untracked_files(paths=paths) or []
+
+    # Remove unmerged paths from the modified list
+    unmerged_set = set(unmerged)
+    modified_set = set(modified)
+    modified_unmerged = modified_set.intersection(unmerged_set)
+    for path in modified_unmerged:
+        modified.remove(path)
+
+    return (staged, modified, unmerged, untracked,
+            staged_submods, modified_submods)
+
+
+def parse_status_v2(tokens):
+    """Parse the NUL-separated tokens of "git status --porcelain=v2 -z"
+
+    Renamed entries list both the new and the original path, which
+    matches what "diff-index" and "diff-files" report without -M.
+
+    """
+    staged = []
+    modified = []
+    unmerged = []
+    untracked = []
+    staged_submods = set()
+    modified_submods = set()
+
+    tokens = iter(tokens)
+    for token in tokens:
+        kind = token[:1]
+        if kind == '1':
+            fields = token.split(' ', 8)
+            paths = [fields[-1]]
+        elif kind == '2':
+            fields = token.split(' ', 9)
+            # The original path follows as a separate token
+            paths = [fields[-1], next(tokens, '')]
+        elif kind == 'u':
+            unmerged.append(token.split(' ', 10)[-1])
+            continue
+        elif kind == '?':
+            untracked.append(token[2:])
+            continue
+        else:
+            # headers ("#") and ignored files ("!")
+            continue
+
+        index_status, worktree_status = fields[1][0], fields[1][1]
+        if fields[2].startswith('S'):
+            if index_status != '.':
+                staged_submods.add(paths[0])
+            if worktree_status != '.':
+                modified_submods.add(paths[0])
+            continue
+        if index_status != '.':
+            staged.append(paths[0])
+            if index_status == 'R':
+                staged.append(paths[1])
+        if worktree_status != '.':
+            modified.append(paths[0])
+            if worktree_status == 'R':
+                modified.append(paths[1])
+
+    return (staged, modified, unmerged, untracked,
+            staged_submods, modified_submods)
 
 
-def diff_index(head, cached=True):
+def diff_index(head, cached=True, paths=None):
     submodules = set()
     staged = []
     unmerged = []
 
-    status, out, err = git.diff_index(head, '--', cached=cached, z=True)
+    status, out, err = git.diff_index(head, '--', cached=cached, z=True,
+                                      *(paths or []))
     if status != 0:
         # handle git init
         return all_files(), unmerged, submodules
@@ -487,14 +730,15 @@ def diff_index(head, cached=True):
     return staged, unmerged, submodules
 
 
-def diff_worktree():
+def diff_worktree(paths=None):
     modified = []
     submodules = set()
 
-    status, out, err = git.diff_files(z=True)
+    status, out, err = git.diff_files('--', z=True, *(paths or []))
     if status != 0:
         # handle git init
-        out = git.ls_files(modified=True, z=True)[STDOUT]
+        out = git.ls_files('--', modified=True, z=True,
+                           *(paths or []))[STDOUT]
         if out:
             modified = out[:-1].split('\0')
         return modified, submodules
@@ -1,16 +1,14 @@
 from __future__ import division, absolute_import, unicode_literals
 
-import time
-
 from PyQt4 import QtGui
 from PyQt4 import QtCore
-from PyQt4 import QtNetwork
 from PyQt4.QtCore import Qt
 from PyQt4.QtCore import SIGNAL
 
 from cola import resources
 from cola import core
-from cola.compat import ustr, urllib
+from cola.compat import urllib
+from cola.models import avatars
 import hashlib
 
 
@@ -26,87 +24,60 @@ class Gravatar(object):
 
 
 class GravatarLabel(QtGui.QLabel):
+
+    imgsize = 48
+
     def __init__(self, parent=None):
         QtGui.QLabel.__init__(self, parent)
 
         self.email = None
-        self.response = None
-        self.timeout = 0
-        self.imgsize = 48
         self.pixmaps = {}
+        self.tasks = set()
+        self._default_pixmap = None
 
-        self.network = QtNetwork.QNetworkAccessManager()
-        self.connect(self.network,
-                     SIGNAL('finished(QNetworkReply*)'),
-                     self.network_finished)
+        self.connect(self, SIGNAL('avatar_ready'), self.avatar_ready)
+        self.connect(self, SIGNAL('task_done'), self.task_done)
 
     def set_email(self, email):
+        self.email = email
         if email in self.pixmaps:
             self.setPixmap(self.pixmaps[email])
             return
-        if (self.timeout > 0 and
-                (int(time.time()) - self.timeout) < (5 * 60)):
-            self.set_pixmap_from_response()
-            return
-        if email == self.email and self.response is not None:
-            self.set_pixmap_from_response()
-            return
-        self.email = email
-        self.request(email)
-
-    def request(self, email):
-        url = Gravatar.url_for_email(email, self.imgsize)
-        self.network.get(QtNetwork.QNetworkRequest(QtCore.QUrl(url)))
-
-    def default_pixmap_as_bytes(self):
-        xres = self.imgsize
-        pixmap = QtGui.QPixmap(resources.icon('git.svg'))
-        pixmap = pixmap.scaledToHeight(xres, Qt.SmoothTransformation)
-        byte_array = QtCore.QByteArray()
-        buf = QtCore.QBuffer(byte_array)
-        buf.open(QtCore.QIODevice.WriteOnly)
-        pixmap.save(buf, 'PNG')
-        buf.close()
-        return byte_array
-
-    def network_finished(self, reply):
-        email = self.email
-
-        header = QtCore.QByteArray('Location')
-        raw_header = reply.rawHeader(header)
-        if raw_header:
-            location = ustr(QtCore.QString(raw_header)).strip()
-            request_location = ustr(
-                    Gravatar.url_for_email(self.email, self.imgsize))
-            relocated = location != request_location
-        else:
-            relocated = False
-
-        if reply.error() == QtNetwork.QNetworkReply.NoError:
-            if relocated:
-                # We could do get_url(urllib.unquote(location)) to
-                # download the default image.
-                # Save bandwidth by using a pixmap.
-                self.response = self.default_pixmap_as_bytes()
-            else:
-                self.response = reply.readAll()
-            self.timeout = 0
-        else:
-            self.response = self.default_pixmap_as_bytes()
-            self.timeout = int(time.time())
-
-        pixmap = self.set_pixmap_from_response()
-
-        # If the email has not changed (e.g. no other requests)
-        # then we know that this pixmap corresponds to this specific
-        # email address.  We can't blindly trust self.email else
-        # we may add cache entries for thee wrong email address.
-        url = Gravatar.url_for_email(email, self.imgsize)
-        if url == ustr(reply.url().toString()):
-            self.pixmaps[email] = pixmap
-
-    def set_pixmap_from_response(self):
+        # Avatars are read from the shared cache, or downloaded, in the
+        # background.  Requests for the same avatar are coalesced there.
+        task = AvatarTask(self, email, self.imgsize)
+        self.tasks.add(task)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+
+    def default_pixmap(self):
+        if self._default_pixmap is None:
+            pixmap = QtGui.QPixmap(resources.icon('git.svg'))
+            self._default_pixmap = pixmap.scaledToHeight(
+                    self.imgsize, Qt.SmoothTransformation)
+        return self._default_pixmap
+
+    def avatar_ready(self, email, data):
         pixmap = QtGui.QPixmap()
-        pixmap.loadFromData(self.response)
-        self.setPixmap(pixmap)
-        return pixmap
+        if data is None or not pixmap.loadFromData(data):
+            pixmap = self.default_pixmap()
+        self.pixmaps[email] = pixmap
+        # Results for an email that is no longer shown are only cached
+        if email == self.email:
+            self.setPixmap(pixmap)
+
+
+class AvatarTask(QtCore.QRunnable):
+
+    def __init__(self, label, email, imgsize):
+        QtCore.QRunnable.__init__(self)
+        self.label = label
+        self.email = email
+        self.imgsize = imgsize
+
+    def run(self):
+        data = avatars.instance().get(self.email, self.imgsize)
+        self.label.emit(SIGNAL('avatar_ready'), self.email, data)
+        self.label.emit(SIGNAL('task_done'), self)
@@ -103,19 +103,24 @@ class Handler():
         """Create an event handler"""
         ## Timer used to prevent notification floods
         self._timer = None
+        ## Paths touched since the last broadcast
+        self._paths = set()
         ## Lock to protect files and timer from threading issues
         self._lock = Lock()
 
     def broadcast(self):
         """Broadcasts a list of all files touched since last broadcast"""
         with self._lock:
+            paths = sorted(self._paths)
+            self._paths = set()
             for observer in _observers:
-                observer()
+                observer(paths)
             self._timer = None
 
     def handle(self, path):
         """Queues up filesystem events for broadcast"""
         with self._lock:
+            self._paths.add(path)
             if self._timer is None:
                 self._timer = Timer(0.888, self.broadcast)
                 self._timer.start()
@@ -0,0 +1,285 @@
+"""A process-wide cache of avatar images
+
+Every GravatarLabel used to download the avatars it showed and keep
+them for as long as the label lived, so each new DAG window or restart
+downloaded them again.  AvatarCache keeps the images on disk under the
+cache directory, shared by every label and process.  Images are stored
+by the sha1 of their content, so the many authors sharing eg. the same
+default image share one file, and are dropped when they are older than
+a TTL or when the images outgrow a size cap.  Authors without an avatar
+are remembered as well so that they are not asked for again.
+
+Requests for an avatar that is already being downloaded wait for that
+download instead of starting another one.  Nothing here depends on Qt.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import collections
+import hashlib
+import os
+import socket
+import threading
+import time
+
+from cola import core
+from cola import resources
+from cola.compat import urllib_error
+from cola.compat import urllib_request
+from cola.decorators import memoize
+from cola.models import storage
+
+
+def email_hash(email):
+    """Return the hash gravatar uses for an email address"""
+    return hashlib.md5(core.encode(email.strip().lower())).hexdigest()
+
+
+class AvatarCache(object):
+    """Downloads avatars once and keeps them on disk and in memory"""
+
+    base_url = 'http://gravatar.com/avatar/'
+
+    ttl = 7 * 24 * 60 * 60
+    """How long a downloaded avatar is used before asking again"""
+
+    miss_ttl = 24 * 60 * 60
+    """How long an author without an avatar is remembered"""
+
+    error_ttl = 5 * 60
+    """How long to wait before retrying after a network error"""
+
+    max_bytes = 8 * 1024 * 1024
+    """The total size of the images kept on disk"""
+
+    max_memory = 256
+    """The number of avatars kept in memory"""
+
+    max_prefetch = 64
+    """The number of avatars queued by a single prefetch() call"""
+
+    timeout = 10
+
+    def __init__(self, path=None, base_url=None):
+        if path is None:
+            path = resources.cache_home('avatars')
+        self.path = path
+        if base_url is not None:
+            self.base_url = base_url
+        self.requests = 0
+        """The number of downloads started"""
+        self._memory = collections.OrderedDict()
+        self._pending = {}
+        self._queue = collections.deque()
+        self._prefetching = False
+        self._lock = threading.Lock()
+
+    def url(self, email, size):
+        """Return the URL of an avatar, which is missing when there is none"""
+        return '%s%s?s=%d&d=404' % (self.base_url, email_hash(email), size)
+
+    def key(self, email, size):
+        return '%s-%d' % (email_hash(email), size)
+
+    def cached(self, email, size):
+        """Return True when an avatar is known without asking the network"""
+        with self._lock:
+            return self._remembered(self.key(email, size)) is not None
+
+    def _remembered(self, key):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._memory[key]
+            return None
+        self._memory[key] = self._memory.pop(key)
+        return entry
+
+    def _remember(self, key, expires, data):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._memory[key] = (expires, data)
+            while len(self._memory) > self.max_memory:
+                self._memory.popitem(last=False)
+
+    def get(self, email, size):
+        """Return the image data of an avatar, or None when there is none
+
+        Downloads the avatar when it is not cached, so this is meant to
+        be called from a thread.
+
+        """
+        key = self.key(email, size)
+        while True:
+            with self._lock:
+                entry = self._remembered(key)
+                if entry is not None:
+                    return entry[1]
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            entry = self._read(key)
+            if entry is None:
+                entry = self._fetch(email, size, key)
+            expires, data = entry
+            self._remember(key, expires, data)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+        return data
+
+    def prefetch(self, emails, size):
+        """Download the avatars of a list of authors in the background"""
+        with self._lock:
+            queued = set(self._queue)
+            count = 0
+            for email in emails:
+                if count >= self.max_prefetch:
+                    break
+                if not email:
+                    continue
+                request = (email, size)
+                if request in queued:
+                    continue
+                queued.add(request)
+                if self._remembered(self.key(email, size)) is not None:
+                    continue
+                self._queue.append(request)
+                count += 1
+            if not self._queue or self._prefetching:
+                return
+            self._prefetching = True
+        thread = threading.Thread(target=self._prefetch)
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._prefetching = False
+                    return
+                email, size = self._queue.popleft()
+            self.get(email, size)
+
+    def _keys_path(self, *paths):
+        return os.path.join(self.path, 'keys', *paths)
+
+    def _objects_path(self, *paths):
+        return os.path.join(self.path, 'objects', *paths)
+
+    def _read(self, key):
+        """Return (expires, data) from the disk cache, or None"""
+        path = self._keys_path(key)
+        try:
+            mtime = core.stat(path).st_mtime
+            with open(core.mkpath(path), 'rb') as fh:
+                sha1 = core.decode(fh.read()).strip()
+        except (IOError, OSError):
+            return None
+        if sha1 == '-':
+            expires = mtime + self.miss_ttl
+            if expires < time.time():
+                return None
+            return (expires, None)
+        expires = mtime + self.ttl
+        if expires < time.time():
+            return None
+        path = self._objects_path(sha1)
+        try:
+            with open(core.mkpath(path), 'rb') as fh:
+                data = fh.read()
+            # Recently used images are the last to be dropped
+            os.utime(core.mkpath(path), None)
+        except (IOError, OSError):
+            return None
+        return (expires, data)
+
+    def _fetch(self, email, size, key):
+        """Download an avatar and return (expires, data)"""
+        with self._lock:
+            self.requests += 1
+        now = time.time()
+        try:
+            fh = urllib_request.urlopen(self.url(email, size),
+                                        timeout=self.timeout)
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+        except urllib_error.HTTPError as e:
+            if e.code != 404:
+                return (now + self.error_ttl, None)
+            self._write(self._keys_path(key), b'-\n')
+            return (now + self.miss_ttl, None)
+        except (urllib_error.URLError, socket.error, socket.timeout,
+                IOError, ValueError):
+            return (now + self.error_ttl, None)
+        if not data:
+            return (now + self.error_ttl, None)
+        sha1 = hashlib.sha1(data).hexdigest()
+        path = self._objects_path(sha1)
+        if not core.exists(path):
+            self._write(path, data)
+        self._write(self._keys_path(key), core.encode(sha1 + '\n'))
+        self.trim()
+        return (now + self.ttl, data)
+
+    def _write(self, path, data):
+        storage.write(path, data)
+
+    def trim(self):
+        """Drop the least recently used images beyond max_bytes
+
+        Keys older than the TTLs are dropped along with them.
+
+        """
+        now = time.time()
+        objects = []
+        total = 0
+        for path in self._listdir(self._objects_path()):
+            try:
+                st = core.stat(path)
+            except OSError:
+                continue
+            objects.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        objects.sort()
+        for mtime, size, path in objects:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+        max_age = max(self.ttl, self.miss_ttl)
+        for path in self._listdir(self._keys_path()):
+            try:
+                if now - core.stat(path).st_mtime > max_age:
+                    self._remove(path)
+            except OSError:
+                continue
+
+    def _listdir(self, path):
+        try:
+            names = os.listdir(core.mkpath(path))
+        except OSError:
+            return []
+        return [os.path.join(path, core.decode(name)) for name in names
+                if not core.decode(name).endswith('.tmp')]
+
+    def _remove(self, path):
+        try:
+            os.remove(core.mkpath(path))
+        except OSError:
+            pass
+
+
+@memoize
+def instance():
+    """Return the AvatarCache shared by the avatar widgets"""
+    return AvatarCache()
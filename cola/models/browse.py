@@ -8,12 +8,12 @@ from PyQt4.QtCore import Qt
 from PyQt4.QtCore import SIGNAL
 
 from cola import gitcfg
+from cola import gitcmds
 from cola import core
 from cola import utils
 from cola import qtutils
 from cola import version
 from cola import resources
-from cola.git import STDOUT
 from cola.i18n import N_
 from cola.models import main
 
@@ -49,7 +49,13 @@ class Columns(object):
 
 
 class GitRepoModel(QtGui.QStandardItemModel):
-    """Provides an interface into a git repository for browsing purposes."""
+    """Provides an interface into a git repository for browsing purposes.
+
+    Rows are only created for the top-level directory and for
+    directories that have been expanded.  The children of the other
+    directories are read from a path index by fetchMore().
+
+    """
     def __init__(self, parent):
         QtGui.QStandardItemModel.__init__(self, parent)
         self._interesting_paths = self._get_paths()
@@ -65,6 +71,8 @@ class GitRepoModel(QtGui.QStandardItemModel):
             self.setHeaderData(idx, Qt.Horizontal, QtCore.QVariant(text))
 
         self._direntries = {'': self.invisibleRootItem()}
+        self._path_index = {}
+        self._populated = set()
         self._initialize()
 
     def _create_column(self, col, path):
@@ -150,50 +158,59 @@ class GitRepoModel(QtGui.QStandardItemModel):
     def _updated_callback(self):
         old_paths = self._interesting_paths
         new_paths = self._get_paths()
-        for path in new_paths.union(old_paths):
-            if path not in self._known_paths:
-                continue
-            self.entry(path).update()
+        paths = [path for path in new_paths.union(old_paths)
+                 if path in self._known_paths]
+        GitRepoEntryManager.update(paths)
 
         self._interesting_paths = new_paths
 
     def _initialize(self):
-        """Iterate over the cola model and create GitRepoItems."""
-        for path in main.model().everything():
-            self.add_file(path)
-
-    def add_file(self, path, insert=False):
-        """Add a file to the model."""
-        dirname = utils.dirname(path)
-        if dirname in self._direntries:
-            parent = self._direntries[dirname]
-        else:
-            parent = self._create_dir_entry(dirname, self._direntries)
-            self._direntries[dirname] = parent
-        self._add_file(parent, path, insert=insert)
-
-    def _create_dir_entry(self, dirname, direntries):
-        """
-        Create a directory entry for the model.
+        """Index the worktree and create the top-level rows."""
+        self._path_index = utils.path_index(main.model().everything())
+        self._populate('')
+        subdirs, files = self._path_index['']
+        GitRepoEntryManager.update(subdirs + files)
+
+    def _populate(self, dirname):
+        """Create the rows for a directory's children."""
+        if dirname in self._populated:
+            return
+        self._populated.add(dirname)
+        parent = self._direntries[dirname]
+        subdirs, files = self._path_index.get(dirname, ((), ()))
+        for path in subdirs:
+            self._direntries[path] = self.add_directory(parent, path)
+        for path in files:
+            self._add_file(parent, path)
+
+    def _unpopulated_dir(self, index):
+        """Return the directory for an index if its rows are pending."""
+        if not index.isValid():
+            return None
+        item = self.itemFromIndex(index.sibling(index.row(), 0))
+        if item is None or item.type() != GitRepoNameItem.TYPE:
+            return None
+        path = item.path
+        if path in self._path_index and path not in self._populated:
+            return path
+        return None
+
+    def hasChildren(self, index=QtCore.QModelIndex()):
+        if self._unpopulated_dir(index) is not None:
+            return True
+        return QtGui.QStandardItemModel.hasChildren(self, index)
 
-        This ensures that directories are always listed before files.
+    def canFetchMore(self, index):
+        if self._unpopulated_dir(index) is not None:
+            return True
+        return QtGui.QStandardItemModel.canFetchMore(self, index)
 
-        """
-        entries = dirname.split('/')
-        curdir = []
-        parent = self.invisibleRootItem()
-        curdir_append = curdir.append
-        self_add_directory = self.add_directory
-        for entry in entries:
-            curdir_append(entry)
-            path = '/'.join(curdir)
-            if path in direntries:
-                parent = direntries[path]
-            else:
-                grandparent = parent
-                parent = self_add_directory(grandparent, path)
-                direntries[path] = parent
-        return parent
+    def fetchMore(self, index):
+        dirname = self._unpopulated_dir(index)
+        if dirname is None:
+            QtGui.QStandardItemModel.fetchMore(self, index)
+            return
+        self._populate(dirname)
 
     def entry(self, path):
         """Return the GitRepoEntry for a path."""
@@ -215,6 +232,12 @@ class GitRepoEntryManager(object):
             e = _static_entries[path] = GitRepoEntry(path)
         return e
 
+    @classmethod
+    def update(cls, paths):
+        """Look up the data for many paths using a single task."""
+        if paths:
+            TaskRunner.instance().run(GitRepoInfoTask(paths))
+
 
 class TaskRunner(object):
     """Manages QRunnable task instances to avoid python's garbage collector
@@ -267,14 +290,11 @@ class GitRepoEntry(QtCore.QObject):
         """Emits a signal corresponding to the entry's name."""
         # 'name' is cheap to calculate so simply emit a signal
         self.emit(SIGNAL(Columns.NAME), utils.basename(self.path))
-        if '/' not in self.path:
-            self.update()
 
     def update(self):
         """Starts a GitRepoInfoTask to calculate info for entries."""
         # GitRepoInfoTask handles expensive lookups
-        task = GitRepoInfoTask(self.path)
-        TaskRunner.instance().run(task)
+        GitRepoEntryManager.update([self.path])
 
     def event(self, e):
         """Receive GitRepoInfoEvents and emit corresponding Qt signals."""
@@ -293,44 +313,22 @@ else:
         pass
 
 class GitRepoInfoTask(QRunnable):
-    """Handles expensive git lookups for a path."""
-    def __init__(self, path):
-        QRunnable.__init__(self)
-        self.path = path
-        self._cfg = gitcfg.instance()
-        self._data = {}
-
-    def data(self, key):
-        """
-        Return git data for a path.
+    """Handles expensive git lookups for a batch of paths.
 
-        Supported keys are 'date', 'message', and 'author'
+    The last commit for every path is found by a single history walk
+    and each entry is updated as soon as its commit is found.
 
-        """
-        if not self._data:
-            log_line = main.model().git.log('-1', '--', self.path,
-                                            M=True,
-                                            all=False,
-                                            no_color=True,
-                                            pretty='format:%ar%x01%s%x01%an'
-                                            )[STDOUT]
-            if log_line:
-                log_line = log_line
-                date, message, author = log_line.split(chr(0x01), 2)
-                self._data['date'] = date
-                self._data['message'] = message
-                self._data['author'] = author
-            else:
-                self._data['date'] = self.date()
-                self._data['message'] = '-'
-                self._data['author'] = self._cfg.get('user.name', 'unknown')
-        return self._data[key]
+    """
+    def __init__(self, paths):
+        QRunnable.__init__(self)
+        self.paths = paths
+        self._cfg = gitcfg.instance()
 
-    def name(self):
+    def name(self, path):
         """Calculate the name for an entry."""
-        return utils.basename(self.path)
+        return utils.basename(path)
 
-    def date(self):
+    def date(self, path):
         """
         Returns a relative date for a file path.
 
@@ -339,7 +337,7 @@ class GitRepoInfoTask(QRunnable):
 
         """
         try:
-            st = core.stat(self.path)
+            st = core.stat(path)
         except:
             return N_('%d minutes ago') % 0
         elapsed = time.time() - st.st_mtime
@@ -351,8 +349,8 @@ class GitRepoInfoTask(QRunnable):
             return N_('%d hours ago') % hours
         return N_('%d days ago') % int(elapsed / 60 / 60 / 24)
 
-    def status(self):
-        """Return the status for the entry's path."""
+    def statuses(self):
+        """Generate (path, status) for the task's paths."""
 
         model = main.model()
         unmerged = utils.add_parents(set(model.unmerged))
@@ -361,32 +359,45 @@ class GitRepoInfoTask(QRunnable):
         untracked = utils.add_parents(set(model.untracked))
         upstream_changed = utils.add_parents(set(model.upstream_changed))
 
-        if self.path in unmerged:
-            return (resources.icon('modified.png'), N_('Unmerged'))
-        if self.path in modified and self.path in staged:
-            return (resources.icon('partial.png'), N_('Partially Staged'))
-        if self.path in modified:
-            return (resources.icon('modified.png'), N_('Modified'))
-        if self.path in staged:
-            return (resources.icon('staged.png'), N_('Staged'))
-        if self.path in upstream_changed:
-            return (resources.icon('upstream.png'), N_('Changed Upstream'))
-        if self.path in untracked:
-            return (None, '?')
-        return (None, '')
+        for path in self.paths:
+            if path in unmerged:
+                status = (resources.icon('modified.png'), N_('Unmerged'))
+            elif path in modified and path in staged:
+                status = (resources.icon('partial.png'),
+                          N_('Partially Staged'))
+            elif path in modified:
+                status = (resources.icon('modified.png'), N_('Modified'))
+            elif path in staged:
+                status = (resources.icon('staged.png'), N_('Staged'))
+            elif path in upstream_changed:
+                status = (resources.icon('upstream.png'),
+                          N_('Changed Upstream'))
+            elif path in untracked:
+                status = (None, '?')
+            else:
+                status = (None, '')
+            yield path, status
 
     def run(self):
         """Perform expensive lookups and post corresponding events."""
         app = QtGui.QApplication.instance()
-        entry = GitRepoEntryManager.entry(self.path)
-        app.postEvent(entry,
-                GitRepoInfoEvent(Columns.MESSAGE, self.data('message')))
-        app.postEvent(entry,
-                GitRepoInfoEvent(Columns.AGE, self.data('date')))
-        app.postEvent(entry,
-                GitRepoInfoEvent(Columns.AUTHOR, self.data('author')))
-        app.postEvent(entry,
-                GitRepoInfoEvent(Columns.STATUS, self.status()))
+        entry = GitRepoEntryManager.entry
+        for path, status in self.statuses():
+            app.postEvent(entry(path),
+                          GitRepoInfoEvent(Columns.STATUS, status))
+
+        for path, info in gitcmds.last_commits(self.paths):
+            if info is None:
+                info = (self.date(path), '-',
+                        self._cfg.get('user.name', 'unknown'))
+            date, message, author = info
+            path_entry = entry(path)
+            app.postEvent(path_entry,
+                          GitRepoInfoEvent(Columns.MESSAGE, message))
+            app.postEvent(path_entry,
+                          GitRepoInfoEvent(Columns.AGE, date))
+            app.postEvent(path_entry,
+                          GitRepoInfoEvent(Columns.AUTHOR, author))
 
         TaskRunner.instance().cleanup_task(self)
 
@@ -0,0 +1,334 @@
+"""Indexes for completing refs and paths
+
+The completion popups used to scan and sort every ref and path on each
+keystroke.  CompletionIndex is built once, follows later changes
+incrementally and answers queries with the best few matches, looking
+only at the items that can match when the text is selective.  It does
+not depend on Qt so that it can be queried from the completion threads.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import bisect
+import heapq
+import threading
+from array import array
+
+from cola import core
+from cola import gitcmds
+from cola import utils
+from cola.decorators import memoize
+from cola.git import git
+
+
+def _never():
+    return False
+
+
+def trigrams(text):
+    """Return the set of three-character substrings of text"""
+    return set([text[idx:idx+3] for idx in range(len(text) - 2)])
+
+
+class CompletionIndex(object):
+    """Ranked substring search over a set of strings
+
+    Text matches an item when it occurs in the item and the occurrence
+    reaches the item's name, ie. the part after the last separator.
+    Matches that lie entirely within a parent directory are left out
+    because the parent directory is expected to be an item of its own.
+    Text ending in the separator matches the items directly beneath a
+    directory.  Without a separator an item is its own name, and text
+    matches wherever it occurs.
+
+    Items whose name starts with the text rank first, and shorter items
+    rank before longer ones.
+
+    """
+    limit = 100
+    """The number of matches returned by default"""
+
+    max_ranked = 4096
+    """Beyond this many candidates only the shortest matches are ranked"""
+
+    max_pending = 1024
+    """The number of changes kept aside before the index is rebuilt"""
+
+    def __init__(self, items=(), separator='/'):
+        self.separator = separator
+        self._lock = threading.RLock()
+        self._build(items)
+
+    def name(self, string):
+        """Return the part of an item after the last separator"""
+        if self.separator is None:
+            return string
+        return string[string.rfind(self.separator)+1:]
+
+    def _build(self, items):
+        self.members = set(items)
+        # Shorter items come first so that scans find them first
+        self.items = items = sorted(self.members)
+        items.sort(key=len)
+        self.lower = lower = [item.lower() for item in items]
+        self.ids = dict((item, idx) for idx, item in enumerate(items))
+        self.text = '\n'.join(items) + '\n'
+        """The items in a single string for fast scanning"""
+        self.lower_text = '\n'.join(lower) + '\n'
+        self.offsets = offsets = array(str('l'))
+        """The offset of each item in self.lower_text"""
+        self.case_offsets = case_offsets = array(str('l'))
+        """The offset of each item in self.text"""
+
+        # Names are indexed once no matter how many items share them
+        self.names = names = {}
+        """Maps lowercase names to the ids of the items with that name"""
+        self.index = index = {}
+        """Maps trigrams to the names containing them"""
+        pos = case_pos = 0
+        for idx, string in enumerate(lower):
+            offsets.append(pos)
+            case_offsets.append(case_pos)
+            pos += len(string) + 1
+            case_pos += len(items[idx]) + 1
+            name = self.name(string)
+            try:
+                names[name].append(idx)
+            except KeyError:
+                names[name] = array(str('i'), [idx])
+                for trigram in trigrams(name):
+                    try:
+                        index[trigram].append(name)
+                    except KeyError:
+                        index[trigram] = [name]
+        offsets.append(pos)
+        case_offsets.append(case_pos)
+        self.sorted_names = sorted(names)
+
+        self.added = []
+        """Items added since the index was built"""
+        self.removed = set()
+        """Ids of the items removed since the index was built"""
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, item):
+        return item in self.members
+
+    def update(self, items):
+        """Make the index hold exactly `items`
+
+        Returns True when the items changed.
+
+        """
+        items = set(items)
+        with self._lock:
+            removed = self.members.difference(items)
+            added = items.difference(self.members)
+            if not removed and not added:
+                return False
+            pending = (len(self.added) + len(self.removed) +
+                       len(added) + len(removed))
+            if pending > self.max_pending or not self.items:
+                self._build(items)
+                return True
+            for item in removed:
+                idx = self.ids.get(item)
+                if idx is None:
+                    self.added.remove(item)
+                else:
+                    self.removed.add(idx)
+            self.added.extend(sorted(added))
+            self.members = items
+            return True
+
+    def query(self, text, case_sensitive=False, limit=None, cancel=None):
+        """Return up to `limit` items matching text, best matches first
+
+        `cancel` is polled while searching; when it returns True the
+        search is abandoned and nothing is returned.
+
+        """
+        if limit is None:
+            limit = self.limit
+        if cancel is None:
+            cancel = _never
+        lower_text = text.lower()
+        if not case_sensitive:
+            text = lower_text
+        name = self.name
+        tail = name(text)
+        nested = tail != text
+        # How far into the name a match has to reach
+        reach = int(bool(tail) or not nested)
+
+        def matches(string):
+            start = len(string) - len(name(string)) + reach - len(text)
+            return string.find(text, max(0, start)) >= 0
+
+        def rank(string):
+            return (not name(string).startswith(tail), len(string), string)
+
+        with self._lock:
+            if case_sensitive:
+                strings = self.items
+            else:
+                strings = self.lower
+            found = self._candidates(name(lower_text), strings, matches,
+                                     cancel)
+            if found is None:
+                if nested:
+                    # Every match has a name starting with the tail
+                    found = set()
+                else:
+                    found = self._prefix_matches(text, strings, matches,
+                                                 limit, cancel)
+                found.update(self._scan(text, case_sensitive, strings,
+                                        matches, limit * 2, cancel))
+            if cancel():
+                return []
+            results = [(strings[idx], self.items[idx]) for idx in found]
+            for item in self.added:
+                string = case_sensitive and item or item.lower()
+                if matches(string):
+                    results.append((string, item))
+
+        ranked = heapq.nsmallest(limit, results,
+                                 key=lambda result: rank(result[0]))
+        return [item for string, item in ranked]
+
+    def _candidates(self, name_text, strings, matches, cancel=_never):
+        """Return the matching ids when the text is selective enough
+
+        Returns None when the text is too short to use the index or
+        when too many items have to be checked.
+
+        """
+        if len(name_text) < 3:
+            return None
+        postings = []
+        for trigram in trigrams(name_text):
+            names = self.index.get(trigram)
+            if names is None:
+                return set()
+            postings.append(names)
+        names = min(postings, key=len)
+        candidates = []
+        for name in names:
+            if name_text in name:
+                candidates.extend(self.names[name])
+                if len(candidates) > self.max_ranked:
+                    return None
+                if cancel():
+                    return set()
+        removed = self.removed
+        return set([idx for idx in candidates
+                    if idx not in removed and matches(strings[idx])])
+
+    def _prefix_matches(self, prefix, strings, matches, limit,
+                        cancel=_never):
+        """Return the `limit` shortest ids whose name starts with prefix
+
+        The names are looked up in sorted order, and the lookup gives up
+        after max_ranked items so that a case-sensitive prefix that only
+        matches in lowercase cannot visit every item.
+
+        """
+        found = []
+        if not prefix:
+            return set()
+        removed = self.removed
+        names = self.sorted_names
+        key = prefix.lower()
+        budget = self.max_ranked
+        pos = bisect.bisect_left(names, key)
+        while pos < len(names) and names[pos].startswith(key) and budget > 0:
+            if cancel():
+                break
+            ids = self.names[names[pos]]
+            budget -= len(ids)
+            for idx in ids:
+                string = strings[idx]
+                if (idx not in removed and
+                        self.name(string).startswith(prefix) and
+                        matches(string)):
+                    found.append(idx)
+            pos += 1
+        # Names are visited alphabetically, so the shortest are kept here
+        return set(heapq.nsmallest(limit, found,
+                                   key=lambda idx: (len(strings[idx]),
+                                                    strings[idx])))
+
+    def _scan(self, text, case_sensitive, strings, matches, limit,
+              cancel=_never):
+        """Return up to `limit` of the shortest matching ids"""
+        found = set()
+        if case_sensitive:
+            haystack = self.text
+            offsets = self.case_offsets
+        else:
+            haystack = self.lower_text
+            offsets = self.offsets
+        removed = self.removed
+        pos = haystack.find(text)
+        while pos >= 0 and not cancel():
+            idx = bisect.bisect_right(offsets, pos) - 1
+            if idx not in removed and matches(strings[idx]):
+                found.add(idx)
+                if len(found) >= limit:
+                    break
+            pos = haystack.find(text, offsets[idx+1])
+        return found
+
+
+class PathIndex(CompletionIndex):
+    """A CompletionIndex over the files in the worktree
+
+    The directories holding the files are indexed along with them.
+
+    """
+
+    def __init__(self, paths=()):
+        self._stamp = None
+        self._tracked = []
+        self._untracked = []
+        self.dirs = frozenset()
+        CompletionIndex.__init__(self)
+        self.update_files(paths)
+
+    def update_files(self, paths):
+        """Make the index hold exactly `paths` and their parents"""
+        files = set(paths)
+        items = utils.add_parents(set(files))
+        with self._lock:
+            self.dirs = frozenset(items.difference(files))
+            return self.update(items)
+
+    def refresh(self, untracked, git=git):
+        """Bring the index up to date with the worktree
+
+        Tracked files are read again only when .git/index changes;
+        `untracked` comes from the main model's status.
+
+        """
+        try:
+            st = core.stat(git.git_path('index'))
+            stamp = (git.worktree(), st.st_mtime, st.st_size)
+        except OSError:
+            stamp = (git.worktree(), None, None)
+        untracked = list(untracked)
+        with self._lock:
+            if stamp == self._stamp and untracked == self._untracked:
+                return False
+            if stamp != self._stamp:
+                self._tracked = gitcmds.all_files()
+                self._stamp = stamp
+            self._untracked = untracked
+            return self.update_files(self._tracked + untracked)
+
+
+@memoize
+def path_index():
+    """Return the PathIndex shared by the completion models"""
+    return PathIndex()
@@ -1,10 +1,15 @@
 from __future__ import division, absolute_import, unicode_literals
 
+import bisect
 import subprocess
+import zlib
+from array import array
 
 from cola import core
 from cola import utils
 from cola.git import git
+from cola.git import STDOUT
+from cola.models import storage
 from cola.observable import Observable
 
 # put summary at the end b/c it can contain
@@ -13,36 +18,6 @@ logfmt = 'format:%H%x01%P%x01%d%x01%an%x01%ad%x01%ae%x01%s'
 logsep = chr(0x01)
 
 
-class CommitFactory(object):
-    root_generation = 0
-    commits = {}
-
-    @classmethod
-    def reset(cls):
-        cls.commits.clear()
-        cls.root_generation = 0
-
-    @classmethod
-    def new(cls, sha1=None, log_entry=None):
-        if not sha1 and log_entry:
-            sha1 = log_entry[:40]
-        try:
-            commit = cls.commits[sha1]
-            if log_entry and not commit.parsed:
-                commit.parse(log_entry)
-            cls.root_generation = max(commit.generation,
-                                      cls.root_generation)
-        except KeyError:
-            commit = Commit(sha1=sha1,
-                            log_entry=log_entry)
-            if not log_entry:
-                cls.root_generation += 1
-                commit.generation = max(commit.generation,
-                                        cls.root_generation)
-            cls.commits[sha1] = commit
-        return commit
-
-
 class DAG(Observable):
     ref_updated = 'ref_updated'
     count_updated = 'count_updated'
@@ -89,68 +64,231 @@ class DAG(Observable):
         return [p for p in all_refs if p and core.exists(p)]
 
 
-class Commit(object):
-    root_generation = 0
-
-    __slots__ = ('sha1',
-                 'summary',
-                 'parents',
-                 'children',
-                 'tags',
-                 'author',
-                 'authdate',
-                 'email',
-                 'generation',
-                 'parsed')
-    def __init__(self, sha1=None, log_entry=None):
-        self.sha1 = sha1
-        self.summary = None
-        self.parents = []
-        self.children = []
-        self.tags = set()
-        self.email = None
-        self.author = None
-        self.authdate = None
-        self.parsed = False
-        self.generation = CommitFactory.root_generation
-        if log_entry:
-            self.parse(log_entry)
-
-    def parse(self, log_entry, sep=logsep):
-        self.sha1 = log_entry[:40]
+class CommitGraph(object):
+    """Stores commits column-wise in arrays instead of one object each
+
+    Commits are identified by integer ids.  Each commit's parents are a
+    contiguous run of the edge arrays (parent_start/parent_count), and
+    the children of a commit are threaded through the same edges via
+    first_child/next_child so that the graph can grow as commits are
+    read.  Authors and emails are interned.  Use commit() to get a
+    lightweight Commit view for an id.
+
+    """
+
+    def __init__(self):
+        self.root_generation = 0
+        self.ids = {}
+        self.sha1s = []
+        self.summaries = []
+        self.authdates = []
+        self.authors = array(str('i'))
+        self.emails = array(str('i'))
+        self.generations = array(str('i'))
+        self.parsed = bytearray()
+        self.parent_start = array(str('i'))
+        self.parent_count = array(str('i'))
+        self.child_count = array(str('i'))
+        self.first_child = array(str('i'))
+        self.last_child = array(str('i'))
+        self.edge_parent = array(str('i'))
+        self.edge_child = array(str('i'))
+        self.next_child = array(str('i'))
+        self.tags = {}
+        self.strings = ['']
+        self._string_ids = {'': 0}
+
+    def __len__(self):
+        return len(self.sha1s)
+
+    def commit(self, idx):
+        return Commit(self, idx)
+
+    def intern(self, string):
+        """Return the id of a shared string"""
+        try:
+            return self._string_ids[string]
+        except KeyError:
+            idx = self._string_ids[string] = len(self.strings)
+            self.strings.append(string)
+            return idx
+
+    def _new(self, sha1, generation):
+        idx = len(self.sha1s)
+        self.ids[sha1] = idx
+        self.sha1s.append(sha1)
+        self.summaries.append(None)
+        self.authdates.append(None)
+        self.authors.append(0)
+        self.emails.append(0)
+        self.generations.append(generation)
+        self.parsed.append(0)
+        self.parent_start.append(0)
+        self.parent_count.append(0)
+        self.child_count.append(0)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        return idx
+
+    def stub(self, sha1):
+        """Return the id for a commit that may not have been read yet"""
+        try:
+            idx = self.ids[sha1]
+        except KeyError:
+            self.root_generation += 1
+            return self._new(sha1, self.root_generation)
+        self.root_generation = max(self.generations[idx],
+                                   self.root_generation)
+        return idx
+
+    def add(self, log_entry, sep=logsep):
+        """Parse a "git log" entry and return the commit's id"""
+        sha1 = log_entry[:40]
+        try:
+            idx = self.ids[sha1]
+        except KeyError:
+            idx = self._new(sha1, self.root_generation)
+        else:
+            if not self.parsed[idx]:
+                self._parse(idx, log_entry, sep)
+            self.root_generation = max(self.generations[idx],
+                                       self.root_generation)
+            return idx
+        self._parse(idx, log_entry, sep)
+        return idx
+
+    def _parse(self, idx, log_entry, sep):
         (parents, tags, author, authdate, email, summary) = \
                 log_entry[41:].split(sep, 6)
-
-        self.summary = summary and summary or ''
-        self.author = author and author or ''
-        self.authdate = authdate or ''
-        self.email = email and email or ''
+        self.summaries[idx] = summary or ''
+        self.authdates[idx] = authdate or ''
+        self.authors[idx] = self.intern(author or '')
+        self.emails[idx] = self.intern(email or '')
 
         if parents:
-            generation = None
-            for parent_sha1 in parents.split(' '):
-                parent = CommitFactory.new(sha1=parent_sha1)
-                parent.children.append(self)
-                if generation is None:
-                    generation = parent.generation+1
-                self.parents.append(parent)
-                generation = max(parent.generation+1, generation)
-            self.generation = generation
-
+            self._link(idx, parents.split(' '))
+            generations = self.generations
+            self.generations[idx] = max([generations[p] + 1 for p in
+                                         self.parent_ids(idx)])
         if tags:
             for tag in tags[2:-1].split(', '):
-                if tag.startswith('tag: '):
-                    tag = tag[5:] # tag: refs/
-                elif tag.startswith('refs/remotes/'):
-                    tag = tag[13:] # refs/remotes/
-                elif tag.startswith('refs/heads/'):
-                    tag = tag[11:] # refs/heads/
-                if tag.endswith('/HEAD'):
-                    continue
-                self.tags.add(tag)
+                tag = ref_label(tag)
+                if tag is not None:
+                    self.tags.setdefault(idx, set()).add(tag)
+        self.parsed[idx] = 1
+
+    def load(self, sha1, parents, generation, author, authdate, email,
+             summary, tags=()):
+        """Add a commit from fields that were parsed earlier"""
+        idx = self.ids.get(sha1)
+        if idx is None:
+            idx = self._new(sha1, generation)
+        self.summaries[idx] = summary
+        self.authdates[idx] = authdate
+        self.authors[idx] = self.intern(author)
+        self.emails[idx] = self.intern(email)
+        if parents:
+            self._link(idx, parents)
+        self.generations[idx] = generation
+        if tags:
+            self.tags.setdefault(idx, set()).update(tags)
+        self.parsed[idx] = 1
+        self.root_generation = max(generation, self.root_generation)
+        return idx
+
+    def _link(self, idx, parent_sha1s):
+        edge = len(self.edge_parent)
+        self.parent_start[idx] = edge
+        self.parent_count[idx] = len(parent_sha1s)
+        for parent_sha1 in parent_sha1s:
+            parent = self.stub(parent_sha1)
+            self.edge_parent.append(parent)
+            self.edge_child.append(idx)
+            self.next_child.append(-1)
+            if self.first_child[parent] < 0:
+                self.first_child[parent] = edge
+            else:
+                self.next_child[self.last_child[parent]] = edge
+            self.last_child[parent] = edge
+            self.child_count[parent] += 1
+            edge += 1
+
+    def parent_ids(self, idx):
+        start = self.parent_start[idx]
+        return self.edge_parent[start:start + self.parent_count[idx]]
+
+    def child_ids(self, idx):
+        children = []
+        edge = self.first_child[idx]
+        while edge >= 0:
+            children.append(self.edge_child[edge])
+            edge = self.next_child[edge]
+        return children
+
+    def row(self, idx):
+        """Return the fields stored by CommitCache for a commit"""
+        sha1s = self.sha1s
+        return (sha1s[idx],
+                [sha1s[p] for p in self.parent_ids(idx)],
+                self.generations[idx],
+                self.strings[self.authors[idx]],
+                self.authdates[idx] or '',
+                self.strings[self.emails[idx]],
+                self.summaries[idx] or '')
 
-        self.parsed = True
-        return self
+
+class Commit(object):
+    """A lightweight view of a commit stored in a CommitGraph"""
+
+    __slots__ = ('graph', 'idx')
+
+    def __init__(self, graph, idx):
+        self.graph = graph
+        self.idx = idx
+
+    sha1 = property(lambda self: self.graph.sha1s[self.idx])
+    summary = property(lambda self: self.graph.summaries[self.idx])
+    authdate = property(lambda self: self.graph.authdates[self.idx])
+    generation = property(lambda self: self.graph.generations[self.idx])
+    parsed = property(lambda self: bool(self.graph.parsed[self.idx]))
+
+    @property
+    def author(self):
+        graph = self.graph
+        if not graph.parsed[self.idx]:
+            return None
+        return graph.strings[graph.authors[self.idx]]
+
+    @property
+    def email(self):
+        graph = self.graph
+        if not graph.parsed[self.idx]:
+            return None
+        return graph.strings[graph.emails[self.idx]]
+
+    @property
+    def tags(self):
+        return self.graph.tags.get(self.idx, _no_tags)
+
+    @property
+    def parents(self):
+        graph = self.graph
+        return [Commit(graph, idx) for idx in graph.parent_ids(self.idx)]
+
+    @property
+    def children(self):
+        graph = self.graph
+        return [Commit(graph, idx) for idx in graph.child_ids(self.idx)]
+
+    def __eq__(self, other):
+        return (isinstance(other, Commit) and
+                self.graph is other.graph and self.idx == other.idx)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.idx)
 
     def __str__(self):
         return self.sha1
@@ -158,30 +296,214 @@ class Commit(object):
     def __repr__(self):
         return ("{\n"
                 "  sha1: " + self.sha1 + "\n"
-                "  summary: " + self.summary + "\n"
-                "  author: " + self.author + "\n"
-                "  authdate: " + self.authdate + "\n"
+                "  summary: " + (self.summary or '') + "\n"
+                "  author: " + (self.author or '') + "\n"
+                "  authdate: " + (self.authdate or '') + "\n"
                 "  parents: [" + ', '.join([p.sha1 for p in self.parents]) + "]\n"
                 "  tags: [" + ', '.join(self.tags) + "]\n"
                 "}")
 
     def is_fork(self):
         ''' Returns True if the node is a fork'''
-        return len(self.children) > 1
+        return self.graph.child_count[self.idx] > 1
 
     def is_merge(self):
         ''' Returns True if the node is a fork'''
-        return len(self.parents) > 1
+        return self.graph.parent_count[self.idx] > 1
+
+
+_no_tags = frozenset()
+
+
+class SpatialIndex(object):
+    """Finds the laid-out commits and edges within a vertical range
+
+    The DAG layout gives every commit its own row, with each row above
+    the previous one, so rows are found by bisecting on y.  Edges are
+    stored in CSR form by their child row.  Edges that span more than
+    `max_span` rows are kept in a separate list and scanned linearly.
+
+    """
+
+    def __init__(self, max_span=64):
+        self.max_span = max_span
+        self.commits = []
+        self.rows = {}
+        self.keys = array(str('d'))
+        self.xs = array(str('d'))
+        self.ys = array(str('d'))
+        self.edge_start = array(str('i'), [0])
+        self.edge_parent = array(str('i'))
+        self.long_edges = []
+
+    def __len__(self):
+        return len(self.commits)
+
+    def add(self, commit, x, y):
+        """Add a commit below every commit that was added before it"""
+        row = len(self.commits)
+        self.commits.append(commit)
+        self.rows[commit.sha1] = row
+        for ref in commit.tags:
+            self.rows[ref] = row
+        self.keys.append(-y)
+        self.xs.append(x)
+        self.ys.append(y)
+        for parent in commit.parents:
+            parent_row = self.rows.get(parent.sha1)
+            if parent_row is None:
+                continue
+            if row - parent_row > self.max_span:
+                self.long_edges.append((parent_row, row))
+            else:
+                self.edge_parent.append(parent_row)
+        self.edge_start.append(len(self.edge_parent))
+        return row
+
+    def row_range(self, top, bottom):
+        """Return the [start, end) rows with top <= y <= bottom"""
+        keys = self.keys
+        return (bisect.bisect_left(keys, -bottom),
+                bisect.bisect_right(keys, -top))
+
+    def edges(self, start, end):
+        """Return the (parent_row, child_row) edges crossing [start, end)"""
+        edges = []
+        edge_start = self.edge_start
+        edge_parent = self.edge_parent
+        last = min(len(self.commits), end + self.max_span)
+        for row in range(start, last):
+            for idx in range(edge_start[row], edge_start[row+1]):
+                parent_row = edge_parent[idx]
+                if parent_row < end:
+                    edges.append((parent_row, row))
+        for parent_row, row in self.long_edges:
+            if parent_row < end and row >= start:
+                edges.append((parent_row, row))
+        return edges
+
+    def position(self, row):
+        return self.xs[row], self.ys[row]
+
+
+def ref_label(tag):
+    """Return the label shown for a decoration, or None to hide it"""
+    if tag.startswith('tag: '):
+        tag = tag[5:] # tag: refs/
+    elif tag.startswith('refs/tags/'):
+        tag = tag[10:] # refs/tags/
+    elif tag.startswith('refs/remotes/'):
+        tag = tag[13:] # refs/remotes/
+    elif tag.startswith('refs/heads/'):
+        tag = tag[11:] # refs/heads/
+    if tag.endswith('/HEAD'):
+        return None
+    return tag
+
+
+class CommitCache(object):
+    """Stores the commits read by RepoReader in a compact binary file
+
+    The file holds a single entry for the most recently read history.
+    Commits are stored column-wise: binary sha1s, generations and
+    parent offsets as integer arrays, and the author, date, email and
+    summary fields as one NUL-separated string.  Decorations are not
+    stored because refs move independently of commits.
+
+    """
+    magic = b'COLADAG1'
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, key):
+        """Return (tips, rows) for `key`, or None when nothing is cached
+
+        Each row is a tuple of (sha1, parents, generation, author,
+        authdate, email, summary).
+
+        """
+        try:
+            with open(core.mkpath(self.path), 'rb') as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return None
+        if not data.startswith(self.magic):
+            return None
+        try:
+            parts = storage.unpack(zlib.decompress(data[len(self.magic):]))
+            (cached_key, tips, sha1s, generations,
+             offsets, parents, fields) = parts
+        except (ValueError, zlib.error):
+            return None
+        if cached_key.decode('utf-8') != key:
+            return None
+
+        sha1s = storage.sha1s_from_bytes(sha1s)
+        generations = storage.array_from_bytes(generations)
+        offsets = storage.array_from_bytes(offsets)
+        parents = storage.sha1s_from_bytes(parents)
+        fields = storage.strings_from_bytes(fields)
+        if (len(generations) != len(sha1s) or
+                len(offsets) != len(sha1s) + 1 or
+                len(fields) != len(sha1s) * 4):
+            return None
+
+        rows = []
+        for idx, sha1 in enumerate(sha1s):
+            field_idx = idx * 4
+            rows.append((sha1,
+                         parents[offsets[idx]:offsets[idx+1]],
+                         generations[idx],
+                         fields[field_idx],
+                         fields[field_idx+1],
+                         fields[field_idx+2],
+                         fields[field_idx+3]))
+        return storage.sha1s_from_bytes(tips), rows
+
+    def save(self, key, tips, rows):
+        """Store rows as returned by load() and the tips they were read from"""
+        sha1s = []
+        generations = []
+        offsets = [0]
+        parents = []
+        fields = []
+        for (sha1, parent_sha1s, generation,
+             author, authdate, email, summary) in rows:
+            sha1s.append(sha1)
+            generations.append(generation)
+            parents.extend(parent_sha1s)
+            offsets.append(len(parents))
+            fields.extend((author, authdate, email, summary))
+        payload = storage.pack((key.encode('utf-8'),
+                                storage.sha1s_to_bytes(tips),
+                                storage.sha1s_to_bytes(sha1s),
+                                storage.array_to_bytes(generations),
+                                storage.array_to_bytes(offsets),
+                                storage.sha1s_to_bytes(parents),
+                                storage.strings_to_bytes(fields)))
+        storage.write(self.path, self.magic + zlib.compress(payload, 1))
 
 
 class RepoReader(object):
 
-    def __init__(self, dag, git=git):
+    # Arguments that can be combined with "--not <tips>" so that the
+    # commit cache can be extended incrementally
+    cacheable_args = set(('--all', '--branches', '--tags', '--remotes'))
+
+    # Beyond this many tips the cache is not used
+    max_cached_tips = 256
+
+    def __init__(self, dag, git=git, cache=None):
         self.dag = dag
         self.git = git
+        self.cache = cache
+        """A CommitCache, True for the repository's cache, or None"""
+        self.graph = CommitGraph()
         self._proc = None
-        self._objects = {}
+        self._reader = None
         self._cmd = ['git', 'log',
+                     '-z',
                      '--topo-order',
                      '--reverse',
                      '--pretty='+logfmt]
@@ -189,8 +511,8 @@ class RepoReader(object):
         """Indicates that all data has been read"""
         self._idx = -1
         """Index into the cached commits"""
-        self._topo_list = []
-        """List of commits objects in topological order"""
+        self._topo_list = array(str('i'))
+        """Ids of the commits in topological order"""
 
     cached = property(lambda self: self._cached)
     """Return True when no commits remain to be read"""
@@ -200,11 +522,13 @@ class RepoReader(object):
         return len(self._topo_list)
 
     def reset(self):
-        CommitFactory.reset()
-        if self._proc:
-            self._topo_list = []
-            self._proc.kill()
+        self.graph = CommitGraph()
+        if self._reader is not None:
+            self._topo_list = array(str('i'))
+            if self._proc:
+                self._proc.kill()
         self._proc = None
+        self._reader = None
         self._cached = False
 
     def __iter__(self):
@@ -217,37 +541,142 @@ class RepoReader(object):
         if self._cached:
             try:
                 self._idx += 1
-                return self._topo_list[self._idx]
+                return self.graph.commit(self._topo_list[self._idx])
             except IndexError:
                 self._idx = -1
                 raise StopIteration
 
-        if self._proc is None:
-            ref_args = utils.shell_split(self.dag.ref)
-            cmd = self._cmd + ['-%d' % self.dag.count] + ref_args
-            self._proc = core.start_command(cmd)
-            self._topo_list = []
+        if self._reader is None:
+            self._topo_list = array(str('i'))
+            self._reader = self._read()
 
-        log_entry = core.readline(self._proc.stdout).rstrip()
-        if not log_entry:
+        try:
+            idx, is_new = next(self._reader)
+        except StopIteration:
             self._cached = True
-            self._proc.wait()
-            self._proc = None
-            raise StopIteration
+            self._reader = None
+            raise
 
-        sha1 = log_entry[:40]
-        try:
-            return self._objects[sha1]
-        except KeyError:
-            c = CommitFactory.new(log_entry=log_entry)
-            self._objects[c.sha1] = c
-            self._topo_list.append(c)
-            return c
+        if is_new:
+            self._topo_list.append(idx)
+        return self.graph.commit(idx)
 
     __next__ = next # for Python 3
 
+    def _read(self):
+        """Generate (id, is_new) pairs from the commit cache and "git log"
+
+        When the cache is usable only the commits that are new since the
+        cached tips are read from "git log".  is_new is False for
+        commits that were already generated.
+
+        """
+        graph = self.graph
+        ref_args = utils.shell_split(self.dag.ref)
+        count = self.dag.count
+        cmd = self._cmd + ['-%d' % count] + ref_args
+
+        cache = self._cache()
+        cached = cache and self._load_cache(cache, ref_args or ['HEAD'])
+        changed = True
+        if cached:
+            # Read only the commits that are new since the cached tips
+            tips, rows = cached
+            new_entries = list(self._log(cmd + (ref_args and [] or ['HEAD'])
+                                         + ['--not'] + tips))
+            changed = bool(new_entries)
+            rows = rows[max(0, len(rows) + len(new_entries) - count):]
+            decorations = self._decorations()
+            for row in rows:
+                yield graph.load(tags=decorations.get(row[0], ()), *row), True
+            entries = new_entries
+        else:
+            entries = self._log(cmd)
+
+        ids = graph.ids
+        parsed = graph.parsed
+        for log_entry in entries:
+            idx = ids.get(log_entry[:40])
+            is_new = idx is None or not parsed[idx]
+            yield graph.add(log_entry), is_new
+
+        if cache is not None and changed:
+            topo_list = self._topo_list
+            tips = [graph.sha1s[idx] for idx in topo_list
+                    if not graph.child_count[idx]]
+            cache.save(self._cache_key(), tips,
+                       [graph.row(idx) for idx in topo_list])
+
+    def _log(self, cmd):
+        """Generate log entries by reading "git log -z" in large chunks"""
+        self._proc = core.start_command(cmd)
+        for log_entry in core.read_nul_tokens(self._proc.stdout):
+            if log_entry:
+                yield log_entry
+        core.wait(self._proc)
+        self._proc = None
+
+    def _cache_key(self):
+        return '%d %s' % (self.dag.count, self.dag.ref)
+
+    def _cache(self):
+        """Return the commit cache, or None when the arguments are unsuitable"""
+        for arg in utils.shell_split(self.dag.ref):
+            if arg.startswith('-'):
+                if arg not in self.cacheable_args:
+                    return None
+            elif '..' in arg or arg.startswith('^'):
+                return None
+        if not self.cache:
+            return None
+        if self.cache is True:
+            self.cache = CommitCache(self.git.git_path('cola-dag.cache'))
+        return self.cache
+
+    def _load_cache(self, cache, ref_args):
+        """Return the cached (tips, rows), or None when they are stale"""
+        cached = cache.load(self._cache_key())
+        if not cached:
+            return None
+        tips, rows = cached
+        if not tips or len(tips) > self.max_cached_tips:
+            return None
+        # Every cached tip must still be reachable from the refs,
+        # otherwise history was rewritten and the cache is stale.
+        status, out, err = self.git.rev_list('-1', *(tips + ['--not'] +
+                                                      ref_args))
+        if status != 0 or out:
+            return None
+        return cached
+
+    def _decorations(self):
+        """Return a dict mapping sha1s to the labels shown for their refs"""
+        decorations = {}
+        status, out, err = self.git.show_ref(head=True, d=True)
+        head_ref = self.git.symbolic_ref('HEAD', q=True)[STDOUT].strip()
+        for line in out.splitlines():
+            try:
+                sha1, ref = line.split(' ', 1)
+            except ValueError:
+                continue
+            if ref.endswith('^{}'):
+                ref = ref[:-3] # peeled annotated tag
+            if ref == 'HEAD':
+                if head_ref:
+                    continue
+                label = 'HEAD'
+            elif ref == head_ref:
+                label = 'HEAD -> ' + ref_label(ref)
+            else:
+                label = ref_label(ref)
+            if label is not None:
+                decorations.setdefault(sha1, set()).add(label)
+        return decorations
+
     def __getitem__(self, sha1):
-        return self._objects[sha1]
+        return self.graph.commit(self.graph.ids[sha1])
 
     def items(self):
-        return self._objects.items()
+        graph = self.graph
+        return [(graph.sha1s[idx], graph.commit(idx))
+                for idx in self._topo_list]
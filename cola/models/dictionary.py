@@ -0,0 +1,321 @@
+"""A compiled spelling dictionary
+
+Reading /usr/share/dict/words into a dict took long enough to stall the
+first keystroke in the commit message editor, and suggestions were found
+by generating every string within two edits of a word.
+
+The words are compiled once into a file under the cache directory and
+mapped into memory when they are needed.  The file holds the sorted
+words along with a symmetric-delete index: the strings left after
+deleting up to two characters from the start of each word point back to
+the word.  Deleting characters from a misspelled word the same way
+finds the candidates within two edits of it with a few lookups, and only
+the candidates have their distance computed.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import mmap
+import struct
+import sys
+import threading
+import zlib
+from array import array
+
+from cola import core
+from cola import resources
+from cola.decorators import memoize
+from cola.models import storage
+
+
+DICTIONARIES = (
+    # (path, add title-case words)
+    ('/usr/share/dict/words', True),
+    ('/usr/share/dict/propernames', False),
+)
+
+
+def read_words(dictionaries=DICTIONARIES):
+    """Yield the words of the system dictionaries"""
+    for (path, title) in dictionaries:
+        try:
+            with open(core.mkpath(path), 'rb') as f:
+                for line in f:
+                    word = core.decode(line).rstrip()
+                    if not word:
+                        continue
+                    yield word
+                    if title:
+                        yield word.title()
+        except (IOError, OSError):
+            pass
+
+
+def deletes(word, max_distance):
+    """Return the strings left after deleting up to max_distance chars"""
+    result = set([word])
+    edge = [word]
+    for distance in range(max_distance):
+        found = []
+        for string in edge:
+            for idx in range(len(string)):
+                deleted = string[:idx] + string[idx+1:]
+                if deleted not in result:
+                    result.add(deleted)
+                    found.append(deleted)
+        edge = found
+    return result
+
+
+def distance(a, b, limit):
+    """Return the edit distance between two strings, counting transposes
+
+    Returns limit + 1 as soon as the distance is known to exceed limit.
+
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        best = i
+        for j in range(1, len(b) + 1):
+            value = min(previous[j] + 1, current[j-1] + 1,
+                        previous[j-1] + (a[i-1] != b[j-1]))
+            if (i > 1 and j > 1 and a[i-1] == b[j-2] and
+                    a[i-2] == b[j-1]):
+                value = min(value, before[j-2] + 1)
+            current[j] = value
+            best = min(best, value)
+        if best > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+def _hash(string):
+    return zlib.crc32(core.encode(string)) & 0xffffffff
+
+
+def _uint32s(values):
+    result = array(str('I'), values)
+    if sys.byteorder == 'big':
+        result.byteswap()
+    try:
+        return result.tobytes()
+    except AttributeError:
+        return result.tostring()
+
+
+class _UInt32s(object):
+    """A read-only view of little-endian integers within a buffer"""
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return struct.unpack_from(str('<I'), self.buf, self.offset + idx * 4)[0]
+
+
+class Dictionary(object):
+    """Sorted words and their symmetric-delete index in a single buffer
+
+    The buffer is usually a memory-mapped file, so only the pages that
+    lookups touch are read.
+
+    """
+    magic = b'COLADIC1'
+    header = str('<IIIII')
+    """Key, word, index and words-text sizes, and the max distance"""
+
+    prefix_length = 7
+    """Only the start of each word is indexed, which keeps the index small"""
+
+    max_distance = 2
+
+    def __init__(self, buf):
+        if not buf[:len(self.magic)] == self.magic:
+            raise ValueError('not a compiled dictionary')
+        offset = len(self.magic)
+        (key_size, word_count, index_count, text_size,
+         self.max_distance) = struct.unpack_from(self.header, buf, offset)
+        offset += struct.calcsize(self.header)
+        self.key = core.decode(buf[offset:offset+key_size])
+        offset += key_size
+        self.offsets = _UInt32s(buf, offset, word_count + 1)
+        offset += (word_count + 1) * 4
+        self.text_offset = offset
+        offset += text_size
+        self.hashes = _UInt32s(buf, offset, index_count)
+        offset += index_count * 4
+        self.ids = _UInt32s(buf, offset, index_count)
+        offset += index_count * 4
+        if offset > len(buf):
+            raise ValueError('truncated dictionary')
+        self.buf = buf
+        self.word_count = word_count
+
+    @classmethod
+    def compile(cls, words, key='', max_distance=2):
+        """Return the compiled form of a sequence of words"""
+        encoded = sorted(set([core.encode(word) for word in words]))
+        offsets = [0]
+        for word in encoded:
+            offsets.append(offsets[-1] + len(word) + 1)
+        text = b''.join([word + b'\n' for word in encoded])
+
+        prefix_length = cls.prefix_length
+        entries = []
+        prefixes = {}
+        for idx, word in enumerate(encoded):
+            prefix = core.decode(word)[:prefix_length]
+            try:
+                hashes = prefixes[prefix]
+            except KeyError:
+                hashes = prefixes[prefix] = sorted(set(
+                    [_hash(deleted)
+                     for deleted in deletes(prefix, max_distance)]))
+            entries.extend([(value << 32) | idx for value in hashes])
+        entries.sort()
+        mask = 0xffffffff
+
+        key = core.encode(key)
+        return b''.join([
+            cls.magic,
+            struct.pack(cls.header, len(key), len(encoded), len(entries),
+                        len(text), max_distance),
+            key,
+            _uint32s(offsets),
+            text,
+            _uint32s([entry >> 32 for entry in entries]),
+            _uint32s([entry & mask for entry in entries]),
+        ])
+
+    def __len__(self):
+        return self.word_count
+
+    def word(self, idx):
+        """Return the word with the given id"""
+        start = self.text_offset + self.offsets[idx]
+        end = self.text_offset + self.offsets[idx+1] - 1
+        return self.buf[start:end]
+
+    def __contains__(self, word):
+        word = core.encode(word)
+        low = 0
+        high = self.word_count
+        while low < high:
+            mid = (low + high) // 2
+            if self.word(mid) < word:
+                low = mid + 1
+            else:
+                high = mid
+        return low < self.word_count and self.word(low) == word
+
+    def _lookup(self, value):
+        hashes = self.hashes
+        low = 0
+        high = len(hashes)
+        while low < high:
+            mid = (low + high) // 2
+            if hashes[mid] < value:
+                low = mid + 1
+            else:
+                high = mid
+        while low < len(hashes) and hashes[low] == value:
+            yield self.ids[low]
+            low += 1
+
+    def suggest(self, word, max_distance=None):
+        """Return the words closest to word, as (distance, word) pairs"""
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        prefix = word[:self.prefix_length]
+        seen = set()
+        best = max_distance
+        result = []
+        for deleted in deletes(prefix, max_distance):
+            for idx in self._lookup(_hash(deleted)):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                candidate = core.decode(self.word(idx))
+                value = distance(word, candidate, best)
+                if value > best:
+                    continue
+                if value < best:
+                    best = value
+                    result = [pair for pair in result if pair[0] <= best]
+                result.append((value, candidate))
+        result.sort()
+        return result
+
+
+def source_key(dictionaries=DICTIONARIES):
+    """Return a key that changes when the system dictionaries change"""
+    parts = []
+    for (path, title) in dictionaries:
+        try:
+            st = core.stat(path)
+            parts.append('%s:%d:%d' % (path, int(st.st_mtime), st.st_size))
+        except OSError:
+            parts.append('%s:-' % path)
+    return '\n'.join(parts)
+
+
+def load(path, key):
+    """Return the Dictionary compiled at path for key, or None"""
+    try:
+        with open(core.mkpath(path), 'rb') as fh:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        dictionary = Dictionary(buf)
+    except (ValueError, struct.error):
+        return None
+    if dictionary.key != key:
+        return None
+    return dictionary
+
+
+def save(path, data):
+    """Write a compiled dictionary, replacing the file atomically"""
+    return storage.write(path, data)
+
+
+_lock = threading.Lock()
+
+
+def load_or_compile(path=None, dictionaries=DICTIONARIES):
+    """Return the compiled system dictionary, compiling it when needed
+
+    When the compiled file cannot be written the dictionary is used
+    from memory.
+
+    """
+    if path is None:
+        path = resources.cache_home('dictionary')
+    key = source_key(dictionaries)
+    with _lock:
+        dictionary = load(path, key)
+        if dictionary is not None:
+            return dictionary
+        data = Dictionary.compile(read_words(dictionaries), key=key)
+        if save(path, data):
+            dictionary = load(path, key)
+        if dictionary is None:
+            dictionary = Dictionary(data)
+        return dictionary
+
+
+@memoize
+def instance():
+    """Return the system dictionary shared by the spell checkers"""
+    return load_or_compile()
@@ -0,0 +1,109 @@
+"""A cache of the diffs shown when browsing commits
+
+Selecting a commit in the DAG runs "git diff sha1^!", even when the same
+commit was shown moments earlier.  DiffCache keeps the most recently
+used diffs up to a total size in bytes.  Entries are keyed by the diff
+options as well as the commit, so changing eg. the context lines does not
+show stale text.  It does not depend on Qt so that it can be filled from
+the diff threads.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import collections
+import sys
+import threading
+
+from cola import gitcmds
+from cola.decorators import memoize
+from cola.git import git
+
+
+class DiffCache(object):
+    """A byte-bounded LRU cache of commit diffs"""
+
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        """The total size of the cached diffs"""
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        """Maps keys being computed to an event set once they are done"""
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def key(self, sha1, filename=None, git=git):
+        """Return the key for the diff of a commit"""
+        opts = tuple(sorted(gitcmds.common_diff_opts().items()))
+        return (git.git_dir(), sha1, filename, opts)
+
+    def get(self, key):
+        """Return a cached diff, or None"""
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        try:
+            text = self._entries.pop(key)
+        except KeyError:
+            return None
+        self._entries[key] = text
+        return text
+
+    def put(self, key, text):
+        """Add a diff, dropping the least recently used ones to make room"""
+        size = sys.getsizeof(text)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= sys.getsizeof(old)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = text
+            self.size += size
+            while self.size > self.max_bytes:
+                key, old = self._entries.popitem(last=False)
+                self.size -= sys.getsizeof(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def diff_info(self, sha1, filename=None, git=git):
+        """Return gitcmds.diff_info() for a commit, running git once
+
+        A caller asking for a diff that another thread is computing waits
+        for that result instead of running git again.
+
+        """
+        key = self.key(sha1, filename=filename, git=git)
+        while True:
+            with self._lock:
+                text = self._get(key)
+                if text is not None:
+                    return text
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            text = gitcmds.diff_info(sha1, git=git, filename=filename)
+            self.put(key, text)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+        return text
+
+
+@memoize
+def diff_cache():
+    """Return the DiffCache shared by the diff widgets"""
+    return DiffCache()
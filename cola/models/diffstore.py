@@ -0,0 +1,133 @@
+"""Chunked storage for very large diffs
+
+DiffStore keeps the text of a diff as a list of chunks along with the
+offset of every line and hunk, so that a window of lines can be taken
+out of it without joining or splitting the whole text.  It does not
+depend on Qt.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import bisect
+from array import array
+
+
+class DiffStore(object):
+    """Lines and hunks of a diff, stored in chunks"""
+
+    def __init__(self, text=''):
+        self.chunks = []
+        self.chunk_offsets = array(str('l'))
+        """The offset of each chunk"""
+        self.line_starts = array(str('l'), [0])
+        """The offset of each line"""
+        self.hunks = array(str('l'))
+        """The line numbers of the hunk headers"""
+        self.size = 0
+        self._tail = '\n'
+        if text:
+            self.append(text)
+
+    def __len__(self):
+        return self.size
+
+    def line_count(self):
+        return len(self.line_starts)
+
+    def append(self, text):
+        """Add text to the end of the diff"""
+        if not text:
+            return
+        offset = self.size
+        self.chunks.append(text)
+        self.chunk_offsets.append(offset)
+        self.size += len(text)
+
+        line_starts = self.line_starts
+        find = text.find
+        pos = find('\n')
+        while pos >= 0:
+            line_starts.append(offset + pos + 1)
+            pos = find('\n', pos + 1)
+
+        # Hunk headers can straddle chunks, so the end of the previous
+        # text is searched along with the new one
+        tail = self._tail
+        combined = tail + text
+        pos = combined.find('\n@@')
+        while pos >= 0:
+            start = offset - len(tail) + pos + 1
+            self.hunks.append(bisect.bisect_left(line_starts, start))
+            pos = combined.find('\n@@', pos + 1)
+        self._tail = combined[-2:]
+
+    def text(self, start=0, end=None):
+        """Return the text between two offsets"""
+        if end is None or end > self.size:
+            end = self.size
+        if start >= end:
+            return ''
+        chunk_offsets = self.chunk_offsets
+        idx = bisect.bisect_right(chunk_offsets, start) - 1
+        parts = []
+        while idx < len(self.chunks) and chunk_offsets[idx] < end:
+            base = chunk_offsets[idx]
+            parts.append(self.chunks[idx][max(0, start - base):end - base])
+            idx += 1
+        return ''.join(parts)
+
+    def offset(self, line):
+        """Return the offset of the start of a line"""
+        if line >= len(self.line_starts):
+            return self.size
+        return self.line_starts[line]
+
+    def line_at(self, offset):
+        """Return the number of the line holding an offset"""
+        return bisect.bisect_right(self.line_starts, offset) - 1
+
+    def lines(self, first, last):
+        """Return lines [first, last) without the final newline"""
+        line_count = self.line_count()
+        last = min(last, line_count)
+        if first >= last:
+            return ''
+        if last < line_count:
+            end = self.offset(last) - 1
+        else:
+            end = self.size
+        return self.text(self.offset(first), end)
+
+    def hunk_start(self, line):
+        """Return the first line of the hunk holding a line"""
+        idx = bisect.bisect_right(self.hunks, line) - 1
+        if idx < 0:
+            return 0
+        return self.hunks[idx]
+
+    def hunk_end(self, line):
+        """Return the line after the end of the hunk holding a line"""
+        idx = bisect.bisect_right(self.hunks, line)
+        if idx >= len(self.hunks):
+            return self.line_count()
+        return self.hunks[idx]
+
+    def window(self, first, size):
+        """Return the lines [start, end) to show around a line
+
+        The window holds roughly `size` lines starting at the hunk that
+        holds `first`, and is extended to the end of the last hunk it
+        touches as long as that stays below twice the size.
+
+        """
+        line_count = self.line_count()
+        first = max(0, min(first, line_count - 1))
+        start = self.hunk_start(first)
+        if first - start > size // 2:
+            # The hunk is too big to show from its start
+            start = first
+        end = min(line_count, start + size)
+        hunk_end = self.hunk_end(max(start, end - 1))
+        if hunk_end - start <= size * 2:
+            end = hunk_end
+        return start, end
@@ -0,0 +1,219 @@
+"""Lane-based layout for the commit graph
+
+GraphLayout places commits that arrive in topological order, oldest
+first, and keeps enough state to place the next batch without looking
+at the previous ones again.  It does not depend on Qt so it can run in
+the thread that reads the history.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import struct
+import zlib
+from array import array
+
+from cola import core
+from cola.models import storage
+
+
+class GraphLayout(object):
+    """Assigns every commit a row and a lane
+
+    Each commit gets its own row, numbered upwards from zero.  A commit
+    keeps its lane open until a child continues it; the first child
+    takes the lane over, and a merge takes the leftmost lane held open
+    by its parents and closes the others.  Other children branch out to
+    the lowest lane to the right of their parent that is unused between
+    the parent's row and their own, which keeps edges from crossing the
+    commits of other lanes.
+
+    """
+    magic = b'COLALAY1'
+
+    def __init__(self, x_off=18, y_off=24):
+        self.x_off = x_off
+        self.y_off = y_off
+        self.reset()
+
+    def reset(self):
+        self.sha1s = []
+        self.rows = {}
+        self.parent_start = array(str('i'), [0])
+        self.parent_rows = array(str('i'))
+        self.lanes = array(str('i'))
+        """The lane of each row"""
+        self.owners = array(str('i'))
+        """The row holding each lane open, or -1 for closed lanes"""
+        self.lane_end = array(str('i'))
+        """The last row that uses each lane"""
+        self.placed = 0
+        """The number of rows added since rewind()"""
+        self.changed = False
+        """Indicates that rows were laid out since rewind()"""
+
+    def __len__(self):
+        return len(self.sha1s)
+
+    @property
+    def width(self):
+        """The number of lanes used so far"""
+        return len(self.owners)
+
+    def rewind(self):
+        """Start adding commits from the first row again
+
+        Rows that were laid out before are reused for as long as the
+        same commits are added in the same order.
+
+        """
+        self.placed = 0
+        self.changed = False
+
+    def add(self, sha1, parents):
+        """Place a commit below all of the commits placed before it
+
+        Parents that were not added are ignored, so truncated
+        histories are laid out as if they started at the first commit.
+
+        """
+        row = self.placed
+        if row < len(self.sha1s):
+            if self.sha1s[row] == sha1:
+                self.placed += 1
+                return row
+            self.truncate(row)
+        rows = self.rows
+        parent_rows = [rows[p] for p in parents if p in rows]
+        self.sha1s.append(sha1)
+        rows[sha1] = row
+        self.parent_rows.extend(parent_rows)
+        self.parent_start.append(len(self.parent_rows))
+        self._place(row, parent_rows)
+        self.placed += 1
+        self.changed = True
+        return row
+
+    def add_commits(self, commits):
+        """Place commits and return a dict mapping sha1s to positions"""
+        positions = {}
+        for commit in commits:
+            row = self.add(commit.sha1, [p.sha1 for p in commit.parents])
+            positions[commit.sha1] = self.position(row)
+        return positions
+
+    def position(self, row):
+        return (self.lanes[row] * self.x_off, -row * self.y_off)
+
+    def truncate(self, count):
+        """Forget every row from `count` onwards"""
+        if count >= len(self.sha1s):
+            return
+        for sha1 in self.sha1s[count:]:
+            del self.rows[sha1]
+        del self.sha1s[count:]
+        del self.parent_rows[self.parent_start[count]:]
+        del self.parent_start[count+1:]
+        # The lane state cannot be unwound, so replay the kept rows
+        self.lanes = array(str('i'))
+        self.owners = array(str('i'))
+        self.lane_end = array(str('i'))
+        parent_start = self.parent_start
+        parent_rows = self.parent_rows
+        for row in range(count):
+            self._place(row,
+                        parent_rows[parent_start[row]:parent_start[row+1]])
+        self.placed = min(self.placed, count)
+        self.changed = True
+
+    def _place(self, row, parent_rows):
+        lanes = self.lanes
+        owners = self.owners
+        lane_end = self.lane_end
+        if parent_rows:
+            # Continue the leftmost lane held open by a parent
+            open_lanes = [lanes[parent_row] for parent_row in parent_rows
+                          if owners[lanes[parent_row]] == parent_row]
+            if open_lanes:
+                lane = min(open_lanes)
+            else:
+                first = parent_rows[0]
+                lane = self._free_lane(lanes[first] + 1, first)
+            # Close the other lanes.  Edges run up the lane on the
+            # right, so a lane to our right is used up to our row.
+            for parent_lane in open_lanes:
+                if parent_lane > lane:
+                    owners[parent_lane] = -1
+                    lane_end[parent_lane] = row
+        else:
+            lane = self._free_lane(0, row)
+
+        if lane == len(owners):
+            owners.append(row)
+            lane_end.append(row)
+        else:
+            owners[lane] = row
+            lane_end[lane] = row
+        lanes.append(lane)
+
+    def _free_lane(self, start, since):
+        """Return the first lane >= start that is unused after row `since`"""
+        owners = self.owners
+        lane_end = self.lane_end
+        for lane in range(start, len(owners)):
+            if owners[lane] < 0 and lane_end[lane] <= since:
+                return lane
+        return max(start, len(owners))
+
+    def dumps(self):
+        """Return the layout state as bytes"""
+        payload = storage.pack((struct.pack(str('>II'),
+                                            self.x_off, self.y_off),
+                                storage.sha1s_to_bytes(self.sha1s),
+                                storage.array_to_bytes(self.parent_start),
+                                storage.array_to_bytes(self.parent_rows),
+                                storage.array_to_bytes(self.lanes),
+                                storage.array_to_bytes(self.owners),
+                                storage.array_to_bytes(self.lane_end)))
+        return self.magic + zlib.compress(payload, 1)
+
+    @classmethod
+    def loads(cls, data):
+        """Return a GraphLayout from dumps() data, or None when invalid"""
+        if not data.startswith(cls.magic):
+            return None
+        try:
+            payload = zlib.decompress(data[len(cls.magic):])
+            (offsets, sha1s, parent_start, parent_rows,
+             lanes, owners, lane_end) = storage.unpack(payload)
+            x_off, y_off = struct.unpack(str('>II'), offsets)
+        except (ValueError, struct.error, zlib.error):
+            return None
+        layout = cls(x_off=x_off, y_off=y_off)
+        layout.sha1s = storage.sha1s_from_bytes(sha1s)
+        layout.parent_start = storage.array_from_bytes(parent_start)
+        layout.parent_rows = storage.array_from_bytes(parent_rows)
+        layout.lanes = storage.array_from_bytes(lanes)
+        layout.owners = storage.array_from_bytes(owners)
+        layout.lane_end = storage.array_from_bytes(lane_end)
+        count = len(layout.sha1s)
+        if (len(layout.lanes) != count or
+                len(layout.parent_start) != count + 1 or
+                len(layout.owners) != len(layout.lane_end)):
+            return None
+        layout.rows = dict((sha1, row)
+                           for row, sha1 in enumerate(layout.sha1s))
+        return layout
+
+
+def load(path):
+    """Return the layout stored by save(), or None"""
+    try:
+        with open(core.mkpath(path), 'rb') as fh:
+            return GraphLayout.loads(fh.read())
+    except (IOError, OSError):
+        return None
+
+
+def save(path, layout):
+    """Store a layout so that a later run can resume from it"""
+    storage.write(path, layout.dumps())
@@ -0,0 +1,106 @@
+"""Streaming "git grep"
+
+The grep dialog used to wait for "git grep" to finish and then show its
+whole output at once.  GrepProcess yields the output a chunk of lines at
+a time as it is read, so results can be shown as they arrive and a
+consumer that stops reading leaves git blocked on the pipe instead of
+buffering output.  kill() stops the search from another thread as soon
+as it is no longer wanted.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import multiprocessing
+import os
+import threading
+
+from cola import core
+from cola import version
+from cola.git import git
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def grep_command(args, regexp_mode='--basic-regexp', pathspecs=None,
+                 threads=None):
+    """Return the "git grep" command line for a search
+
+    `threads` defaults to the number of CPUs when git supports
+    --threads.
+
+    """
+    cmd = ['git', 'grep', '-n', '--no-color', regexp_mode]
+    if version.check('grep-threads', version.git_version()):
+        if threads is None:
+            threads = cpu_count()
+        cmd.append('--threads=%d' % threads)
+    cmd.extend(args)
+    if pathspecs:
+        if '--' not in args:
+            cmd.append('--')
+        cmd.extend(pathspecs)
+    return cmd
+
+
+class GrepProcess(object):
+    """Runs "git grep" and yields its output as it is read"""
+
+    chunk_size = 65536
+
+    def __init__(self, args, regexp_mode='--basic-regexp', pathspecs=None,
+                 threads=None, git=git):
+        self.cmd = grep_command(args, regexp_mode=regexp_mode,
+                                pathspecs=pathspecs, threads=threads)
+        self.git = git
+        self.proc = None
+        self.killed = False
+        self.status = None
+        """The exit status, once the output has been read"""
+        self.err = ''
+        self._lock = threading.Lock()
+
+    def chunks(self):
+        """Yield lists of output lines as they are read"""
+        with self._lock:
+            if self.killed:
+                return
+            self.proc = proc = core.start_command(self.cmd,
+                                                  cwd=self.git.getcwd())
+        try:
+            pending = b''
+            while True:
+                # os.read() returns what has arrived instead of waiting
+                # for a whole chunk
+                chunk = os.read(proc.stdout.fileno(), self.chunk_size)
+                if not chunk:
+                    break
+                chunk = pending + chunk
+                end = chunk.rfind(b'\n') + 1
+                pending = chunk[end:]
+                if end:
+                    yield core.decode(chunk[:end]).splitlines()
+            if pending:
+                yield [core.decode(pending)]
+        finally:
+            # Abandoned searches are stopped rather than read to the end
+            if proc.poll() is None:
+                self.kill()
+            out, err = core.communicate(proc)
+            self.status = proc.returncode
+            self.err = core.decode(err)
+
+    def kill(self):
+        """Stop the search; chunks() ends once it is stopped"""
+        with self._lock:
+            self.killed = True
+            proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
@@ -0,0 +1,153 @@
+"""Syntax highlighting tokens for files
+
+Lexing a whole file with pygments is slow enough to stall the GUI, and
+the same file tends to be shown over and over.  The tokens of a file are
+computed once, stored line by line so that any range of lines can be
+formatted on its own, and kept in a TokenCache keyed by the file's blob
+sha1 and the lexer.  Nothing here depends on Qt so that lexing can be
+done in a thread.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import collections
+import hashlib
+import threading
+
+from cola import core
+from cola.decorators import memoize
+
+have_pygments = True
+try:
+    from pygments import lex
+    from pygments.util import ClassNotFound
+    from pygments.lexers import get_lexer_for_filename
+except ImportError:
+    have_pygments = False
+
+
+def _never():
+    return False
+
+
+def blob_sha1(text):
+    """Return the sha1 git gives a blob holding text"""
+    data = core.encode(text)
+    header = ('blob %d\0' % len(data)).encode('ascii')
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def lexer_for_filename(filename):
+    """Return the pygments lexer for a file, or None"""
+    if not have_pygments:
+        return None
+    try:
+        return get_lexer_for_filename(filename, stripnl=False)
+    except ClassNotFound:
+        return None
+
+
+def tokenize(text, lexer, cancel=None):
+    """Return a list holding the token runs of each line of text
+
+    Each line is a tuple of (start, length, token type) runs, where start
+    is the column the run starts at.  `cancel` is polled while lexing;
+    when it returns True lexing stops and None is returned.
+
+    """
+    if cancel is None:
+        cancel = _never
+    lines = []
+    runs = []
+    column = 0
+    for count, (token, value) in enumerate(lex(text, lexer)):
+        if count % 1000 == 0 and cancel():
+            return None
+        pos = 0
+        end = value.find('\n')
+        while end >= 0:
+            if end > pos:
+                runs.append((column, end - pos, token))
+            lines.append(tuple(runs))
+            runs = []
+            column = 0
+            pos = end + 1
+            end = value.find('\n', pos)
+        if pos < len(value):
+            runs.append((column, len(value) - pos, token))
+            column += len(value) - pos
+    lines.append(tuple(runs))
+    return lines
+
+
+class TokenCache(object):
+    """An LRU cache of token runs bounded by the number of runs"""
+
+    def __init__(self, max_runs=500000):
+        self.max_runs = max_runs
+        """The total number of runs kept"""
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Return the cached lines for a key, or None"""
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, lines):
+        """Add lines, dropping the least recently used ones to make room"""
+        size = _count_runs(lines)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.max_runs:
+                return
+            self._entries[key] = (lines, size)
+            self.size += size
+            while self.size > self.max_runs:
+                key, old = self._entries.popitem(last=False)
+                self.size -= old[1]
+
+    def tokens(self, text, filename, sha1=None, cancel=None):
+        """Return the token runs of a file's text, lexing it only once
+
+        `sha1` is the blob sha1 of the text when it is already known.
+        Returns None when no lexer handles the file or when lexing was
+        cancelled.
+
+        """
+        lexer = lexer_for_filename(filename)
+        if lexer is None:
+            return None
+        if sha1 is None:
+            sha1 = blob_sha1(text)
+        key = (sha1, lexer.name)
+        lines = self.get(key)
+        if lines is None:
+            lines = tokenize(text, lexer, cancel=cancel)
+            if lines is not None:
+                self.put(key, lines)
+        return lines
+
+
+def _count_runs(lines):
+    return sum(len(runs) for runs in lines) + len(lines)
+
+
+@memoize
+def token_cache():
+    """Return the TokenCache shared by the highlighters"""
+    return TokenCache()
@@ -5,6 +5,7 @@ from __future__ import division, absolute_import, unicode_literals
 
 import os
 import copy
+import threading
 
 from cola import core
 from cola import git
@@ -28,6 +29,122 @@ def model():
     return MainModel()
 
 
+class RefreshRequest(object):
+    """Describes the parts of the model that need to be refreshed"""
+
+    def __init__(self, parts, update_index=False, paths=None):
+        self.parts = set(parts)
+        self.update_index = update_index
+        # None refreshes every file, otherwise only the given paths
+        if paths is None or MainModel.refresh_files not in self.parts:
+            self.paths = None
+        else:
+            self.paths = set(paths)
+
+    def merge(self, other):
+        files = MainModel.refresh_files
+        if files in other.parts:
+            if files not in self.parts:
+                self.paths = other.paths
+            elif self.paths is None or other.paths is None:
+                self.paths = None
+            else:
+                self.paths.update(other.paths)
+        self.parts.update(other.parts)
+        self.update_index = self.update_index or other.update_index
+
+
+class RefreshScheduler(object):
+    """Runs model refreshes one at a time, merging overlapping requests
+
+    At most one refresh runs at a time.  Requests that arrive while it
+    runs are merged into a single pending refresh, which runs as soon
+    as the current one finishes.  Synchronous requests run in the
+    calling thread when nothing is running; asynchronous requests start
+    a background thread.
+
+    """
+
+    def __init__(self, refresh):
+        self._refresh = refresh
+        self._cond = threading.Condition()
+        self._pending = None
+        self._running = False
+        self._thread = None
+        self.requests = 0
+        """Number of refreshes requested"""
+        self.refreshes = 0
+        """Number of refreshes that ran"""
+        self.coalesced = 0
+        """Number of requests merged into a pending refresh"""
+        self.parts = {}
+        """Number of times each part of the model was refreshed"""
+
+    def request(self, request, wait=False):
+        """Schedule a RefreshRequest, optionally waiting until it is done"""
+        with self._cond:
+            self.requests += 1
+            if self._pending is None:
+                self._pending = request
+            else:
+                self._pending.merge(request)
+                self.coalesced += 1
+            if self._running:
+                # Requests made while refreshing, e.g. by an observer,
+                # are picked up once the current refresh is done.
+                if wait and self._thread is not threading.current_thread():
+                    while self._running:
+                        self._cond.wait()
+                return
+            self._running = True
+        if wait:
+            self._run()
+        else:
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def wait(self):
+        """Wait until every requested refresh has finished"""
+        with self._cond:
+            while self._running:
+                self._cond.wait()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'refreshes': self.refreshes,
+                'coalesced': self.coalesced,
+                'parts': dict(self.parts),
+            }
+
+    def _run(self):
+        with self._cond:
+            self._thread = threading.current_thread()
+        error = None
+        while True:
+            with self._cond:
+                request = self._pending
+                self._pending = None
+                if request is None:
+                    self._running = False
+                    self._thread = None
+                    self._cond.notify_all()
+                    break
+                self.refreshes += 1
+                for part in request.parts:
+                    self.parts[part] = self.parts.get(part, 0) + 1
+            try:
+                self._refresh(request)
+            except Exception as e:
+                # Requests merged in meanwhile are still serviced
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+
 class MainModel(Observable):
     """Provides a friendly wrapper for doing common git operations."""
 
@@ -60,6 +177,19 @@ class MainModel(Observable):
     unstaged = property(lambda self: self.modified + self.unmerged + self.untracked)
     """An aggregate of the modified, unmerged, and untracked file lists."""
 
+    # Parts of the model that can be refreshed independently
+    refresh_files = 'files' # Worktree and index status
+    refresh_refs = 'refs' # Remotes, branches and tags
+    refresh_state = 'state' # Merge and rebase state
+    refresh_all = (refresh_files, refresh_refs, refresh_state)
+
+    # update_paths() does a full refresh when more paths than this change
+    max_partial_paths = 128
+
+    # Changes to these files do a full refresh since they affect the
+    # status of other paths
+    status_files = ('.gitignore', '.gitmodules')
+
     def __init__(self, cwd=None):
         """Reads git repository settings and sets several methods
         so that they refer to the git module.  This object
@@ -87,6 +217,12 @@ class MainModel(Observable):
         self.unmerged = []
         self.upstream_changed = []
         self.submodules = set()
+        self._status_stamp = None
+        self.scheduler = RefreshScheduler(self._refresh)
+        self.dispatcher = None
+        """Called with a function and its arguments to run it in the GUI
+        thread, so that observers are notified there by refreshes that
+        run in the background"""
 
         self.local_branches = []
         self.remote_branches = []
@@ -94,6 +230,13 @@ class MainModel(Observable):
         if cwd:
             self.set_worktree(cwd)
 
+    def notify_observers(self, message, *args, **opts):
+        if self.dispatcher is None:
+            Observable.notify_observers(self, message, *args, **opts)
+        else:
+            self.dispatcher(Observable.notify_observers,
+                            self, message, *args, **opts)
+
     def unstageable(self):
         return self.mode in self.modes_unstageable
 
@@ -167,33 +310,170 @@ class MainModel(Observable):
         return self.git.log('-1', no_color=True, pretty='format:%s%n%n%b',
                             *args)[STDOUT]
 
+    def refresh(self, parts=refresh_all, update_index=False, paths=None,
+                wait=False):
+        """Schedule a refresh of parts of the model
+
+        Overlapping refreshes are merged, see RefreshScheduler.
+        When `paths` is given only the status of those paths is read.
+
+        """
+        if paths is not None and (not paths or
+                                  len(paths) > self.max_partial_paths):
+            parts = self.refresh_all
+            update_index = True
+            paths = None
+        request = RefreshRequest(parts, update_index=update_index,
+                                 paths=paths)
+        self.scheduler.request(request, wait=wait)
+
     def update_file_status(self, update_index=False):
-        self.notify_observers(self.message_about_to_update)
-        self._update_files(update_index=update_index)
-        self.notify_observers(self.message_updated)
+        self.refresh((self.refresh_files,), update_index=update_index,
+                     wait=True)
 
     def update_status(self, update_index=False):
+        self.refresh(update_index=update_index, wait=True)
+
+    def update_paths(self, paths):
+        """Refresh the status of the given worktree paths only
+
+        A full update_status() is done instead when the index or HEAD
+        changed since the last refresh, or when too many paths changed.
+
+        """
+        self.refresh((self.refresh_files,), paths=paths, wait=True)
+
+    def _refresh(self, request):
+        """Refresh the parts of the model described by a RefreshRequest"""
+        parts = request.parts
+        paths = request.paths
+        update_index = request.update_index
+        if paths is not None and (self._status_stamp is None or
+                self._status_stamp != self._read_status_stamp() or
+                self._affects_other_paths(paths)):
+            # The index or HEAD moved, or the changes affect other
+            # paths, so everything needs to be read
+            parts = self.refresh_all
+            update_index = True
+            paths = None
+
+        # Read everything in the calling thread and apply it in one go
+        # in the GUI thread so that observers never see partial updates
+        state = {}
+        if self.refresh_state in parts:
+            state.update(self._read_merge_rebase_status())
+        if self.refresh_files in parts:
+            if paths is None:
+                state.update(self._read_files(update_index=update_index))
+            else:
+                state.update(self._read_paths(paths))
+        if self.refresh_refs in parts:
+            state.update(self._read_refs())
+        self._dispatch(self._apply_refresh, parts, paths, state)
+
+    def _dispatch(self, fn, *args):
+        """Call fn in the GUI thread when there is a dispatcher"""
+        if self.dispatcher is None:
+            fn(*args)
+        else:
+            self.dispatcher(fn, *args)
+
+    def _apply_refresh(self, parts, paths, state):
+        """Replace the model's state with the results of _refresh()"""
         # Give observers a chance to respond
         self.notify_observers(self.message_about_to_update)
-        self._update_merge_rebase_status()
-        self._update_files(update_index=update_index)
-        self._update_refs()
-        self._update_branches_and_tags()
-        self._update_branch_heads()
+        if paths is not None:
+            self._merge_paths(paths, state)
+        for key, value in state.items():
+            setattr(self, key, value)
+        if self.refresh_state in parts:
+            if self.is_merging and self.mode == self.mode_amend:
+                self.set_mode(self.mode_none)
+        if self.refresh_files in parts:
+            self._update_selection()
         self.notify_observers(self.message_updated)
 
-    def _update_files(self, update_index=False):
+    def _affects_other_paths(self, paths):
+        """Can changes to the paths change the status of other paths?
+
+        """
+        for path in paths:
+            if os.path.basename(path) in self.status_files:
+                return True
+        return False
+
+    def _read_files(self, update_index=False):
         display_untracked = prefs.display_untracked()
         state = gitcmds.worktree_state_dict(head=self.head,
                                             update_index=update_index,
                                             display_untracked=display_untracked)
-        self.staged = state.get('staged', [])
-        self.modified = state.get('modified', [])
-        self.unmerged = state.get('unmerged', [])
-        self.untracked = state.get('untracked', [])
-        self.submodules = state.get('submodules', set())
-        self.upstream_changed = state.get('upstream_changed', [])
+        return {
+            'staged': state.get('staged', []),
+            'modified': state.get('modified', []),
+            'unmerged': state.get('unmerged', []),
+            'untracked': state.get('untracked', []),
+            'submodules': state.get('submodules', set()),
+            'upstream_changed': state.get('upstream_changed', []),
+            '_status_stamp': self._read_status_stamp(),
+        }
+
+    def _read_paths(self, paths):
+        display_untracked = prefs.display_untracked()
+        state = gitcmds.worktree_state_dict(head=self.head,
+                                            display_untracked=display_untracked,
+                                            paths=sorted(paths))
+        return {
+            'staged': state['staged'],
+            'modified': state['modified'],
+            'unmerged': state['unmerged'],
+            'untracked': state['untracked'],
+            'submodules': state['submodules'],
+            '_status_stamp': self._read_status_stamp(),
+        }
 
+    def _merge_paths(self, paths, state):
+        """Merge the status read by _read_paths() into the current lists"""
+
+        def in_scope(name):
+            """Is the name one of the paths or inside one of them?"""
+            while name:
+                if name in paths:
+                    return True
+                name = name[:max(name.rfind('/'), 0)]
+            return False
+
+        for key in ('staged', 'modified', 'unmerged', 'untracked'):
+            items = [x for x in getattr(self, key) if not in_scope(x)]
+            items.extend([x for x in state[key] if in_scope(x)])
+            items.sort()
+            state[key] = items
+
+        submodules = set([x for x in self.submodules if not in_scope(x)])
+        submodules.update([x for x in state['submodules'] if in_scope(x)])
+        state['submodules'] = submodules
+
+    def _read_status_stamp(self):
+        """Return a value that changes whenever the index or HEAD changes"""
+        stamp = []
+        head = self.git.git_path('HEAD')
+        paths = [self.git.git_path('index'), head,
+                 self.git.git_path('packed-refs')]
+        try:
+            ref = core.read(head).strip()
+        except (IOError, OSError):
+            ref = ''
+        if ref.startswith('ref: '):
+            paths.append(self.git.git_path(ref[5:]))
+        stamp.append(ref)
+        for path in paths:
+            try:
+                st = core.stat(path)
+                stamp.append((st.st_mtime, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def _update_selection(self):
         sel = selection_model()
         if self.is_empty():
             sel.reset()
@@ -206,24 +486,21 @@ class MainModel(Observable):
         return not(bool(self.staged or self.modified or
                         self.unmerged or self.untracked))
 
-    def _update_refs(self):
-        self.remotes = self.git.remote()[STDOUT].splitlines()
-
-    def _update_branch_heads(self):
-        # Set these early since they are used to calculate 'upstream_changed'.
-        self.currentbranch = gitcmds.current_branch()
-
-    def _update_branches_and_tags(self):
+    def _read_refs(self):
         local_branches, remote_branches, tags = gitcmds.all_refs(split=True)
-        self.local_branches = local_branches
-        self.remote_branches = remote_branches
-        self.tags = tags
+        return {
+            'remotes': self.git.remote()[STDOUT].splitlines(),
+            'local_branches': local_branches,
+            'remote_branches': remote_branches,
+            'tags': tags,
+            'currentbranch': gitcmds.current_branch(),
+        }
 
-    def _update_merge_rebase_status(self):
-        self.is_merging = core.exists(self.git.git_path('MERGE_HEAD'))
-        self.is_rebasing = core.exists(self.git.git_path('rebase-merge'))
-        if self.is_merging and self.mode == self.mode_amend:
-            self.set_mode(self.mode_none)
+    def _read_merge_rebase_status(self):
+        return {
+            'is_merging': core.exists(self.git.git_path('MERGE_HEAD')),
+            'is_rebasing': core.exists(self.git.git_path('rebase-merge')),
+        }
 
     def delete_branch(self, branch):
         return self.git.branch(branch, D=True)
@@ -449,8 +726,6 @@ class MainModel(Observable):
             else:
                 remove.append(path)
 
-        self.notify_observers(self.message_about_to_update)
-
         # `git add -u` doesn't work on untracked files
         if add:
             self._sliced_add(add)
@@ -462,8 +737,7 @@ class MainModel(Observable):
                 self.git.add('--', u=True, *remove[:42])
                 remove = remove[42:]
 
-        self._update_files()
-        self.notify_observers(self.message_updated)
+        self.update_file_status()
 
     def unstage_paths(self, paths):
         if not paths:
@@ -0,0 +1,438 @@
+"""Searching commits without walking the whole history for every query
+
+The search dialog ran "git log --all" for every message, author and date
+search.  CommitIndex keeps the authors, committers, dates, summaries and
+message words of every commit reachable from the refs in a file in the
+git directory.  It is built once, in the background, and extended with
+only the commits that are new since the refs it was built from.  When the
+old refs are no longer reachable, eg. after a rebase, it is built again.
+
+Diff searches cannot be answered from an index, so PickaxeSearch streams
+the results of "git log -S" as they are found and can be killed.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import re
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+
+from cola import core
+from cola import gitcmds
+from cola.decorators import memoize
+from cola.git import git
+from cola.models import storage
+
+
+LOG_FORMAT = '%H%x01%aN <%aE>%x01%cN <%cE>%x01%at%x01%ct%x01%s%x01%b'
+
+# Queries with these characters are regular expressions and are left to git
+REGEX_CHARS = re.compile(r'[.*+?^$\[\](){}|\\]')
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Return the set of lowercase words in text"""
+    return set(_word_re.findall(text.lower()))
+
+
+def is_regex(query):
+    return bool(REGEX_CHARS.search(query))
+
+
+def _plural(count, singular, plural):
+    return (count == 1 and singular or plural) % count
+
+
+def relative_date(timestamp, now=None):
+    """Format a timestamp the way git's "%ar" does"""
+    if now is None:
+        now = time.time()
+    diff = int(now - timestamp)
+    if diff < 0:
+        return 'in the future'
+    if diff < 90:
+        return _plural(diff, '%d second ago', '%d seconds ago')
+    diff = (diff + 30) // 60
+    if diff < 90:
+        return _plural(diff, '%d minute ago', '%d minutes ago')
+    diff = (diff + 30) // 60
+    if diff < 36:
+        return _plural(diff, '%d hour ago', '%d hours ago')
+    diff = (diff + 12) // 24
+    if diff < 14:
+        return _plural(diff, '%d day ago', '%d days ago')
+    if diff < 70:
+        return _plural((diff + 3) // 7, '%d week ago', '%d weeks ago')
+    if diff < 365:
+        return _plural((diff + 15) // 30, '%d month ago', '%d months ago')
+    if diff < 1825:
+        total_months = (diff * 12 * 2 + 365) // (365 * 2)
+        years = _plural(total_months // 12, '%d year', '%d years')
+        months = total_months % 12
+        if months:
+            return '%s, %s' % (years, _plural(months, '%d month ago',
+                                              '%d months ago'))
+        return years + ' ago'
+    return _plural((diff + 183) // 365, '%d year ago', '%d years ago')
+
+
+def _finish(proc):
+    """Reap a command whose stdin has been closed and stdout read"""
+    core.wait(proc)
+    proc.stdout.close()
+    proc.stderr.close()
+
+
+class CommitIndex(object):
+    """Commit metadata and message words for the commits in a repository
+
+    Searches return None while the index is being read or updated so
+    that callers can ask git instead.
+
+    """
+    magic = b'COLAIDX1'
+
+    def __init__(self, path, git=git):
+        self.path = path
+        self.git = git
+        self.ready = False
+        """True once the index holds every commit reachable from the refs"""
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.tips = []
+        self.sha1s = []
+        self.ids = {}
+        self.summaries = []
+        self.people = []
+        """Every distinct "Name <email>" of the authors and committers"""
+        self.people_ids = {}
+        self.authors = array(str('l'))
+        self.committers = array(str('l'))
+        self.authdates = array(str('l'))
+        self.commitdates = array(str('l'))
+        self.words = {}
+        """Maps each word to the ids of the commits holding it"""
+        self._sorted_words = None
+
+    def __len__(self):
+        return len(self.sha1s)
+
+    # Building
+
+    def update(self):
+        """Bring the index up to date with the refs
+
+        Returns True when commits were added.
+
+        """
+        with self._lock:
+            if not self.sha1s:
+                self._load()
+            tips = self._current_tips()
+            if tips == self.tips and self.sha1s:
+                self.ready = True
+                return False
+            if self.tips and not self._reachable(self.tips, tips):
+                # History was rewritten
+                self._clear()
+            count = len(self.sha1s)
+            self._read_log(self.tips)
+            self.tips = tips
+            self._save()
+            self.ready = True
+            return len(self.sha1s) > count
+
+    def _current_tips(self):
+        status, out, err = self.git.rev_parse('--all', 'HEAD')
+        return sorted(set([line for line in out.splitlines()
+                           if len(line) == 40]))
+
+    def _reachable(self, tips, current):
+        """Return True when the old tips are all reachable from the refs"""
+        cmd = ['git', 'rev-list', '-1', '--stdin']
+        proc = core.start_command(cmd, cwd=self.git.getcwd())
+        stdin = (''.join(['%s\n' % tip for tip in tips]) +
+                 ''.join(['^%s\n' % tip for tip in current]))
+        proc.stdin.write(core.encode(stdin))
+        proc.stdin.close()
+        out = proc.stdout.read()
+        _finish(proc)
+        # Missing objects fail, and unreachable commits are listed
+        return proc.returncode == 0 and not out.strip()
+
+    def _read_log(self, known_tips):
+        cmd = ['git', 'log', '-z', '--all', '--stdin', '--no-color',
+               '--format=' + LOG_FORMAT]
+        proc = core.start_command(cmd, cwd=self.git.getcwd())
+        proc.stdin.write(core.encode(''.join(['^%s\n' % tip
+                                              for tip in known_tips])))
+        proc.stdin.close()
+        for entry in core.read_nul_tokens(proc.stdout):
+            parts = entry.split('\x01', 6)
+            if len(parts) == 7:
+                self._add(*parts)
+        _finish(proc)
+
+    def _person(self, person):
+        try:
+            return self.people_ids[person]
+        except KeyError:
+            idx = self.people_ids[person] = len(self.people)
+            self.people.append(person)
+            return idx
+
+    def _add(self, sha1, author, committer, authdate, commitdate,
+             summary, body):
+        if sha1 in self.ids:
+            return
+        idx = self.ids[sha1] = len(self.sha1s)
+        self.sha1s.append(sha1)
+        self.summaries.append(summary)
+        self.authors.append(self._person(author))
+        self.committers.append(self._person(committer))
+        self.authdates.append(int(authdate or 0))
+        self.commitdates.append(int(commitdate or 0))
+        words = self.words
+        for word in tokenize(summary + '\n' + body):
+            try:
+                words[word].append(idx)
+            except KeyError:
+                words[word] = array(str('l'), [idx])
+        self._sorted_words = None
+
+    # Storage
+
+    def _load(self):
+        try:
+            with open(core.mkpath(self.path), 'rb') as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return
+        if not data.startswith(self.magic):
+            return
+        try:
+            (tips, sha1s, summaries, people, authors, committers,
+             authdates, commitdates, words, counts, postings) = \
+                    storage.unpack(zlib.decompress(data[len(self.magic):]))
+            self._restore(tips, sha1s, summaries, people, authors,
+                          committers, authdates, commitdates, words,
+                          counts, postings)
+        except (ValueError, zlib.error, UnicodeDecodeError):
+            self._clear()
+
+    def _restore(self, tips, sha1s, summaries, people, authors, committers,
+                 authdates, commitdates, words, counts, postings):
+        self.sha1s = storage.sha1s_from_bytes(sha1s)
+        self.ids = dict((sha1, idx) for idx, sha1 in enumerate(self.sha1s))
+        self.tips = storage.strings_from_bytes(tips)
+        self.summaries = storage.strings_from_bytes(summaries)
+        self.people = storage.strings_from_bytes(people)
+        self.people_ids = dict((person, idx)
+                               for idx, person in enumerate(self.people))
+        self.authors = storage.array_from_bytes(authors, 'l')
+        self.committers = storage.array_from_bytes(committers, 'l')
+        self.authdates = storage.array_from_bytes(authdates, 'l')
+        self.commitdates = storage.array_from_bytes(commitdates, 'l')
+        words = storage.strings_from_bytes(words)
+        counts = storage.array_from_bytes(counts, 'l')
+        postings = storage.array_from_bytes(postings, 'l')
+        count = len(self.sha1s)
+        if (len(self.summaries) != count or len(self.authors) != count or
+                len(self.committers) != count or
+                len(self.authdates) != count or
+                len(self.commitdates) != count or
+                len(counts) != len(words) or sum(counts) != len(postings)):
+            raise ValueError('inconsistent search index')
+        offset = 0
+        self.words = {}
+        for word, size in zip(words, counts):
+            self.words[word] = postings[offset:offset+size]
+            offset += size
+        self._sorted_words = None
+
+    def _save(self):
+        words = sorted(self.words)
+        postings = array(str('l'))
+        for word in words:
+            postings.extend(self.words[word])
+        counts = [len(self.words[word]) for word in words]
+        payload = storage.pack((
+            storage.strings_to_bytes(self.tips),
+            storage.sha1s_to_bytes(self.sha1s),
+            storage.strings_to_bytes(self.summaries),
+            storage.strings_to_bytes(self.people),
+            storage.array_to_bytes(self.authors, 'l'),
+            storage.array_to_bytes(self.committers, 'l'),
+            storage.array_to_bytes(self.authdates, 'l'),
+            storage.array_to_bytes(self.commitdates, 'l'),
+            storage.strings_to_bytes(words),
+            storage.array_to_bytes(counts, 'l'),
+            storage.array_to_bytes(postings, 'l'),
+        ))
+        storage.write(self.path, self.magic + zlib.compress(payload, 1))
+
+    # Searching
+
+    def _search(self, func, *args):
+        if not self.ready or not self._lock.acquire(False):
+            return None
+        try:
+            return func(*args)
+        finally:
+            self._lock.release()
+
+    def result(self, idx, now=None):
+        """Return (sha1, "author - summary - date") like gitcmds.parse_rev_list"""
+        author = self.people[self.authors[idx]]
+        name = author[:author.rfind(' <')]
+        return (self.sha1s[idx], '%s - %s - %s' % (
+                name, self.summaries[idx],
+                relative_date(self.authdates[idx], now=now)))
+
+    def _newest(self, ids, max_count):
+        commitdates = self.commitdates
+        ids = sorted(ids, key=lambda idx: (-commitdates[idx], idx))
+        now = time.time()
+        return [self.result(idx, now=now) for idx in ids[:max_count]]
+
+    def search_messages(self, query, max_count=500):
+        """Return the commits whose messages hold every word of the query
+
+        The last word also matches longer words that it starts.  Commits
+        with the words in their summary rank first, newest first.
+
+        """
+        return self._search(self._search_messages, query, max_count)
+
+    def _search_messages(self, query, max_count):
+        terms = _word_re.findall(query.lower())
+        if not terms:
+            return []
+        found = None
+        for pos, term in enumerate(terms):
+            if pos == len(terms) - 1:
+                ids = self._prefix_ids(term)
+            else:
+                ids = set(self.words.get(term, ()))
+            if found is None:
+                found = ids
+            else:
+                found &= ids
+            if not found:
+                return []
+
+        commitdates = self.commitdates
+        summaries = self.summaries
+        last = terms[-1]
+        terms = set(terms[:-1])
+
+        def rank(idx):
+            words = tokenize(summaries[idx])
+            score = len(terms & words)
+            if [word for word in words if word.startswith(last)]:
+                score += 1
+            return (-score, -commitdates[idx], idx)
+
+        now = time.time()
+        ranked = sorted(found, key=rank)[:max_count]
+        return [self.result(idx, now=now) for idx in ranked]
+
+    def _prefix_ids(self, prefix):
+        if self._sorted_words is None:
+            self._sorted_words = sorted(self.words)
+        words = self._sorted_words
+        ids = set()
+        pos = bisect_left(words, prefix)
+        while pos < len(words) and words[pos].startswith(prefix):
+            ids.update(self.words[words[pos]])
+            pos += 1
+        return ids
+
+    def search_authors(self, query, max_count=500):
+        """Return the newest commits by authors matching the query"""
+        return self._search(self._search_people, self.authors,
+                            query, max_count)
+
+    def search_committers(self, query, max_count=500):
+        """Return the newest commits by committers matching the query"""
+        return self._search(self._search_people, self.committers,
+                            query, max_count)
+
+    def _search_people(self, column, query, max_count):
+        query = query.lower()
+        people = set([idx for idx, person in enumerate(self.people)
+                      if query in person.lower()])
+        ids = [idx for idx, person in enumerate(column) if person in people]
+        return self._newest(ids, max_count)
+
+    def search_dates(self, start, end, max_count=500):
+        """Return the newest commits committed between two timestamps"""
+        return self._search(self._search_dates, start, end, max_count)
+
+    def _search_dates(self, start, end, max_count):
+        ids = [idx for idx, date in enumerate(self.commitdates)
+               if start <= date < end]
+        return self._newest(ids, max_count)
+
+
+@memoize
+def _commit_index(path):
+    return CommitIndex(path)
+
+
+def commit_index():
+    """Return the CommitIndex of the current repository"""
+    return _commit_index(git.git_path('cola-search.index'))
+
+
+class PickaxeSearch(object):
+    """Streams the commits that add or remove a string, as "git log -S"
+
+    kill() may be called from another thread to stop the search.
+
+    """
+
+    def __init__(self, query, max_count=500, git=git):
+        self.cmd = ['git', 'log', '-S' + query, '--all', '--no-color',
+                    '--max-count=%d' % max_count,
+                    '--pretty=format:%H %aN - %s - %ar']
+        self.git = git
+        self.proc = None
+        self.killed = False
+        self._lock = threading.Lock()
+
+    def results(self):
+        """Yield (sha1, summary) pairs as git finds them"""
+        with self._lock:
+            if self.killed:
+                return
+            self.proc = proc = core.start_command(self.cmd,
+                                                  cwd=self.git.getcwd())
+        try:
+            while True:
+                line = core.readline(proc.stdout)
+                if not line:
+                    break
+                for result in gitcmds.parse_rev_list(line):
+                    yield result
+        finally:
+            if proc.poll() is None:
+                self.kill()
+            core.communicate(proc)
+
+    def kill(self):
+        with self._lock:
+            self.killed = True
+            proc = self.proc
+        if proc is not None and proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
@@ -0,0 +1,121 @@
+"""Compact binary files for the caches kept by cola
+
+The caches store columns of integers, sha1s and strings as
+length-prefixed parts, usually compressed, behind a magic header
+chosen by each cache.  Files are replaced atomically so that a reader
+never sees a partial write.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import binascii
+import os
+import struct
+import threading
+from array import array
+
+from cola import core
+
+
+def array_to_bytes(values, typecode='i'):
+    """Return integers as the bytes of an array"""
+    arr = array(str(typecode), values)
+    try:
+        return arr.tobytes()
+    except AttributeError: # Python 2
+        return arr.tostring()
+
+
+def array_from_bytes(data, typecode='i'):
+    """Return the array stored by array_to_bytes()"""
+    arr = array(str(typecode))
+    try:
+        arr.frombytes(data)
+    except AttributeError: # Python 2
+        arr.fromstring(data)
+    return arr
+
+
+def sha1s_to_bytes(sha1s):
+    """Return hex sha1s as 20 bytes each"""
+    return binascii.unhexlify(''.join(sha1s).encode('ascii'))
+
+
+def sha1s_from_bytes(data):
+    """Return the hex sha1s stored by sha1s_to_bytes()"""
+    hexdata = binascii.hexlify(data).decode('ascii')
+    return [hexdata[i:i+40] for i in range(0, len(hexdata), 40)]
+
+
+def strings_to_bytes(strings):
+    """Return strings without NULs as a single NUL-separated string"""
+    return '\0'.join(strings).encode('utf-8')
+
+
+def strings_from_bytes(data):
+    """Return the strings stored by strings_to_bytes()"""
+    if not data:
+        return []
+    return data.decode('utf-8').split('\0')
+
+
+def pack(parts):
+    """Return a sequence of bytes as length-prefixed parts"""
+    return b''.join([struct.pack(str('>I'), len(part)) + part
+                     for part in parts])
+
+
+def unpack(data):
+    """Return the parts stored by pack()
+
+    Raises ValueError when the data is truncated.
+
+    """
+    parts = []
+    offset = 0
+    while offset < len(data):
+        try:
+            size, = struct.unpack_from(str('>I'), data, offset)
+        except struct.error:
+            raise ValueError('truncated data')
+        offset += 4
+        if offset + size > len(data):
+            raise ValueError('truncated data')
+        parts.append(data[offset:offset+size])
+        offset += size
+    return parts
+
+
+def _replace(src, dst):
+    try:
+        replace = os.replace
+    except AttributeError: # Python 2
+        if os.name == 'nt' and os.path.exists(dst):
+            # rename() does not replace files on Windows
+            os.remove(dst)
+        replace = os.rename
+    replace(src, dst)
+
+
+def write(path, data):
+    """Replace a file atomically, creating its directory when needed
+
+    Returns False when the file cannot be written.
+
+    """
+    tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    try:
+        dirname = os.path.dirname(path)
+        if dirname and not core.exists(dirname):
+            core.makedirs(dirname)
+        with open(core.mkpath(tmp_path), 'wb') as fh:
+            fh.write(data)
+        _replace(core.mkpath(tmp_path), core.mkpath(path))
+    except (IOError, OSError):
+        try:
+            os.remove(core.mkpath(tmp_path))
+        except OSError:
+            pass
+        return False
+    return True
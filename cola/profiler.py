@@ -0,0 +1,174 @@
+"""Records how long the commands run by git-cola take
+
+Every command started through core.start_command() is recorded in a
+bounded in-memory ring along with its exit status, the amount of output
+it produced and the cola function that ran it.  Setting
+GIT_COLA_PROFILE=<path> writes the records and a per-subcommand summary
+to <path> as JSON when git-cola exits.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+from cola.decorators import memoize
+
+
+# Frames in these modules are plumbing, not callers
+_PLUMBING_MODULES = frozenset((
+    'cola.core',
+    'cola.decorators',
+    'cola.git',
+    'cola.profiler',
+))
+# Long argument lists (eg. paths) are cut down to this many arguments
+MAX_ARGS = 12
+
+
+def subcommand(command):
+    """Return the git subcommand of a command, or the program's name"""
+    if not command:
+        return ''
+    program = os.path.basename(command[0])
+    if program != 'git':
+        return program
+    args = iter(command[1:])
+    for arg in args:
+        if arg in ('-c', '-C'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return program
+
+
+def caller():
+    """Return "module.function" for the first frame outside the plumbing"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module not in _PLUMBING_MODULES:
+            return '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+    return ''
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    rank = int(len(values) * pct / 100.0 + 0.5)
+    return values[min(len(values), max(1, rank)) - 1]
+
+
+class Profiler(object):
+    """A bounded ring of command records"""
+
+    def __init__(self, size=4096):
+        self._lock = threading.Lock()
+        self.records = collections.deque(maxlen=size)
+        self.count = 0
+        """The number of records added, including the discarded ones"""
+
+    def started(self, proc, command, **extra):
+        """Start timing a process returned by core.start_command()"""
+        args = list(command[:MAX_ARGS])
+        if len(command) > MAX_ARGS:
+            args.append('... (%d more)' % (len(command) - MAX_ARGS))
+        record = {
+            'command': args,
+            'subcommand': subcommand(command),
+            'caller': caller(),
+            'thread': threading.current_thread().name,
+            'start': time.time(),
+            'elapsed': None,
+            'status': None,
+            'stdout': None,
+            'stderr': None,
+        }
+        record.update(extra)
+        proc._cola_profile = record
+
+    def finished(self, proc, out=None, err=None):
+        """Record a process once it has exited
+
+        The sizes of stdout and stderr are only known when the output
+        was collected in one piece, and are None otherwise.
+
+        """
+        record = getattr(proc, '_cola_profile', None)
+        if record is None:
+            return
+        proc._cola_profile = None
+        record['elapsed'] = time.time() - record['start']
+        record['status'] = proc.returncode
+        if out is not None:
+            record['stdout'] = len(out)
+        if err is not None:
+            record['stderr'] = len(err)
+        with self._lock:
+            self.records.append(record)
+            self.count += 1
+
+    def summary(self):
+        """Return latency percentiles and totals per subcommand"""
+        with self._lock:
+            records = list(self.records)
+        by_subcommand = collections.defaultdict(list)
+        for record in records:
+            by_subcommand[record['subcommand']].append(record)
+
+        result = {}
+        for name, items in by_subcommand.items():
+            elapsed = sorted(record['elapsed'] for record in items)
+            result[name] = {
+                'count': len(items),
+                'total': sum(elapsed),
+                'p50': percentile(elapsed, 50),
+                'p95': percentile(elapsed, 95),
+                'p99': percentile(elapsed, 99),
+                'max': elapsed[-1],
+                'stdout': sum(record['stdout'] or 0 for record in items),
+                'stderr': sum(record['stderr'] or 0 for record in items),
+                'failed': len([record for record in items
+                               if record['status']]),
+                'lock_contended': len([record for record in items
+                                       if record.get('lock_contended')]),
+            }
+        return result
+
+    def dumps(self):
+        """Return the summary and the records as JSON"""
+        with self._lock:
+            records = list(self.records)
+            count = self.count
+        data = {
+            'pid': os.getpid(),
+            'count': count,
+            'summary': self.summary(),
+            'records': records,
+        }
+        return json.dumps(data, indent=1, sort_keys=True)
+
+    def dump(self, path):
+        """Write dumps() to a file"""
+        try:
+            with open(path, 'w') as fh:
+                fh.write(self.dumps())
+        except (IOError, OSError) as e:
+            sys.stderr.write('git-cola: unable to write %s: %s\n' % (path, e))
+
+
+@memoize
+def instance():
+    """Return the Profiler singleton"""
+    profiler = Profiler()
+    path = os.environ.get('GIT_COLA_PROFILE')
+    if path:
+        atexit.register(profiler.dump, path)
+    return profiler
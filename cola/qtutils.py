@@ -23,6 +23,28 @@ from cola.widgets import defs
 from cola.compat import ustr
 
 
+class Dispatcher(QtCore.QObject):
+    """Runs functions in the thread that created it
+
+    Calls made from other threads are queued as signals.
+
+    """
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.connect(self, SIGNAL('dispatch'), self._dispatch,
+                     Qt.QueuedConnection)
+
+    def __call__(self, fn, *args, **kwargs):
+        if QtCore.QThread.currentThread() == self.thread():
+            fn(*args, **kwargs)
+        else:
+            self.emit(SIGNAL('dispatch'), fn, args, kwargs)
+
+    def _dispatch(self, fn, args, kwargs):
+        fn(*args, **kwargs)
+
+
 def connect_action(action, fn):
     action.connect(action, SIGNAL('triggered()'), fn)
 
@@ -53,6 +53,36 @@ def add_parents(path_entry_set):
     return path_entry_set
 
 
+def path_index(paths):
+    """Return a dict mapping directories to sorted (subdirs, files) lists
+
+    The top-level directory is ''.  Every directory that holds a path,
+    directly or through a subdirectory, is present.
+
+    """
+    index = {'': ([], [])}
+    for path in paths:
+        parent = dirname(path)
+        entry = index.get(parent)
+        if entry is None:
+            entry = index[parent] = ([], [])
+            # Register the new directory with its own parents
+            child = parent
+            while True:
+                grandparent = dirname(child)
+                grandparent_entry = index.get(grandparent)
+                if grandparent_entry is not None:
+                    grandparent_entry[0].append(child)
+                    break
+                index[grandparent] = ([child], [])
+                child = grandparent
+        entry[1].append(path)
+    for subdirs, files in index.values():
+        subdirs.sort()
+        files.sort()
+    return index
+
+
 def ident_file_type(filename, exists):
     """Returns an icon based on the contents of filename."""
     if exists:
@@ -368,11 +368,9 @@ class BrowserController(QtCore.QObject):
         if path in self.updated:
             return
         self.updated.add(path)
-        GitRepoEntryManager.entry(path).update()
-        entry = GitRepoEntryManager.entry
-        for row in range(item.rowCount()):
-            path = item.child(row, 0).path
-            entry(path).update()
+        paths = [path] + [item.child(row, 0).path
+                          for row in range(item.rowCount())]
+        GitRepoEntryManager.update(paths)
 
     def difftool_predecessor(self, paths):
         """Prompt for an older commit and launch difftool against it."""
@@ -400,12 +398,14 @@ class SaveBlob(BaseCommand):
 
     def do(self):
         model = self.model
-        cmd = ['git', 'show', '%s:%s' % (model.ref, model.relpath)]
-        with core.xopen(model.filename, 'wb') as fp:
-            proc = core.start_command(cmd, stdout=fp)
-            out, err = proc.communicate()
+        obj = git.read_object('%s:%s' % (model.ref, model.relpath))
+        if obj is None:
+            status = 1
+        else:
+            status = 0
+            with core.xopen(model.filename, 'wb') as fp:
+                fp.write(obj[2])
 
-        status = proc.returncode
         msg = (N_('Saved "%(filename)s" from "%(ref)s" to "%(destination)s"') %
                dict(filename=model.relpath,
                     ref=model.ref,
@@ -669,26 +669,28 @@ class GitTreeModel(GitFileTreeModel):
         self._initialize()
 
     def _initialize(self):
-        """Iterate over git-ls-tree and create GitTreeItems."""
-        status, out, err = git.ls_tree('--full-tree', '-r', '-t', '-z',
-                                       self.ref)
-        if status != 0:
-            Interaction.log_status(status, out, err)
-            return
-
-        if not out:
+        """Walk the tree objects for the ref and create GitTreeItems."""
+        entries = git.tree_entries(self.ref)
+        if entries is None:
+            Interaction.log_status(1, '',
+                                   N_('"%s" is not a valid tree') % self.ref)
             return
+        self._add_tree_entries('', entries)
 
-        for line in out[:-1].split('\0'):
-            # .....6 ...4 ......................................40
-            # 040000 tree c127cde9a0c644a3a8fef449a244f47d5272dfa6	relative
-            # 100644 blob 139e42bf4acaa4927ec9be1ec55a252b97d3f1e2	relative/path
-            objtype = line[7]
-            relpath = line[6 + 1 + 4 + 1 + 40 + 1:]
-            if objtype == 't':
-                parent = self.dir_entries[utils.dirname(relpath)]
+    def _add_tree_entries(self, dirname, entries):
+        """Add tree entries, reading subtrees through "cat-file --batch"."""
+        for mode, objtype, sha1, name in entries:
+            if dirname:
+                relpath = dirname + '/' + name
+            else:
+                relpath = name
+            if objtype == 'tree':
+                parent = self.dir_entries[dirname]
                 self.add_directory(parent, relpath)
-            elif objtype == 'b':
+                subtree = git.tree_entries(sha1)
+                if subtree:
+                    self._add_tree_entries(relpath, subtree)
+            elif objtype == 'blob':
                 self.add_file(relpath)
 
 
@@ -2,6 +2,7 @@ from __future__ import division, absolute_import, unicode_literals
 
 import re
 import subprocess
+import threading
 
 from PyQt4 import QtCore
 from PyQt4 import QtGui
@@ -12,6 +13,8 @@ from cola.i18n import N_
 from cola import qtutils
 from cola import utils
 from cola.models import main
+from cola.models.completion import CompletionIndex
+from cola.models.completion import path_index
 from cola.widgets import defs
 from cola.compat import ustr
 
@@ -186,22 +189,72 @@ class CompletionLineEdit(QtGui.QLineEdit):
 
 
 class GatherCompletionsThread(QtCore.QThread):
+    """Gathers completions for the most recent request
+
+    Each request carries a generation number.  A request that arrives
+    while an older one is being gathered cancels the older one, which
+    stops scanning and is never reported.  The thread exits once there
+    are no more requests and is started again by the next one, so that
+    no idle thread is left behind by a completer that is never disposed.
+
+    """
+
     def __init__(self, model):
         QtCore.QThread.__init__(self)
         self.model = model
-        self.case_sensitive = False
+        self._lock = threading.Lock()
+        self._request = None
+        self._generation = 0
+        self._quit = False
+        self._active = False
+        """Whether run() will service the pending request"""
+
+    def request(self, generation, text, case_sensitive):
+        with self._lock:
+            self._generation = generation
+            self._request = (generation, text, case_sensitive)
+            start = not self._active
+            self._active = True
+        if start:
+            # An exiting run() may not have returned yet
+            self.wait()
+            self.start()
+
+    def stop(self):
+        with self._lock:
+            self._quit = True
+        self.wait()
+
+    def is_stale(self, generation):
+        return self._quit or generation != self._generation
 
     def run(self):
-        text = None
-        # Loop when the matched text changes between the start and end time.
-        # This happens when gather_matches() takes too long and the
-        # model's matched_text changes in-between.
-        while text != self.model.matched_text:
-            text = self.model.matched_text
-            items = self.model.gather_matches(self.case_sensitive)
-
-        if text is not None:
-            self.emit(SIGNAL('items_gathered'), items)
+        model = self.model
+        while True:
+            with self._lock:
+                if self._request is None or self._quit:
+                    self._active = False
+                    return
+                generation, text, case_sensitive = self._request
+                self._request = None
+
+            cancel = lambda: self.is_stale(generation)
+            refs = model.gather_refs(text, case_sensitive, cancel)
+            if cancel():
+                continue
+            if not model.completes_paths:
+                self.emit(SIGNAL('items_gathered'),
+                          generation, text, refs, (), set())
+                continue
+            # The refs are shown while the paths are being searched
+            if refs:
+                self.emit(SIGNAL('items_gathered'),
+                          generation, text, refs, (), set())
+            paths, dirs = model.gather_paths(text, case_sensitive, cancel)
+            if cancel():
+                continue
+            self.emit(SIGNAL('items_gathered'),
+                      generation, text, refs, paths, dirs)
 
 
 class HighlightDelegate(QtGui.QStyledItemDelegate):
@@ -270,73 +323,145 @@ class HighlightDelegate(QtGui.QStyledItemDelegate):
         painter.restore()
 
 
-class CompletionModel(QtGui.QStandardItemModel):
+class CompletionModel(QtCore.QAbstractListModel):
+    """A list of completions that is filled in off the main thread
+
+    Only the rows the popup has asked for are exposed; the rest are
+    handed out in batches through fetchMore() as the popup scrolls.
+
+    """
+    completes_paths = False
+    """Indicates that gather_paths() is used"""
+
+    batch_size = 64
+    """The number of rows exposed at a time"""
+
+    debounce_ms = 50
+    """Typing pauses for this long before completions are gathered"""
+
+    KIND_REF = 0
+    KIND_FILE = 1
+    KIND_DIR = 2
 
     def __init__(self, parent):
-        QtGui.QStandardItemModel.__init__(self, parent)
+        QtCore.QAbstractListModel.__init__(self, parent)
         self.matched_text = ''
         self.case_sensitive = False
+        self.generation = 0
+        self.entries = []
+        """(text, kind) tuples for every completion"""
+        self.visible = 0
+        """The number of entries exposed to views"""
+        self.icons = {}
 
         self.update_thread = GatherCompletionsThread(self)
         self.connect(self.update_thread, SIGNAL('items_gathered'),
                      self.apply_matches)
 
-    def lower_completion_key(self, x):
-        return x.replace('.','').lower()
-
-    def completion_key(self, x):
-        return x.replace('.','')
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.debounce_ms)
+        self.connect(self.timer, SIGNAL('timeout()'), self.request_matches)
 
     def update(self):
-        case_sensitive = self.update_thread.case_sensitive
-        self.update_matches(case_sensitive)
+        self.update_matches(self.case_sensitive)
 
     def set_match_text(self, matched_text, case_sensitive):
+        """Gather completions once typing pauses"""
         self.matched_text = matched_text
-        self.update_matches(case_sensitive)
+        self.case_sensitive = case_sensitive
+        self.timer.start()
 
     def update_matches(self, case_sensitive):
+        """Gather completions right away"""
         self.case_sensitive = case_sensitive
-        self.update_thread.case_sensitive = case_sensitive
-        if not self.update_thread.isRunning():
-            self.update_thread.start()
-
-    def gather_matches(self, case_sensitive):
-        return ((), (), set())
-
-    def apply_matches(self, match_tuple):
-        self.match_tuple = match_tuple
-        matched_refs, matched_paths, dirs = match_tuple
-        QStandardItem = QtGui.QStandardItem
-        file_icon = qtutils.file_icon()
-        dir_icon = qtutils.dir_icon()
-        git_icon = qtutils.git_icon()
-
-        matched_text = self.matched_text
-        items = []
-        for ref in matched_refs:
-            item = QStandardItem()
-            item.setText(ref)
-            item.setIcon(git_icon)
-            items.append(item)
+        self.timer.stop()
+        self.request_matches()
+
+    def request_matches(self):
+        self.generation += 1
+        self.update_thread.request(self.generation,
+                                   self.matched_text, self.case_sensitive)
+
+    def gather_refs(self, text, case_sensitive, cancel):
+        return []
 
+    def gather_paths(self, text, case_sensitive, cancel):
+        return ([], set())
+
+    def gather_matches(self, text, case_sensitive, cancel=lambda: False):
+        """Return the (refs, paths, dirs) matching text"""
+        refs = self.gather_refs(text, case_sensitive, cancel)
+        if not self.completes_paths:
+            return (refs, [], set())
+        paths, dirs = self.gather_paths(text, case_sensitive, cancel)
+        return (refs, paths, dirs)
+
+    def apply_matches(self, generation, matched_text,
+                      matched_refs, matched_paths, dirs):
+        if generation != self.generation:
+            return # superseded by a newer request
+        entries = [(ref, self.KIND_REF) for ref in matched_refs]
         if matched_paths and (not matched_text or matched_text in '--'):
-            item = QStandardItem()
-            item.setText('--')
-            item.setIcon(file_icon)
-            items.append(item)
-
-        for match in matched_paths:
-            item = QStandardItem()
-            item.setText(match)
-            if match in dirs:
-                item.setIcon(dir_icon)
+            entries.append(('--', self.KIND_FILE))
+        for path in matched_paths:
+            if path in dirs:
+                entries.append((path, self.KIND_DIR))
             else:
-                item.setIcon(file_icon)
-            items.append(item)
+                entries.append((path, self.KIND_FILE))
 
-        self.clear()
-        self.invisibleRootItem().appendRows(items)
+        self.beginResetModel()
+        self.entries = entries
+        self.visible = min(len(entries), self.batch_size)
+        self.endResetModel()
+
+    def dispose(self):
+        self.timer.stop()
+        self.update_thread.stop()
+
+    def icon(self, kind):
+        try:
+            return self.icons[kind]
+        except KeyError:
+            if kind == self.KIND_REF:
+                icon = qtutils.git_icon()
+            elif kind == self.KIND_DIR:
+                icon = qtutils.dir_icon()
+            else:
+                icon = qtutils.file_icon()
+            self.icons[kind] = icon
+            return icon
+
+    # Qt model API
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.visible
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.visible < len(self.entries)
+
+    def fetchMore(self, parent):
+        if parent.isValid():
+            return
+        count = min(self.batch_size, len(self.entries) - self.visible)
+        if count <= 0:
+            return
+        self.beginInsertRows(parent, self.visible, self.visible + count - 1)
+        self.visible += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        if not index.isValid() or row >= self.visible:
+            return QtCore.QVariant()
+        text, kind = self.entries[row]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return QtCore.QVariant(text)
+        if role == Qt.DecorationRole:
+            return QtCore.QVariant(self.icon(kind))
+        return QtCore.QVariant()
 
 
 class Completer(QtGui.QCompleter):
@@ -365,29 +490,18 @@ class GitCompletionModel(CompletionModel):
     def __init__(self, parent):
         CompletionModel.__init__(self, parent)
         self.main_model = model = main.model()
+        self.ref_index = CompletionIndex(separator=None)
         msg = model.message_updated
         model.add_observer(msg, self.emit_update)
 
-    def gather_matches(self, case_sensitive):
-        if case_sensitive:
-            transform = lambda x: x
-            keyfunc = self.completion_key
-        else:
-            transform = lambda x: x.lower()
-            keyfunc = self.lower_completion_key
-
-        matched_text = self.matched_text
-        if matched_text:
-            matched_refs = [r for r in self.matches()
-                            if transform(matched_text) in transform(r)]
-            # if we match nothing, still offer to complete something
-            if not matched_refs:
-                matched_refs = self.matches()
-        else:
-            matched_refs = self.matches()
-
-        matched_refs.sort(key=keyfunc)
-        return (matched_refs, (), set())
+    def gather_refs(self, text, case_sensitive, cancel):
+        self.ref_index.update(self.matches())
+        matched_refs = self.ref_index.query(text, case_sensitive,
+                                            cancel=cancel)
+        # if we match nothing, still offer to complete something
+        if text and not matched_refs and not cancel():
+            matched_refs = self.ref_index.query('', case_sensitive)
+        return matched_refs
 
     def emit_update(self):
         self.emit(SIGNAL('update()'))
@@ -396,6 +510,7 @@ class GitCompletionModel(CompletionModel):
         return []
 
     def dispose(self):
+        CompletionModel.dispose(self)
         self.main_model.remove_observer(self.emit_update)
 
 
@@ -434,36 +549,19 @@ class GitRemoteBranchCompletionModel(GitCompletionModel):
 
 class GitLogCompletionModel(GitRefCompletionModel):
     """Completer for arguments suitable for git-log like commands"""
+    completes_paths = True
 
     def __init__(self, parent):
         GitRefCompletionModel.__init__(self, parent)
 
-    def gather_matches(self, case_sensitive):
-        (matched_refs, dummy_paths, dummy_dirs) =\
-                GitRefCompletionModel.gather_matches(self, case_sensitive)
-
-        file_list = self.main_model.everything()
-        files = set(file_list)
-        files_and_dirs = utils.add_parents(set(files))
-
-        if case_sensitive:
-            transform = lambda x: x
-            keyfunc = self.completion_key
-        else:
-            transform = lambda x: x.lower()
-            keyfunc = self.lower_completion_key
-
-        dirs = files_and_dirs.difference(files)
-        matched_text = self.matched_text
-        if matched_text:
-            matched_paths = [f for f in files_and_dirs
-                             if transform(matched_text) in transform(f)]
-        else:
-            matched_paths = list(files_and_dirs)
-
-        matched_paths.sort(key=keyfunc)
-
-        return (matched_refs, matched_paths, dirs)
+    def gather_paths(self, text, case_sensitive, cancel):
+        # The index is shared and only re-reads the tracked files
+        # when .git/index changes
+        paths = path_index()
+        paths.refresh(self.main_model.untracked)
+        matched_paths = paths.query(text, case_sensitive, cancel=cancel)
+        dirs = set([path for path in matched_paths if path in paths.dirs])
+        return (matched_paths, dirs)
 
 
 def bind_lineedit(model):
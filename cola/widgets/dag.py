@@ -1,6 +1,5 @@
 from __future__ import division, absolute_import, unicode_literals
 
-import collections
 import math
 
 from PyQt4 import QtGui
@@ -12,11 +11,16 @@ from PyQt4.QtCore import QRectF
 
 from cola import cmds
 from cola import difftool
+from cola import gravatar
 from cola import observable
 from cola import qtutils
+from cola.git import git
 from cola.i18n import N_
 from cola.models.dag import DAG
 from cola.models.dag import RepoReader
+from cola.models.dag import SpatialIndex
+from cola.models import avatars
+from cola.models import graphlayout
 from cola.widgets import completion
 from cola.widgets import defs
 from cola.widgets.createbranch import create_new_branch
@@ -549,14 +553,14 @@ class GitDAG(MainWindow):
         self.commits.clear()
         self.commit_list = []
 
-    def add_commits(self, commits):
+    def add_commits(self, commits, positions):
         self.commit_list.extend(commits)
         # Keep track of commits
         for commit_obj in commits:
             self.commits[commit_obj.sha1] = commit_obj
             for tag in commit_obj.tags:
                 self.commits[tag] = commit_obj
-        self.graphview.add_commits(commits)
+        self.graphview.add_commits(commits, positions)
         self.treewidget.add_commits(commits)
 
     def thread_done(self):
@@ -606,9 +610,21 @@ class ReaderThread(QtCore.QThread):
         self._condition = QtCore.QWaitCondition()
 
     def run(self):
-        repo = RepoReader(self.dag)
+        # Only the DAG window uses the commit cache, which holds a
+        # single history
+        repo = RepoReader(self.dag, cache=True)
         repo.reset()
+        # Commits are laid out here rather than in the GUI thread.
+        # The layout of the previous run is reused for as long as the
+        # same commits are read.
+        layout_path = git.git_path('cola-dag-layout.cache')
+        layout = graphlayout.load(layout_path)
+        if (layout is None or layout.x_off != GraphView.x_off or
+                layout.y_off != GraphView.y_off):
+            layout = graphlayout.GraphLayout(x_off=GraphView.x_off,
+                                             y_off=GraphView.y_off)
         commits = []
+        prefetched = False
         for c in repo:
             self._mutex.lock()
             if self._stop:
@@ -619,13 +635,27 @@ class ReaderThread(QtCore.QThread):
                 return
             commits.append(c)
             if len(commits) >= 512:
-                self.emit(self.commits_ready, commits)
+                if not prefetched:
+                    self.prefetch_avatars(commits)
+                    prefetched = True
+                self.emit(self.commits_ready, commits,
+                          layout.add_commits(commits))
                 commits = []
 
         if commits:
-            self.emit(self.commits_ready, commits)
+            if not prefetched:
+                self.prefetch_avatars(commits)
+            self.emit(self.commits_ready, commits, layout.add_commits(commits))
+        layout.truncate(layout.placed)
+        if layout.changed:
+            graphlayout.save(layout_path, layout)
         self.emit(self.done)
 
+    def prefetch_avatars(self, commits):
+        # The authors of the newest commits are the likeliest to be shown
+        emails = [c.email for c in commits]
+        avatars.instance().prefetch(emails, gravatar.GravatarLabel.imgsize)
+
     def start(self):
         self._abort = False
         self._stop = False
@@ -654,15 +684,23 @@ class Cache(object):
 class Edge(QtGui.QGraphicsItem):
     item_type = QtGui.QGraphicsItem.UserType + 1
 
-    def __init__(self, source, dest):
+    def __init__(self, source, dest, color=None):
 
         QtGui.QGraphicsItem.__init__(self)
 
         self.setAcceptedMouseButtons(Qt.NoButton)
+        self.setZValue(-2)
+        self.set_nodes(source, dest, color=color)
+
+    def set_nodes(self, source, dest, color=None):
+        """Connect the edge to a pair of commit items
+
+        The color is chosen automatically unless one is given.
+        """
+        self.prepareGeometryChange()
         self.source = source
         self.dest = dest
         self.commit = source.commit
-        self.setZValue(-2)
 
         dest_pt = Commit.item_bbox.center()
 
@@ -676,16 +714,15 @@ class Edge(QtGui.QGraphicsItem):
         self.bound = rect.normalized()
 
         # Choose a new color for new branch edges
-        if self.source.x() < self.dest.x():
+        line = Qt.SolidLine
+        if color is not None:
+            pass
+        elif self.source.x() < self.dest.x():
             color = EdgeColor.next()
-            line = Qt.SolidLine
-        elif self.source.x() != self.dest.x():
-            color = EdgeColor.current()
-            line = Qt.SolidLine
         else:
             color = EdgeColor.current()
-            line = Qt.SolidLine
 
+        self.color = color
         self.pen = QtGui.QPen(color, 4.0, line, Qt.SquareCap, Qt.RoundJoin)
 
     # Qt overrides
@@ -814,21 +851,28 @@ class Commit(QtGui.QGraphicsItem):
     def __init__(self, commit,
                  notifier,
                  selectable=QtGui.QGraphicsItem.ItemIsSelectable,
-                 cursor=Qt.PointingHandCursor,
-                 xpos=commit_radius/2.0 + 1.0,
-                 cached_commit_color=commit_color,
-                 cached_merge_color=merge_color):
+                 cursor=Qt.PointingHandCursor):
 
         QtGui.QGraphicsItem.__init__(self)
 
-        self.commit = commit
         self.notifier = notifier
+        self.label = None
 
         self.setZValue(0)
         self.setFlag(selectable)
         self.setCursor(cursor)
+        self.set_commit(commit)
+
+    def set_commit(self, commit,
+                   xpos=commit_radius/2.0 + 1.0,
+                   cached_commit_color=commit_color,
+                   cached_merge_color=merge_color):
+        """Display a commit; used when recycling items"""
+        self.commit = commit
         self.setToolTip(commit.sha1[:7] + ': ' + commit.summary)
 
+        if self.label is not None:
+            self.label.setParentItem(None)
         if commit.tags:
             self.label = label = Label(commit)
             label.setParentItem(self)
@@ -840,6 +884,7 @@ class Commit(QtGui.QGraphicsItem):
             self.brush = cached_merge_color
         else:
             self.brush = cached_commit_color
+        self.commit_pen = Commit.commit_pen
 
         self.pressed = False
         self.dragged = False
@@ -996,6 +1041,13 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
     x_off = 18
     y_off = 24
 
+    # Graphs with more commits than this only create items for the
+    # region being shown (see update_visible())
+    virtual_threshold = 10000
+    # When more rows than this are shown an overview is drawn instead
+    max_visible_items = 2500
+    max_overview_points = 20000
+
     def __init__(self, notifier, parent):
         QtGui.QGraphicsView.__init__(self, parent)
         ViewerMixin.__init__(self)
@@ -1010,7 +1062,22 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         self.items = {}
         self.saved_matrix = QtGui.QMatrix(self.matrix())
 
-        self.x_offsets = collections.defaultdict(int)
+        self.index = SpatialIndex()
+        self.virtual = False
+        self.overview = False
+        self.edge_items = {}
+        self.edge_colors = {}
+        self.commit_pool = []
+        self.edge_pool = []
+        self.overview_pen = QtGui.QPen(EdgeColor.colors[0])
+        self.overview_pen.setWidth(3)
+        self.overview_pen.setCosmetic(True)
+
+        self.visible_timer = QtCore.QTimer(self)
+        self.visible_timer.setSingleShot(True)
+        self.visible_timer.setInterval(0)
+        self.connect(self.visible_timer, SIGNAL('timeout()'),
+                     self.update_visible)
 
         self.is_panning = False
         self.pressed = False
@@ -1057,10 +1124,16 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         self.scene().clear()
         self.selection_list = []
         self.items.clear()
-        self.x_offsets.clear()
         self.x_max = 0
         self.y_min = 0
         self.commits = []
+        self.index = SpatialIndex()
+        self.virtual = False
+        self.overview = False
+        self.edge_items.clear()
+        self.edge_colors.clear()
+        self.commit_pool = []
+        self.edge_pool = []
 
     # ViewerMixin interface
     def selected_items(self):
@@ -1082,9 +1155,8 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         """Select the item for the SHA-1"""
         self.scene().clearSelection()
         for sha1 in sha1s:
-            try:
-                item = self.items[sha1]
-            except KeyError:
+            item = self.item(sha1)
+            if item is None:
                 continue
             item.blockSignals(True)
             item.setSelected(True)
@@ -1102,10 +1174,7 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
                     criteria_fn(generation, commit.generation)):
                 sha1 = commit.sha1
                 generation = commit.generation
-        try:
-            return self.items[sha1]
-        except KeyError:
-            return None
+        return self.item(sha1)
 
     def oldest_item(self, commits):
         """Return the item for the commit with the oldest generation number"""
@@ -1182,11 +1251,10 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
 
     def set_initial_view(self):
         self_commits = self.commits
-        self_items = self.items
 
         commits = self_commits[-2:]
-        items = [self_items[c.sha1] for c in commits]
-        self.fit_view_to_items(items)
+        items = [self.item(c.sha1) for c in commits]
+        self.fit_view_to_items([item for item in items if item is not None])
 
     def zoom_to_fit(self):
         """Fit selected items into the viewport"""
@@ -1195,7 +1263,9 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         self.fit_view_to_items(items)
 
     def fit_view_to_items(self, items):
-        if not items:
+        if not items and self.virtual:
+            rect = self.scene().sceneRect()
+        elif not items:
             rect = self.scene().itemsBoundingRect()
         else:
             maxint = 9223372036854775807
@@ -1221,6 +1291,7 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         rect.setWidth(rect.width() + x_adjust*2)
         self.fitInView(rect, Qt.KeepAspectRatio)
         self.scene().invalidate()
+        self.update_visible_later()
 
     def save_selection(self, event):
         if event.button() != Qt.LeftButton:
@@ -1266,6 +1337,7 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         matrix = QtGui.QMatrix(self.saved_matrix).translate(tx, ty)
         self.setTransformationAnchor(QtGui.QGraphicsView.NoAnchor)
         self.setMatrix(matrix)
+        self.update_visible_later()
 
     def wheel_zoom(self, event):
         """Handle mouse wheel zooming."""
@@ -1279,6 +1351,7 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
         self.setTransformationAnchor(QtGui.QGraphicsView.AnchorUnderMouse)
         self.zoom = zoom
         self.scale(zoom, zoom)
+        self.update_visible_later()
 
     def wheel_pan(self, event):
         """Handle mouse wheel panning."""
@@ -1296,6 +1369,7 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
             matrix = self.matrix().translate(s*factor, 0)
         self.setTransformationAnchor(QtGui.QGraphicsView.NoAnchor)
         self.setMatrix(matrix)
+        self.update_visible_later()
 
     def scale_view(self, scale):
         factor = (self.matrix().scale(scale, scale)
@@ -1329,10 +1403,26 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
             range_ = max_ - min_
             value = min_ + int(float(range_) * scrolloffset)
             scrollbar.setValue(value)
+        self.update_visible_later()
 
-    def add_commits(self, commits):
-        """Traverse commits and add them to the view."""
+    def add_commits(self, commits, positions):
+        """Add commits laid out by a GraphLayout to the view."""
         self.commits.extend(commits)
+        index = self.index
+        for commit in commits:
+            x, y = positions[commit.sha1]
+            index.add(commit, x, y)
+            self.x_max = max(self.x_max, x)
+            self.y_min = min(self.y_min, y)
+
+        if not self.virtual and len(index) > self.virtual_threshold:
+            self.set_virtual()
+        if self.virtual:
+            self.update_scene_rect()
+            self.resetCachedContent()
+            self.update_visible_later()
+            return
+
         scene = self.scene()
         for commit in commits:
             item = Commit(commit, self.notifier)
@@ -1341,9 +1431,112 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
                 self.items[ref] = item
             scene.addItem(item)
 
-        self.layout_commits(commits)
+        self.layout_commits(positions)
         self.link(commits)
 
+    def set_virtual(self):
+        """Switch to creating items for the visible region only"""
+        selected = [item.commit.sha1 for item in self.selected_items()]
+        self.notifier.notification_enabled = False
+        self.scene().clear()
+        self.notifier.notification_enabled = True
+        self.items.clear()
+        self.virtual = True
+        self.select(selected)
+
+    def item(self, sha1):
+        """Return the item for a commit, creating it when virtualized"""
+        item = self.items.get(sha1)
+        if item is None and self.virtual:
+            row = self.index.rows.get(sha1)
+            if row is not None:
+                item = self.add_commit_item(row)
+        return item
+
+    def add_commit_item(self, row):
+        commit = self.index.commits[row]
+        if self.commit_pool:
+            item = self.commit_pool.pop()
+            item.set_commit(commit)
+        else:
+            item = Commit(commit, self.notifier)
+        x, y = self.index.position(row)
+        item.setPos(x, y)
+        self.scene().addItem(item)
+        self.items[commit.sha1] = item
+        return item
+
+    def add_edge_item(self, key):
+        parent_row, child_row = key
+        commits = self.index.commits
+        parent_item = self.item(commits[parent_row].sha1)
+        child_item = self.item(commits[child_row].sha1)
+        color = self.edge_colors.get(key)
+        if self.edge_pool:
+            edge = self.edge_pool.pop()
+            edge.set_nodes(parent_item, child_item, color=color)
+        else:
+            edge = Edge(parent_item, child_item, color=color)
+        self.edge_colors[key] = edge.color
+        self.scene().addItem(edge)
+        self.edge_items[key] = edge
+
+    def update_visible_later(self):
+        if self.virtual:
+            self.visible_timer.start()
+
+    def update_visible(self):
+        """Create items for the region being shown and recycle the rest
+
+        Selected items are kept so that the selection survives
+        scrolling.  When too many rows are shown an overview is drawn
+        by drawBackground() instead.
+
+        """
+        if not self.virtual:
+            return
+        index = self.index
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        margin = rect.height() / 2.0
+        start, end = index.row_range(rect.top() - margin,
+                                     rect.bottom() + margin)
+
+        overview = end - start > self.max_visible_items
+        if overview != self.overview:
+            self.overview = overview
+            self.resetCachedContent()
+            self.viewport().update()
+        if overview:
+            edges = set()
+            rows = set()
+        else:
+            edges = set(index.edges(start, end))
+            rows = set(range(start, end))
+            for parent_row, child_row in edges:
+                rows.add(parent_row)
+                rows.add(child_row)
+        commits = index.commits
+        wanted = set([commits[row].sha1 for row in rows])
+
+        scene = self.scene()
+        for key, edge in list(self.edge_items.items()):
+            if key not in edges:
+                scene.removeItem(edge)
+                del self.edge_items[key]
+                self.edge_pool.append(edge)
+
+        for sha1, item in list(self.items.items()):
+            if sha1 not in wanted and not item.isSelected():
+                scene.removeItem(item)
+                del self.items[sha1]
+                self.commit_pool.append(item)
+
+        for row in rows:
+            self.item(commits[row].sha1)
+        for key in edges:
+            if key not in self.edge_items:
+                self.add_edge_item(key)
+
     def link(self, commits):
         """Create edges linking commits with their parents"""
         scene = self.scene()
@@ -1362,61 +1555,11 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
                 edge = Edge(parent_item, commit_item)
                 scene.addItem(edge)
 
-    def layout_commits(self, nodes):
-        positions = self.position_nodes(nodes)
+    def layout_commits(self, positions):
         for sha1, (x, y) in positions.items():
             item = self.items[sha1]
             item.setPos(x, y)
 
-    def position_nodes(self, nodes):
-        positions = {}
-
-        x_max = self.x_max
-        y_min = self.y_min
-        x_off = self.x_off
-        y_off = self.y_off
-        x_offsets = self.x_offsets
-
-        for node in nodes:
-            generation = node.generation
-            sha1 = node.sha1
-
-            if node.is_fork():
-                # This is a fan-out so sweep over child generations and
-                # shift them to the right to avoid overlapping edges
-                child_gens = [c.generation for c in node.children]
-                maxgen = max(child_gens)
-                for g in range(generation + 1, maxgen):
-                    x_offsets[g] += x_off
-
-            if len(node.parents) == 1:
-                # Align nodes relative to their parents
-                parent_gen = node.parents[0].generation
-                parent_off = x_offsets[parent_gen]
-                x_offsets[generation] = max(parent_off-x_off,
-                                            x_offsets[generation])
-
-            cur_xoff = x_offsets[generation]
-            next_xoff = cur_xoff
-            next_xoff += x_off
-            x_offsets[generation] = next_xoff
-
-            x_pos = cur_xoff
-            y_pos = -generation * y_off
-
-            y_pos = min(y_pos, y_min - y_off)
-
-            #y_pos = y_off
-            positions[sha1] = (x_pos, y_pos)
-
-            x_max = max(x_max, x_pos)
-            y_min = y_pos
-
-        self.x_max = x_max
-        self.y_min = y_min
-
-        return positions
-
     def update_scene_rect(self):
         y_min = self.y_min
         x_max = self.x_max
@@ -1435,6 +1578,29 @@ class GraphView(ViewerMixin, QtGui.QGraphicsView):
     def contextMenuEvent(self, event):
         self.context_menu_event(event)
 
+    def drawBackground(self, painter, rect):
+        QtGui.QGraphicsView.drawBackground(self, painter, rect)
+        if not self.overview:
+            return
+        # Draw a sample of the commits when zoomed too far out for items
+        index = self.index
+        start, end = index.row_range(rect.top(), rect.bottom())
+        step = max(1, (end - start) // self.max_overview_points)
+        points = QtGui.QPolygonF()
+        for row in range(start, end, step):
+            x, y = index.position(row)
+            points.append(QPointF(x, y))
+        painter.setPen(self.overview_pen)
+        painter.drawPoints(points)
+
+    def scrollContentsBy(self, dx, dy):
+        QtGui.QGraphicsView.scrollContentsBy(self, dx, dy)
+        self.update_visible_later()
+
+    def resizeEvent(self, event):
+        QtGui.QGraphicsView.resizeEvent(self, event)
+        self.update_visible_later()
+
     def mousePressEvent(self, event):
         if event.button() == Qt.MidButton:
             pos = event.pos()
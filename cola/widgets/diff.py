@@ -13,6 +13,8 @@ from cola.cmds import run
 from cola.i18n import N_
 from cola.models import main
 from cola.models import selection
+from cola.models.diffcache import diff_cache
+from cola.models.diffstore import DiffStore
 from cola.qtutils import add_action
 from cola.qtutils import create_action_button
 from cola.qtutils import create_menu
@@ -38,9 +40,21 @@ class DiffTextEdit(MonoTextView):
 
 class DiffEditor(DiffTextEdit):
 
+    large_diff_size = 1024 * 1024
+    """Diffs with more characters than this are shown a window at a time"""
+
+    window_lines = 2000
+    """The number of lines shown at a time for large diffs"""
+
     def __init__(self, parent):
         DiffTextEdit.__init__(self, parent)
         self.model = model = main.model()
+        self.store = None
+        """The DiffStore of a large diff, or None"""
+        self._text = ''
+        self._window = (0, 0)
+        self._window_offset = 0
+        self._moving_window = False
 
         # "Diff Options" tool menu
         self.diff_ignore_space_at_eol_action = add_action(self,
@@ -124,6 +138,8 @@ class DiffEditor(DiffTextEdit):
                      self.enable_selection_actions)
 
         self.connect(self, SIGNAL('set_text'), self.setPlainText)
+        self.connect(self.verticalScrollBar(), SIGNAL('valueChanged(int)'),
+                     self._scrolled)
 
     def _emit_text(self, text):
         self.emit(SIGNAL('set_text'), text)
@@ -247,7 +263,16 @@ class DiffEditor(DiffTextEdit):
             return
 
         offset, selection_text = self.offset_and_selection()
-        old_text = ustr(self.toPlainText())
+        old_text = self._text
+        self._text = text
+
+        if len(text) > self.large_diff_size:
+            if self.store is None or text != old_text:
+                self._set_large_text(text, selection_text)
+            return
+        self.store = None
+        self._window = (0, 0)
+        self._window_offset = 0
 
         DiffTextEdit.setPlainText(self, text)
 
@@ -272,11 +297,76 @@ class DiffEditor(DiffTextEdit):
             scrollbar.setValue(scrollvalue)
 
     def offset_and_selection(self):
+        """Return the cursor's offset into the diff and the selected text"""
         cursor = self.textCursor()
-        offset = cursor.position()
+        offset = cursor.position() + self._window_offset
         selection_text = ustr(cursor.selection().toPlainText())
         return offset, selection_text
 
+    # Large diffs
+
+    def _set_large_text(self, text, selection_text):
+        """Show a large diff a window of lines at a time
+
+        The line at the top of the viewport stays there, and the old
+        selection is re-selected when it is part of the new window.
+
+        """
+        top = self._top_line()
+        self.store = DiffStore(text)
+        selection = None
+        if selection_text:
+            idx = text.find(selection_text)
+            if idx >= 0:
+                selection = (idx, idx + len(selection_text))
+        self._show_window(top, top, selection=selection)
+
+    def _show_window(self, first, top, selection=None):
+        """Show the lines around `first` and scroll line `top` into view
+
+        `selection` is a pair of offsets into the diff to select.
+
+        """
+        start, end = self.store.window(first, self.window_lines)
+        self._window = (start, end)
+        self._window_offset = window_offset = self.store.offset(start)
+        self._moving_window = True
+        try:
+            DiffTextEdit.setPlainText(self, self.store.lines(start, end))
+            if selection is not None:
+                sel_start, sel_end = selection
+                if (sel_start >= window_offset and
+                        sel_end <= self.store.offset(end)):
+                    cursor = self.textCursor()
+                    cursor.setPosition(sel_start - window_offset)
+                    cursor.setPosition(sel_end - window_offset,
+                                       QtGui.QTextCursor.KeepAnchor)
+                    self.setTextCursor(cursor)
+            document = self.document()
+            block = document.findBlockByNumber(max(0, top - start))
+            rect = document.documentLayout().blockBoundingRect(block)
+            self.verticalScrollBar().setValue(int(rect.top()))
+        finally:
+            self._moving_window = False
+
+    def _top_line(self):
+        """Return the diff's line number at the top of the viewport"""
+        cursor = self.cursorForPosition(QtCore.QPoint(0, 0))
+        return self._window[0] + cursor.blockNumber()
+
+    def _scrolled(self, value):
+        """Move the window when scrolling reaches one of its ends"""
+        if self.store is None or self._moving_window:
+            return
+        scrollbar = self.verticalScrollBar()
+        start, end = self._window
+        if value >= scrollbar.maximum() and end < self.store.line_count():
+            top = self._top_line()
+            self._show_window(top - self.window_lines // 4, top)
+        elif value <= scrollbar.minimum() and start > 0:
+            top = self._top_line()
+            self._show_window(top - self.window_lines * 3 // 4, top)
+
     # Mutators
     def enable_selection_actions(self, enabled):
         self.action_apply_selection.setEnabled(enabled)
@@ -354,6 +444,9 @@ class DiffEditor(DiffTextEdit):
 
 class DiffWidget(QtGui.QWidget):
 
+    max_prefetch = 4
+    """The number of neighbouring commits prefetched on selection"""
+
     def __init__(self, notifier, parent):
         QtGui.QWidget.__init__(self, parent)
 
@@ -391,6 +484,8 @@ class DiffWidget(QtGui.QWidget):
         self.diff = DiffTextEdit(self, whitespace=False)
         self.tasks = set()
         self.reflector = QtCore.QObject(self)
+        self.generation = 0
+        """Counts the diffs asked for so that stale results are dropped"""
 
         self.info_layout = QtGui.QVBoxLayout()
         self.info_layout.setMargin(defs.no_margin)
@@ -414,7 +509,7 @@ class DiffWidget(QtGui.QWidget):
 
         notifier.add_observer(COMMITS_SELECTED, self.commits_selected)
         notifier.add_observer(FILES_SELECTED, self.files_selected)
-        self.connect(self.reflector, SIGNAL('diff'), self.diff.setText)
+        self.connect(self.reflector, SIGNAL('diff'), self.set_diff)
         self.connect(self.reflector, SIGNAL('task_done'), self.task_done)
 
     def task_done(self, task):
@@ -423,11 +518,39 @@ class DiffWidget(QtGui.QWidget):
         except:
             pass
 
+    def start_task(self, task, priority=0):
+        self.tasks.add(task)
+        QtCore.QThreadPool.globalInstance().start(task, priority)
+
+    def is_stale(self, generation):
+        """Return True when a newer diff has been asked for"""
+        return generation != self.generation
+
+    def set_diff(self, generation, diff):
+        # Results for earlier selections are cached but not shown
+        if not self.is_stale(generation):
+            self.diff.setText(diff)
+
     def set_diff_sha1(self, sha1, filename=None):
+        self.generation += 1
+        cache = diff_cache()
+        diff = cache.get(cache.key(sha1, filename=filename))
+        if diff is not None:
+            self.diff.setText(diff)
+            return
         self.diff.setText('+++ ' + N_('Loading...'))
-        task = DiffInfoTask(sha1, self.reflector, filename=filename)
-        self.tasks.add(task)
-        QtCore.QThreadPool.globalInstance().start(task)
+        self.start_task(DiffInfoTask(sha1, self.generation, self.reflector,
+                                     self.is_stale, filename=filename))
+
+    def prefetch(self, commits):
+        """Fill the cache with the diffs of the commits in the background"""
+        cache = diff_cache()
+        for commit in commits[:self.max_prefetch]:
+            if cache.key(commit.sha1) in cache:
+                continue
+            self.start_task(DiffPrefetchTask(commit.sha1, self.generation,
+                                             self.reflector, self.is_stale),
+                            priority=-1)
 
     def commits_selected(self, commits):
         if len(commits) != 1:
@@ -457,6 +580,8 @@ class DiffWidget(QtGui.QWidget):
 
         self.set_diff_sha1(self.sha1)
         self.gravatar_label.set_email(email)
+        # Moving to the next or previous commit is the likely next step
+        self.prefetch(commit.parents + commit.children)
 
     def files_selected(self, filenames):
         if not filenames:
@@ -515,12 +640,26 @@ class TextLabel(QtGui.QLabel):
 
 class DiffInfoTask(QtCore.QRunnable):
 
-    def __init__(self, sha1, reflector, filename=None):
+    def __init__(self, sha1, generation, reflector, is_stale, filename=None):
         QtCore.QRunnable.__init__(self)
         self.sha1 = sha1
+        self.generation = generation
         self.reflector = reflector
+        self.is_stale = is_stale
         self.filename = filename
 
     def run(self):
-        diff = gitcmds.diff_info(self.sha1, filename=self.filename)
-        self.reflector.emit(SIGNAL('diff'), diff)
+        # Tasks for selections that were left before they started are
+        # dropped without running git
+        if not self.is_stale(self.generation):
+            diff = diff_cache().diff_info(self.sha1, filename=self.filename)
+            self.reflector.emit(SIGNAL('diff'), self.generation, diff)
+        self.reflector.emit(SIGNAL('task_done'), self)
+
+
+class DiffPrefetchTask(DiffInfoTask):
+
+    def run(self):
+        if not self.is_stale(self.generation):
+            diff_cache().diff_info(self.sha1)
+        self.reflector.emit(SIGNAL('task_done'), self)
@@ -1,5 +1,7 @@
 from __future__ import division, absolute_import, unicode_literals
 
+import threading
+
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 from PyQt4.QtCore import Qt
@@ -9,8 +11,8 @@ from cola import cmds
 from cola import utils
 from cola import qtutils
 from cola.cmds import do
-from cola.git import git
 from cola.i18n import N_
+from cola.models.grep import GrepProcess
 from cola.qtutils import diff_font
 from cola.widgets import defs
 from cola.widgets.standard import Dialog
@@ -33,6 +35,14 @@ def new_grep(text=None, parent=None):
     return widget
 
 
+def shell_split(text):
+    """Split text with shell syntax, tolerating unclosed quotes as typed"""
+    try:
+        return utils.shell_split(text)
+    except ValueError:
+        return [text]
+
+
 def goto_grep(line):
     """Called when Search -> Grep's right-click 'goto' action."""
     filename, line_number, contents = line.split(':', 2)
@@ -40,26 +50,119 @@ def goto_grep(line):
 
 
 class GrepThread(QtCore.QThread):
+    """Streams the output of the most recent search
+
+    A search that arrives while an older one is running kills the older
+    "git grep".  Output is emitted a chunk of lines at a time and reading
+    pauses after `max_results` lines until load_more() is called, which
+    leaves git blocked on the pipe rather than buffering its output.
+
+    """
+
+    max_results = 1000
+    """The number of lines shown before more are asked for"""
 
     def __init__(self, parent):
         QtCore.QThread.__init__(self, parent)
-        self.query = None
-        self.shell = False
-        self.regexp_mode = '--basic-regexp'
+        self._cond = threading.Condition()
+        self._request = None
+        self._generation = 0
+        self._limit = 0
+        self._process = None
+        self._quit = False
+
+    def search(self, query, shell=False, regexp_mode='--basic-regexp',
+               pathspecs=None):
+        """Start a search and return its generation number"""
+        with self._cond:
+            self._generation += 1
+            generation = self._generation
+            self._request = (generation, query, shell, regexp_mode,
+                             pathspecs or [])
+            self._limit = self.max_results
+            process = self._process
+            self._cond.notify()
+        if process is not None:
+            process.kill()
+        if not self.isRunning():
+            self.start()
+        return generation
+
+    def cancel(self):
+        """Stop the running search without starting another"""
+        with self._cond:
+            self._generation += 1
+            self._request = None
+            process = self._process
+            self._cond.notify()
+        if process is not None:
+            process.kill()
+
+    def load_more(self):
+        with self._cond:
+            self._limit += self.max_results
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._quit = True
+            process = self._process
+            self._cond.notify()
+        if process is not None:
+            process.kill()
+        self.wait()
+
+    def is_stale(self, generation):
+        return self._quit or generation != self._generation
 
     def run(self):
-        if self.query is None:
-            return
-        query = self.query
-        if self.shell:
-            args = utils.shell_split(query)
-        else:
-            args = [query]
-        status, out, err = git.grep(self.regexp_mode, n=True, *args)
-        if query == self.query:
-            self.emit(SIGNAL('result'), status, out, err)
-        else:
-            self.run()
+        while True:
+            with self._cond:
+                while self._request is None and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    return
+                generation, query, shell, regexp_mode, pathspecs = \
+                        self._request
+                self._request = None
+                if shell:
+                    args = shell_split(query)
+                else:
+                    args = [query]
+                process = self._process = GrepProcess(
+                        args, regexp_mode=regexp_mode, pathspecs=pathspecs)
+            try:
+                completed = self.stream(generation, process)
+            finally:
+                with self._cond:
+                    self._process = None
+            if completed:
+                self.emit(SIGNAL('result'),
+                          generation, process.status, process.err)
+
+    def stream(self, generation, process):
+        """Emit the output of a search, returning False once it is stale"""
+        shown = 0
+        chunks = process.chunks()
+        try:
+            for lines in chunks:
+                while lines:
+                    with self._cond:
+                        if shown >= self._limit:
+                            self.emit(SIGNAL('more_available'), generation)
+                            while (shown >= self._limit and
+                                    not self.is_stale(generation)):
+                                self._cond.wait()
+                        if self.is_stale(generation):
+                            return False
+                        room = self._limit - shown
+                    batch = lines[:room]
+                    lines = lines[room:]
+                    shown += len(batch)
+                    self.emit(SIGNAL('lines'), generation, batch)
+        finally:
+            chunks.close()
+        return not self.is_stale(generation)
 
 
 class Grep(Dialog):
@@ -96,6 +199,12 @@ class Grep(Dialog):
         combo.setItemData(1, '--extended-regexp', Qt.UserRole)
         combo.setItemData(2, '--fixed-strings', Qt.UserRole)
 
+        self.pathspec_txt = HintedLineEdit(N_('paths'), self)
+        self.pathspec_txt.setToolTip(
+                N_('Limit the search to these paths.\n'
+                   'Paths with spaces will require "double quotes".'))
+        self.pathspec_txt.enable_hint(True)
+
         self.result_txt = GrepTextView(N_('grep result...'), self)
         self.result_txt.enable_hint(True)
 
@@ -108,6 +217,11 @@ class Grep(Dialog):
         self.refresh_button.setIcon(qtutils.reload_icon())
         self.refresh_button.setShortcut(QtGui.QKeySequence.Refresh)
 
+        self.more_button = QtGui.QPushButton(N_('Load More'))
+        self.more_button.setToolTip(
+                N_('Show the next %d results') % GrepThread.max_results)
+        self.more_button.setEnabled(False)
+
         self.shell_checkbox = QtGui.QCheckBox(N_('Shell arguments'))
         self.shell_checkbox.setToolTip(
                 N_('Parse arguments using a shell.\n'
@@ -131,9 +245,11 @@ class Grep(Dialog):
         self.input_layout.addWidget(self.input_label)
         self.input_layout.addWidget(self.input_txt)
         self.input_layout.addWidget(self.regexp_combo)
+        self.input_layout.addWidget(self.pathspec_txt)
 
         self.bottom_layout.addWidget(self.edit_button)
         self.bottom_layout.addWidget(self.refresh_button)
+        self.bottom_layout.addWidget(self.more_button)
         self.bottom_layout.addWidget(self.shell_checkbox)
         self.bottom_layout.addStretch()
         self.bottom_layout.addWidget(self.close_button)
@@ -144,13 +260,21 @@ class Grep(Dialog):
         self.setLayout(self.mainlayout)
 
         self.grep_thread = GrepThread(self)
+        self.generation = 0
+        self.line_count = 0
 
+        self.connect(self.grep_thread, SIGNAL('lines'), self.process_lines)
         self.connect(self.grep_thread, SIGNAL('result'),
                      self.process_result)
+        self.connect(self.grep_thread, SIGNAL('more_available'),
+                     self.more_available)
 
         self.connect(self.input_txt, SIGNAL('textChanged(QString)'),
                      lambda s: self.search())
 
+        self.connect(self.pathspec_txt, SIGNAL('textChanged(QString)'),
+                     lambda s: self.search())
+
         self.connect(self.regexp_combo, SIGNAL('currentIndexChanged(int)'),
                      lambda x: self.search())
 
@@ -165,6 +289,7 @@ class Grep(Dialog):
                            'Ctrl+L')
         qtutils.connect_button(self.edit_button, self.edit)
         qtutils.connect_button(self.refresh_button, self.search)
+        qtutils.connect_button(self.more_button, self.load_more)
         qtutils.connect_toggle(self.shell_checkbox, lambda x: self.search())
         qtutils.connect_button(self.close_button, self.close)
         qtutils.add_close_action(self)
@@ -174,6 +299,7 @@ class Grep(Dialog):
 
     def done(self, exit_code):
         self.save_state()
+        self.grep_thread.stop()
         return Dialog.done(self, exit_code)
 
     def regexp_mode(self):
@@ -184,14 +310,19 @@ class Grep(Dialog):
     def search(self):
         self.edit_button.setEnabled(False)
         self.refresh_button.setEnabled(False)
+        self.more_button.setEnabled(False)
         query = self.input_txt.value()
         if len(query) < 2:
+            self.grep_thread.cancel()
             self.result_txt.set_value('')
             return
-        self.grep_thread.query = query
-        self.grep_thread.shell = self.shell_checkbox.isChecked()
-        self.grep_thread.regexp_mode = self.regexp_mode()
-        self.grep_thread.start()
+        # The previous results are shown until the first new lines arrive
+        self.line_count = 0
+        self.generation = self.grep_thread.search(
+                query,
+                shell=self.shell_checkbox.isChecked(),
+                regexp_mode=self.regexp_mode(),
+                pathspecs=shell_split(self.pathspec_txt.value()))
 
     def search_for(self, txt):
         self.input_txt.set_value(txt)
@@ -216,15 +347,7 @@ class Grep(Dialog):
         cursor.setPosition(offset)
         self.result_txt.setTextCursor(cursor)
 
-    def process_result(self, status, out, err):
-
-        if status == 0:
-            value = out + err
-        elif out + err:
-            value = 'git grep: ' + out + err
-        else:
-            value = ''
-
+    def set_result(self, value):
         # save scrollbar and text cursor
         scroll = self.text_scroll()
         offset = min(len(value), self.text_offset())
@@ -234,9 +357,41 @@ class Grep(Dialog):
         self.set_text_scroll(scroll)
         self.set_text_offset(offset)
 
+    def process_lines(self, generation, lines):
+        if generation != self.generation:
+            return
+        if self.line_count == 0:
+            self.set_result('\n'.join(lines))
+        else:
+            cursor = QtGui.QTextCursor(self.result_txt.document())
+            cursor.movePosition(QtGui.QTextCursor.End)
+            cursor.insertText('\n' + '\n'.join(lines))
+        self.line_count += len(lines)
+
+    def process_result(self, generation, status, err):
+        if generation != self.generation:
+            return
+        if self.line_count == 0:
+            if status != 0 and err:
+                self.set_result('git grep: ' + err)
+            else:
+                self.set_result(err)
+        elif err:
+            self.process_lines(generation, [err.rstrip('\n')])
+
         self.edit_button.setEnabled(status == 0)
         self.refresh_button.setEnabled(status == 0)
 
+    def more_available(self, generation):
+        if generation == self.generation:
+            self.more_button.setEnabled(True)
+            self.edit_button.setEnabled(True)
+            self.refresh_button.setEnabled(True)
+
+    def load_more(self):
+        self.more_button.setEnabled(False)
+        self.grep_thread.load_more()
+
     def edit(self):
         goto_grep(self.result_txt.selected_line()),
 
@@ -1,53 +1,138 @@
 from __future__ import division, absolute_import, unicode_literals
 
 from PyQt4 import QtCore, QtGui
+from PyQt4.QtCore import SIGNAL
 
 from cola.compat import ustr
+from cola.models.highlight import have_pygments
+from cola.models.highlight import token_cache
 
-have_pygments = True
-try:
+if have_pygments:
     from pygments.styles import get_style_by_name
-    from pygments import lex
-    from pygments.util import ClassNotFound
-    from pygments.lexers import get_lexer_for_filename
-except ImportError:
-    have_pygments = False
 
-def highlight_document(edit, filename):
-    doc = edit.document()
 
-    if not have_pygments:
-        return
-
-    try:
-        lexer = get_lexer_for_filename(filename, stripnl=False)
-    except ClassNotFound:
-        return
-
-    style = get_style_by_name("default")
+def highlight_document(edit, filename, sha1=None):
+    """Highlight the text of an edit widget using pygments
 
-    font = doc.defaultFont()
-    base_format = QtGui.QTextCharFormat()
-    base_format.setFont(font)
-    token_formats = {}
+    The text is lexed in a thread and formatted as its blocks are
+    scrolled into view.  `sha1` is the blob sha1 of the text, when known.
 
-    window = edit.window()
-    if hasattr(window, "processEvents"):
-        processEvents = window.processEvents
-    else:
-        processEvents = QtCore.QCoreApplication.processEvents
-
-    def get_token_format(token):
-        if token in token_formats:
-            return token_formats[token]
+    """
+    if not have_pygments:
+        return None
+    highlighter = getattr(edit, 'document_highlighter', None)
+    if highlighter is None:
+        highlighter = DocumentHighlighter(edit)
+        edit.document_highlighter = highlighter
+    highlighter.highlight(filename, sha1=sha1)
+    return highlighter
+
+
+class DocumentHighlighter(QtCore.QObject):
+    """Applies cached pygments tokens to the visible blocks of an edit"""
+
+    def __init__(self, edit, style='default'):
+        QtCore.QObject.__init__(self, edit)
+        self.edit = edit
+        self.style = get_style_by_name(style)
+        self.base_format = QtGui.QTextCharFormat()
+        self.base_format.setFont(edit.document().defaultFont())
+        self.token_formats = {}
+        self.lines = None
+        """The token runs of each line, once they have been computed"""
+        self.formatted = set()
+        """The numbers of the blocks that have been formatted"""
+        self.generation = 0
+        self.tasks = set()
+
+        self.connect(self, SIGNAL('tokens_ready'), self.tokens_ready)
+        self.connect(self, SIGNAL('task_done'), self.task_done)
+        self.connect(edit.verticalScrollBar(), SIGNAL('valueChanged(int)'),
+                     lambda value: self.format_visible())
+        edit.viewport().installEventFilter(self)
+
+    def highlight(self, filename, sha1=None):
+        """Start lexing the current text of the edit"""
+        self.generation += 1
+        self.lines = None
+        self.formatted.clear()
+        text = ustr(self.edit.document().toPlainText())
+        task = HighlightTask(self, self.generation, text, filename, sha1)
+        self.tasks.add(task)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def is_stale(self, generation):
+        return generation != self.generation
+
+    def tokens_ready(self, generation, lines):
+        if self.is_stale(generation) or lines is None:
+            return
+        self.lines = lines
+        self.format_visible()
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QtCore.QEvent.Resize:
+            self.format_visible()
+        return False
+
+    def visible_blocks(self):
+        """Return the first and last blocks shown by the edit"""
+        edit = self.edit
+        viewport = edit.viewport()
+        first = edit.cursorForPosition(QtCore.QPoint(0, 0)).block()
+        last = edit.cursorForPosition(
+                QtCore.QPoint(viewport.width(), viewport.height())).block()
+        return first, last
+
+    def format_visible(self):
+        """Format the visible blocks that have not been formatted yet"""
+        lines = self.lines
+        if lines is None:
+            return
+        doc = self.edit.document()
+        first, last = self.visible_blocks()
+        block = first
+        while block.isValid():
+            number = block.blockNumber()
+            if number >= len(lines):
+                break
+            if number not in self.formatted:
+                self.formatted.add(number)
+                self.format_block(block, lines[number])
+                doc.markContentsDirty(block.position(), block.length())
+            if block == last:
+                break
+            block = block.next()
+
+    def format_block(self, block, runs):
+        block_formats = []
+        block_len = block.length()
+        for start, length, token in runs:
+            if start >= block_len:
+                break
+            format_range = QtGui.QTextLayout.FormatRange()
+            format_range.start = start
+            format_range.length = min(length, block_len - start)
+            format_range.format = self.token_format(token)
+            block_formats.append(format_range)
+        block.layout().setAdditionalFormats(block_formats)
 
+    def token_format(self, token):
+        try:
+            return self.token_formats[token]
+        except KeyError:
+            pass
         if token.parent:
-            parent_format = get_token_format(token.parent)
+            parent_format = self.token_format(token.parent)
         else:
-            parent_format = base_format
+            parent_format = self.base_format
 
         format = QtGui.QTextCharFormat(parent_format)
         font = format.font()
+        style = self.style
         if style.styles_token(token):
             tstyle = style.style_for_token(token)
             if tstyle['color']:
@@ -58,41 +143,29 @@ def highlight_document(edit, filename):
             if tstyle['bgcolor']: format.setBackground (QtGui.QColor("#"+tstyle['bgcolor']))
             # No way to set this for a QTextCharFormat
             #if tstyle['border']: format.
-        token_formats[token] = format
+        self.token_formats[token] = format
         return format
 
-    text = ustr(doc.toPlainText())
-
-    block_count = 0
-    block = doc.firstBlock()
-    assert(isinstance(block, QtGui.QTextBlock))
-    block_pos = 0
-    block_len = block.length()
-    block_formats = []
 
-    for token, ttext in lex(text, lexer):
-        format_len = len(ttext)
-        format = get_token_format(token)
-        while format_len > 0:
-            format_range = QtGui.QTextLayout.FormatRange()
-            format_range.start = block_pos
-            format_range.length = min(format_len, block_len)
-            format_range.format = format
-            block_formats.append(format_range)
-            block_len -= format_range.length
-            format_len -= format_range.length
-            block_pos += format_range.length
-            if block_len == 0:
-                block.layout().setAdditionalFormats(block_formats)
-                doc.markContentsDirty(block.position(), block.length())
-                block = block.next()
-                block_pos = 0
-                block_len = block.length()
-                block_formats = []
-
-                block_count += 1
-                if block_count % 100 == 0:
-                    processEvents()
+class HighlightTask(QtCore.QRunnable):
+    """Lexes text in a thread, or takes its tokens from the cache"""
+
+    def __init__(self, highlighter, generation, text, filename, sha1):
+        QtCore.QRunnable.__init__(self)
+        self.highlighter = highlighter
+        self.generation = generation
+        self.text = text
+        self.filename = filename
+        self.sha1 = sha1
+
+    def run(self):
+        highlighter = self.highlighter
+        generation = self.generation
+        cancel = lambda: highlighter.is_stale(generation)
+        lines = token_cache().tokens(self.text, self.filename,
+                                     sha1=self.sha1, cancel=cancel)
+        highlighter.emit(SIGNAL('tokens_ready'), generation, lines)
+        highlighter.emit(SIGNAL('task_done'), self)
 
 
 if __name__ == "__main__":
@@ -14,6 +14,9 @@ from cola import utils
 from cola import qtutils
 from cola.i18n import N_
 from cola.interaction import Interaction
+from cola.models.search import PickaxeSearch
+from cola.models.search import commit_index
+from cola.models.search import is_regex
 from cola.git import git
 from cola.git import STDOUT
 from cola.qtutils import connect_button
@@ -29,6 +32,10 @@ def mkdate(timespec):
     return '%04d-%02d-%02d' % time.localtime(timespec)[:3]
 
 
+def parse_date(datestr):
+    return time.mktime(time.strptime(datestr, '%Y-%m-%d'))
+
+
 class SearchOptions(object):
     def __init__(self):
         self.query = ''
@@ -132,6 +139,10 @@ def search():
 
 
 class SearchEngine(object):
+
+    streaming = False
+    """Streaming engines yield results from stream() as they are found"""
+
     def __init__(self, model):
         self.model = model
 
@@ -158,6 +169,18 @@ class SearchEngine(object):
         revlist = git.log(*args, **kwargs)[STDOUT]
         return gitcmds.parse_rev_list(revlist)
 
+    def index(self):
+        """Return the commit index, or None when it is not built
+
+        The index is brought up to date by IndexTask, never here,
+        so that searches do not wait for git.
+
+        """
+        index = commit_index()
+        if not index.ready:
+            return None
+        return index
+
     def results(self):
         pass
 
@@ -178,26 +201,45 @@ class PathSearch(SearchEngine):
 class MessageSearch(SearchEngine):
     def results(self):
         query, kwargs = self.common_args()
+        index = not is_regex(query) and self.index()
+        if index:
+            results = index.search_messages(query, self.model.max_count)
+            if results is not None:
+                return results
         return self.revisions(all=True, grep=query, **kwargs)
 
 
 class AuthorSearch(SearchEngine):
     def results(self):
         query, kwargs = self.common_args()
+        index = not is_regex(query) and self.index()
+        if index:
+            results = index.search_authors(query, self.model.max_count)
+            if results is not None:
+                return results
         return self.revisions(all=True, author=query, **kwargs)
 
 
 class CommitterSearch(SearchEngine):
     def results(self):
         query, kwargs = self.common_args()
+        index = not is_regex(query) and self.index()
+        if index:
+            results = index.search_committers(query, self.model.max_count)
+            if results is not None:
+                return results
         return self.revisions(all=True, committer=query, **kwargs)
 
 
 class DiffSearch(SearchEngine):
+
+    streaming = True
+
+    def stream(self):
+        return PickaxeSearch(self.model.query, self.model.max_count)
+
     def results(self):
-        query, kwargs = self.common_args()
-        return gitcmds.parse_rev_list(
-            git.log('-S'+query, all=True, **kwargs)[STDOUT])
+        return list(self.stream().results())
 
 
 class DateRangeSearch(SearchEngine):
@@ -208,6 +250,14 @@ class DateRangeSearch(SearchEngine):
         kwargs = self.rev_args()
         start_date = self.model.start_date
         end_date = self.model.end_date
+        index = self.index()
+        if index:
+            # Commits made on the end date are included, as with git
+            results = index.search_dates(parse_date(start_date),
+                                         parse_date(end_date) + 24*60*60,
+                                         self.model.max_count)
+            if results is not None:
+                return results
         return self.revisions(date='iso',
                               all=True,
                               after=start_date,
@@ -220,6 +270,10 @@ class Search(SearchWidget):
     def __init__(self, model, parent):
         SearchWidget.__init__(self, parent)
         self.model = model
+        self.results = []
+        self.tasks = set()
+        self.generation = 0
+        self.pickaxe = None
 
         self.EXPR = N_('Search by Expression')
         self.PATH = N_('Search by Path')
@@ -257,12 +311,36 @@ class Search(SearchWidget):
                      SIGNAL('itemSelectionChanged()'),
                      self.display)
 
+        self.connect(self, SIGNAL('result'), self.add_result)
+        self.connect(self, SIGNAL('task_done'), self.task_done)
+
         self.set_start_date(mkdate(time.time()-(87640*31)))
         self.set_end_date(mkdate(time.time()+87640))
         self.set_mode(self.EXPR)
 
         self.query.setFocus()
 
+        # Build or extend the commit index while the query is typed
+        self.start_task(IndexTask(self))
+
+    def start_task(self, task):
+        self.tasks.add(task)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+
+    def cancel(self):
+        """Stop a diff search that is still running"""
+        self.generation += 1
+        if self.pickaxe is not None:
+            self.pickaxe.kill()
+            self.pickaxe = None
+
+    def done(self, exit_code):
+        self.cancel()
+        return SearchWidget.done(self, exit_code)
+
     def mode_index_changed(self, idx):
         mode = self.mode()
         self.update_shown_widgets(mode)
@@ -311,12 +389,35 @@ class Search(SearchWidget):
         self.model.start_date = str(self.start_date.date().toString(fmt))
         self.model.end_date = str(self.end_date.date().toString(fmt))
 
-        self.results = engineclass(self.model).search()
+        self.cancel()
+        engine = engineclass(self.model)
+        if engine.streaming:
+            self.stream(engine)
+            return
+        self.results = engine.search()
         if self.results:
             self.display_results()
         else:
             self.commit_list.clear()
             self.commit_text.setText('')
+        # Pick up new commits for the next search
+        self.start_task(IndexTask(self))
+
+    def stream(self, engine):
+        self.results = []
+        self.commit_list.clear()
+        self.commit_text.setText('')
+        if not engine.validate():
+            return
+        self.pickaxe = engine.stream()
+        self.start_task(PickaxeTask(self.pickaxe, self.generation, self))
+
+    def add_result(self, generation, result):
+        """Show a result streamed from a search unless it was cancelled"""
+        if generation != self.generation:
+            return
+        self.results.append(result)
+        self.commit_list.addItem(result[1])
 
     def browse_callback(self):
         paths = QtGui.QFileDialog.getOpenFileNames(self,
@@ -365,6 +466,32 @@ class Search(SearchWidget):
         revision = self.results[row][0]
         Interaction.log_status(*git.cherry_pick(revision))
 
+
+class IndexTask(QtCore.QRunnable):
+
+    def __init__(self, widget):
+        QtCore.QRunnable.__init__(self)
+        self.widget = widget
+
+    def run(self):
+        commit_index().update()
+        self.widget.emit(SIGNAL('task_done'), self)
+
+
+class PickaxeTask(QtCore.QRunnable):
+
+    def __init__(self, pickaxe, generation, widget):
+        QtCore.QRunnable.__init__(self)
+        self.pickaxe = pickaxe
+        self.generation = generation
+        self.widget = widget
+
+    def run(self):
+        for result in self.pickaxe.results():
+            self.widget.emit(SIGNAL('result'), self.generation, result)
+        self.widget.emit(SIGNAL('task_done'), self)
+
+
 def search_commits(parent):
     opts = SearchOptions()
     widget = Search(opts, parent)
@@ -7,9 +7,9 @@ __copyright__ = """
 2013, David Aguilar <davvid@gmail.com>
 """
 
-import collections
 import re
 import sys
+import threading
 
 from PyQt4.Qt import QAction
 from PyQt4.Qt import QApplication
@@ -21,86 +21,68 @@ from PyQt4.Qt import QTextCharFormat
 from PyQt4.Qt import QTextCursor
 from PyQt4.Qt import Qt
 from PyQt4.QtCore import SIGNAL
+from PyQt4.QtCore import QRunnable
+from PyQt4.QtCore import QThreadPool
 
 from cola.i18n import N_
+from cola.models import dictionary
 from cola.widgets.text import HintedTextEdit
 from cola.compat import ustr
 
 
-alphabet = 'abcdefghijklmnopqrstuvwxyz'
-
-
-def train(features, model):
-    for f in features:
-        model[f] += 1
-    return model
-
-
-def edits1(word):
-    splits     = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-    deletes    = [a + b[1:] for a, b in splits if b]
-    transposes = [a + b[1] + b[0] + b[2:] for a, b in splits if len(b)>1]
-    replaces   = [a + c + b[1:] for a, b in splits for c in alphabet if b]
-    inserts    = [a + c + b     for a, b in splits for c in alphabet]
-    return set(deletes + transposes + replaces + inserts)
-
-
-def known_edits2(word, words):
-    return set(e2 for e1 in edits1(word)
-                  for e2 in edits1(e1) if e2 in words)
-
-def known(word, words):
-    return set(w for w in word if w in words)
-
-
-def suggest(word, words):
-    candidates = (known([word], words) or
-                  known(edits1(word), words) or
-                  known_edits2(word, words) or [word])
-    return candidates
-
+class NorvigSpellCheck(object):
+    """Checks words against the compiled system dictionary
 
-def correct(word, words):
-    candidates = suggest(word, words)
-    return max(candidates, key=words.get)
+    Until the dictionary has been loaded, check() accepts every word
+    unless it is asked to wait.
 
+    """
 
-class NorvigSpellCheck(object):
     def __init__(self):
-        self.words = collections.defaultdict(lambda: 1)
+        self.words = None
         self.extra_words = set()
-        self.initialized = False
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self.words is not None
 
     def init(self):
-        if self.initialized:
-            return
-        self.initialized = True
-        train(self.read(), self.words)
-        train(self.extra_words, self.words)
+        """Load the dictionary, compiling it the first time"""
+        with self._lock:
+            if self.words is None:
+                self.words = dictionary.instance()
+        return self.words
 
     def add_word(self, word):
         self.extra_words.add(word)
 
     def suggest(self, word):
-        self.init()
-        return suggest(word, self.words)
-
-    def check(self, word):
-        self.init()
-        return word.replace('.', '') in self.words
-
-    def read(self):
-        for (path, title) in (('/usr/share/dict/words', True),
-                              ('/usr/share/dict/propernames', False)):
-            try:
-                with open(path, 'r') as f:
-                    for word in f:
-                        yield word.rstrip()
-                        if title:
-                            yield word.rstrip().title()
-            except IOError:
-                pass
-        raise StopIteration
+        words = self.init()
+        candidates = words.suggest(word)
+        if candidates:
+            limit = candidates[0][0]
+        else:
+            limit = words.max_distance
+        for extra in self.extra_words:
+            value = dictionary.distance(word, extra, limit)
+            if value <= limit:
+                candidates.append((value, extra))
+        if not candidates:
+            return [word]
+        best = min(candidates)[0]
+        return sorted(set([candidate for value, candidate in candidates
+                           if value == best]))
+
+    def check(self, word, wait=True):
+        if wait:
+            words = self.init()
+        else:
+            words = self.words
+            if words is None:
+                return True
+        word = word.replace('.', '')
+        return word in self.extra_words or word in words
 
 
 class SpellCheckTextEdit(HintedTextEdit):
@@ -173,13 +155,27 @@ class Highlighter(QSyntaxHighlighter):
         QSyntaxHighlighter.__init__(self, doc)
         self.spellcheck = spellcheck
         self.enabled = False
+        self.task = None
+        self.connect(self, SIGNAL('initialized'), self.initialized)
 
     def enable(self, enabled):
         self.enabled = enabled
+        if enabled and not self.spellcheck.initialized:
+            # The dictionary is loaded in the background and the text is
+            # highlighted once it is ready
+            if self.task is None:
+                self.task = InitTask(self)
+                QThreadPool.globalInstance().start(self.task)
+            return
         self.rehighlight()
 
+    def initialized(self):
+        self.task = None
+        if self.enabled:
+            self.rehighlight()
+
     def highlightBlock(self, text):
-        if not self.enabled:
+        if not self.enabled or not self.spellcheck.initialized:
             return
         text = ustr(text)
         fmt = QTextCharFormat()
@@ -187,11 +183,23 @@ class Highlighter(QSyntaxHighlighter):
         fmt.setUnderlineStyle(QTextCharFormat.SpellCheckUnderline)
 
         for word_object in re.finditer(self.WORDS, text):
-            if not self.spellcheck.check(word_object.group()):
+            if not self.spellcheck.check(word_object.group(), wait=False):
                 self.setFormat(word_object.start(),
                     word_object.end() - word_object.start(), fmt)
 
 
+class InitTask(QRunnable):
+    """Loads the dictionary in a thread"""
+
+    def __init__(self, highlighter):
+        QRunnable.__init__(self)
+        self.highlighter = highlighter
+
+    def run(self):
+        self.highlighter.spellcheck.init()
+        self.highlighter.emit(SIGNAL('initialized'))
+
+
 class SpellAction(QAction):
     """QAction that returns the text in a signal.
     """
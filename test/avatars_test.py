@@ -0,0 +1,183 @@
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import helper
+from cola.models import avatars
+
+
+IMAGES = {
+    avatars.email_hash('author@example.com'): b'author image',
+    avatars.email_hash('other@example.com'): b'other image',
+    avatars.email_hash('same@example.com'): b'author image',
+}
+
+
+class AvatarHandler(BaseHTTPRequestHandler):
+    """Serves IMAGES like gravatar does with d=404"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+        time.sleep(server.delay)
+        email_hash = self.path.split('/')[-1].split('?')[0]
+        data = IMAGES.get(email_hash)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class AvatarCacheTestCase(helper.TmpPathTestCase):
+    """Tests the AvatarCache class against a local HTTP server."""
+
+    def setUp(self):
+        helper.TmpPathTestCase.setUp(self)
+        self.server = HTTPServer(('127.0.0.1', 0), AvatarHandler)
+        self.server.lock = threading.Lock()
+        self.server.paths = []
+        self.server.delay = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d/avatar/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        helper.TmpPathTestCase.tearDown(self)
+
+    def cache(self):
+        return avatars.AvatarCache(path=self.test_path('avatars'),
+                                   base_url=self.base_url)
+
+    def test_get(self):
+        cache = self.cache()
+        self.assertEqual(cache.get('author@example.com', 48), b'author image')
+        self.assertEqual(cache.get('Author@example.com ', 48),
+                         b'author image')
+        self.assertEqual(cache.requests, 1)
+        self.assertEqual(self.server.paths,
+                         ['/avatar/%s?s=48&d=404' %
+                          avatars.email_hash('author@example.com')])
+        # Other sizes are other images
+        cache.get('author@example.com', 64)
+        self.assertEqual(cache.requests, 2)
+
+        # The disk cache is shared with later instances
+        cache = self.cache()
+        self.assertEqual(cache.get('author@example.com', 48), b'author image')
+        self.assertEqual(cache.requests, 0)
+
+    def test_content_addressed(self):
+        cache = self.cache()
+        cache.get('author@example.com', 48)
+        cache.get('same@example.com', 48)
+        cache.get('other@example.com', 48)
+        objects = os.listdir(self.test_path('avatars', 'objects'))
+        self.assertEqual(len(objects), 2)
+
+    def test_miss(self):
+        cache = self.cache()
+        self.assertEqual(cache.get('nobody@example.com', 48), None)
+        self.assertEqual(cache.get('nobody@example.com', 48), None)
+        self.assertEqual(cache.requests, 1)
+        # Misses are remembered on disk too
+        cache = self.cache()
+        self.assertEqual(cache.get('nobody@example.com', 48), None)
+        self.assertEqual(cache.requests, 0)
+
+        cache = self.cache()
+        cache.miss_ttl = -1
+        self.assertEqual(cache.get('nobody@example.com', 48), None)
+        self.assertEqual(cache.requests, 1)
+
+    def test_ttl(self):
+        cache = self.cache()
+        cache.get('author@example.com', 48)
+        cache = self.cache()
+        cache.ttl = -1
+        self.assertEqual(cache.get('author@example.com', 48), b'author image')
+        self.assertEqual(cache.requests, 1)
+
+    def test_network_error(self):
+        cache = avatars.AvatarCache(path=self.test_path('avatars'),
+                                    base_url='http://127.0.0.1:1/avatar/')
+        self.assertEqual(cache.get('author@example.com', 48), None)
+        self.assertEqual(cache.get('author@example.com', 48), None)
+        self.assertEqual(cache.requests, 1)
+        # Errors are not remembered on disk
+        cache = self.cache()
+        self.assertEqual(cache.get('author@example.com', 48), b'author image')
+
+    def test_size_cap(self):
+        cache = self.cache()
+        cache.max_bytes = len(b'author image')
+        cache.get('author@example.com', 48)
+        objects_path = self.test_path('avatars', 'objects')
+        (first,) = os.listdir(objects_path)
+        old = time.time() - 60
+        os.utime(os.path.join(objects_path, first), (old, old))
+        cache.get('other@example.com', 48)
+        self.assertEqual(len(os.listdir(objects_path)), 1)
+        self.assertFalse(first in os.listdir(objects_path))
+
+        # Dropped images are downloaded again
+        cache = self.cache()
+        self.assertEqual(cache.get('author@example.com', 48), b'author image')
+        self.assertEqual(cache.requests, 1)
+
+    def test_coalesce(self):
+        self.server.delay = 0.2
+        cache = self.cache()
+        results = []
+
+        def get():
+            results.append(cache.get('author@example.com', 48))
+
+        threads = [threading.Thread(target=get) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'author image'] * 4)
+        self.assertEqual(cache.requests, 1)
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_prefetch(self):
+        cache = self.cache()
+        emails = ['author@example.com', None, 'other@example.com',
+                  'author@example.com', 'nobody@example.com']
+        cache.prefetch(emails, 48)
+        deadline = time.time() + 10
+        while cache._prefetching and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.requests, 3)
+        self.assertTrue(cache.cached('other@example.com', 48))
+        self.assertTrue(cache.cached('nobody@example.com', 48))
+        # Known avatars are not queued again
+        cache.prefetch(emails, 48)
+        self.assertFalse(cache._prefetching)
+        self.assertEqual(cache.get('other@example.com', 48), b'other image')
+        self.assertEqual(cache.requests, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
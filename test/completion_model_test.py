@@ -0,0 +1,179 @@
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+import helper
+from cola import utils
+from cola.models import completion
+
+
+def brute_force(items, text, case_sensitive=False):
+    """Return the items matched by CompletionIndex.query(), unranked"""
+    if not case_sensitive:
+        text = text.lower()
+    result = set()
+    for item in items:
+        string = case_sensitive and item or item.lower()
+        name_start = string.rfind('/') + 1
+        if text.endswith('/'):
+            found = string[:name_start].endswith(text)
+        else:
+            found = string.find(text, max(0, name_start + 1 - len(text))) >= 0
+        if found:
+            result.add(item)
+    return result
+
+
+class CompletionIndexTestCase(unittest.TestCase):
+    """Tests the CompletionIndex class."""
+
+    def setUp(self):
+        self.index = completion.CompletionIndex(utils.add_parents(set([
+            'Makefile',
+            'cola/main.py',
+            'cola/models/main.py',
+            'cola/widgets/main.py',
+            'cola/widgets/completion.py',
+            'share/doc/main/README',
+        ])))
+
+    def test_ranking(self):
+        self.assertEqual(self.index.query('main'),
+                         ['cola/main.py', 'share/doc/main',
+                          'cola/models/main.py', 'cola/widgets/main.py'])
+        # Names containing the text rank below names starting with it
+        index = completion.CompletionIndex(['abc/xmain', 'abcdef/mainframe'])
+        self.assertEqual(index.query('main'),
+                         ['abcdef/mainframe', 'abc/xmain'])
+
+    def test_match_reaches_name(self):
+        # Files beneath "cola" are found through the directory
+        self.assertEqual(self.index.query('cola'), ['cola'])
+        self.assertEqual(self.index.query('cola/w'), ['cola/widgets'])
+        self.assertEqual(self.index.query('widgets/'),
+                         ['cola/widgets/main.py', 'cola/widgets/completion.py'])
+        self.assertEqual(self.index.query('ls/ma'), ['cola/models/main.py'])
+
+    def test_case_sensitive(self):
+        self.assertEqual(self.index.query('make'), ['Makefile'])
+        self.assertEqual(self.index.query('make', case_sensitive=True), [])
+        self.assertEqual(self.index.query('Make', case_sensitive=True),
+                         ['Makefile'])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.query('', limit=3)), 3)
+        self.assertEqual(self.index.query('m', limit=1), ['Makefile'])
+
+    def test_update(self):
+        index = self.index
+        items = set(index.items)
+        items.remove('Makefile')
+        items.add('cola/widgets/maintainer.py')
+        self.assertTrue(index.update(items))
+        self.assertFalse(index.update(items))
+        self.assertEqual(len(index.added), 1)
+        self.assertEqual(index.query('make'), [])
+        self.assertEqual(index.query('maint'), ['cola/widgets/maintainer.py'])
+        self.assertTrue('cola/widgets/maintainer.py' in index)
+        self.assertFalse('Makefile' in index)
+
+        # Too many changes rebuild the index
+        index.max_pending = 1
+        items.add('Makefile')
+        index.update(items)
+        self.assertEqual(index.added, [])
+        self.assertEqual(index.query('make'), ['Makefile'])
+
+    def test_cancel(self):
+        self.assertEqual(self.index.query('main', cancel=lambda: True), [])
+        self.assertEqual(self.index.query('m', cancel=lambda: True), [])
+        # Cancelling part-way through a scan abandons the query
+        calls = []
+        def cancel():
+            calls.append(None)
+            return len(calls) > 2
+        scan = completion.CompletionIndex(self.index.items)
+        scan.max_ranked = 0
+        self.assertEqual(scan.query('ma', cancel=cancel), [])
+        self.assertEqual(len(scan.query('ma', cancel=lambda: False)), 5)
+
+    def test_without_separator(self):
+        refs = completion.CompletionIndex(
+                ['master', 'origin/master', 'origin/maint', 'v1.0'],
+                separator=None)
+        self.assertEqual(refs.query('orig'), ['origin/maint', 'origin/master'])
+        self.assertEqual(refs.query('ma'),
+                         ['master', 'origin/maint', 'origin/master'])
+
+    def test_scans_agree_with_index(self):
+        rand = random.Random(0)
+        words = ['cola', 'main', 'models', 'Widgets', 'dag', 'test']
+        files = set()
+        for idx in range(2000):
+            dirs = [rand.choice(words) + str(rand.randrange(5))
+                    for depth in range(rand.randrange(3))]
+            files.add('/'.join(dirs + ['%s_%d.py' % (rand.choice(words), idx)]))
+        items = utils.add_parents(files)
+        index = completion.CompletionIndex(items)
+        scan = completion.CompletionIndex(items)
+        # Force the scanning fallback
+        scan.max_ranked = 0
+        queries = ('mai', 'main_1', 'dag', 'widgets', 'Widgets', 'dag3/',
+                   'els2/te', 'zzz', 'a', '_19')
+        for text in queries:
+            case_sensitive = text != text.lower()
+            expect = brute_force(items, text, case_sensitive)
+            found = index.query(text, case_sensitive, limit=len(items))
+            self.assertEqual(set(found), expect)
+            self.assertEqual(len(found), len(expect))
+            found = scan.query(text, case_sensitive, limit=len(items))
+            self.assertEqual(set(found), expect)
+
+
+    def test_ranking_agrees_with_brute_force(self):
+        rand = random.Random(0)
+        letters = 'abgh'
+        files = set()
+        while len(files) < 20000:
+            parts = [''.join([rand.choice(letters)
+                              for idx in range(rand.randrange(2, 7))])
+                     for depth in range(rand.randrange(1, 3))]
+            files.add('/'.join(parts))
+        items = utils.add_parents(files)
+        index = completion.CompletionIndex(items)
+
+        def rank(item):
+            name = item[item.rfind('/')+1:]
+            return (not name.startswith(tail), len(item), item)
+
+        for text in ('gh', 'g', 'ab/', 'hag', 'gh/ab'):
+            tail = text[text.rfind('/')+1:]
+            expect = sorted(brute_force(items, text), key=rank)
+            self.assertEqual(index.query(text), expect[:index.limit])
+
+
+class PathIndexTestCase(helper.GitRepositoryTestCase):
+    """Tests the PathIndex class."""
+
+    def test_refresh(self):
+        self.shell('mkdir -p dir/sub && touch dir/sub/C && git add dir')
+        index = completion.PathIndex()
+        self.assertTrue(index.refresh([]))
+        self.assertEqual(sorted(index.members), ['A', 'B', 'dir', 'dir/sub',
+                                               'dir/sub/C'])
+        self.assertEqual(index.dirs, frozenset(['dir', 'dir/sub']))
+        self.assertFalse(index.refresh([]))
+
+        self.assertTrue(index.refresh(['untracked/D']))
+        self.assertEqual(index.query('unt'), ['untracked'])
+        self.assertEqual(index.query('d'),
+                         ['dir', 'untracked/D', 'untracked'])
+
+        self.shell('git rm -q --cached A')
+        self.assertTrue(index.refresh(['untracked/D']))
+        self.assertFalse('A' in index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+from __future__ import unicode_literals
+
+import unittest
+
+import helper
+from cola import core
+from cola import git
+from cola.git import STDOUT
+from cola.models import dag
+
+
+class RepoReaderTestCase(helper.GitRepositoryTestCase):
+    """Tests the RepoReader class and its commit cache."""
+
+    def setUp(self):
+        helper.GitRepositoryTestCase.setUp(self)
+        self.git = git.instance()
+        self.commit('second')
+        self.commit('third')
+        self.shell('git tag v1.0')
+
+    def commit(self, summary):
+        self.shell("echo '%s' >> A && git commit -q -a -m'%s'"
+                   % (summary, summary))
+
+    def read(self, ref='HEAD', count=1000, cache=True):
+        reader = dag.RepoReader(dag.DAG(ref, count), cache=cache)
+        reader.reset()
+        return list(reader)
+
+    def expected(self, *args):
+        out = self.git.rev_list('--topo-order', '--reverse', *args)[STDOUT]
+        return out.splitlines()
+
+    def test_read(self):
+        commits = self.read()
+        self.assertEqual([c.sha1 for c in commits], self.expected('HEAD'))
+        self.assertEqual([c.summary for c in commits],
+                         ['Initial commit', 'second', 'third'])
+        self.assertEqual(commits[1].parents, [commits[0]])
+        self.assertEqual(commits[1].children, [commits[2]])
+        self.assertTrue('v1.0' in commits[2].tags)
+
+    def test_cache_is_used(self):
+        self.read()
+        # Rewrite the cache so that we can tell cached commits apart
+        cache = dag.CommitCache(self.git.git_path('cola-dag.cache'))
+        tips, rows = cache.load('1000 HEAD')
+        rows = [row[:-1] + ('cached',) for row in rows]
+        cache.save('1000 HEAD', tips, rows)
+
+        self.commit('fourth')
+        self.shell('git tag v2.0 HEAD~1')
+        commits = self.read()
+        self.assertEqual([c.sha1 for c in commits], self.expected('HEAD'))
+        self.assertEqual([c.summary for c in commits],
+                         ['cached', 'cached', 'cached', 'fourth'])
+        # Decorations are refreshed for cached commits
+        self.assertTrue('v2.0' in commits[2].tags)
+        self.assertEqual(commits[3].parents, [commits[2]])
+        self.assertEqual(commits[3].generation, commits[2].generation + 1)
+
+        # The cache was updated with the new commit
+        tips, rows = cache.load('1000 HEAD')
+        self.assertEqual(tips, [commits[-1].sha1])
+        self.assertEqual([row[0] for row in rows], self.expected('HEAD'))
+
+    def test_cache_count(self):
+        self.read(count=2)
+        self.commit('fourth')
+        commits = self.read(count=2)
+        self.assertEqual([c.summary for c in commits], ['third', 'fourth'])
+
+    def test_stale_cache(self):
+        self.read()
+        self.shell('git commit -q --amend -m rewritten')
+        commits = self.read()
+        self.assertEqual([c.sha1 for c in commits], self.expected('HEAD'))
+        self.assertEqual(commits[-1].summary, 'rewritten')
+
+    def test_uncacheable_arguments(self):
+        commits = self.read(ref='HEAD~1..HEAD')
+        self.assertEqual([c.summary for c in commits], ['third'])
+        self.assertFalse(core.exists(self.git.git_path('cola-dag.cache')))
+
+    def test_cache_is_opt_in(self):
+        self.read()
+        commits = self.read(count=6, cache=None)
+        self.assertEqual([c.sha1 for c in commits], self.expected('HEAD'))
+        # Readers without the cache leave its entry alone
+        cache = dag.CommitCache(self.git.git_path('cola-dag.cache'))
+        self.assertNotEqual(cache.load('1000 HEAD'), None)
+
+    def test_corrupt_cache(self):
+        core.write(self.git.git_path('cola-dag.cache'), 'COLADAG1 garbage')
+        commits = self.read()
+        self.assertEqual([c.sha1 for c in commits], self.expected('HEAD'))
+
+
+class CommitGraphTestCase(unittest.TestCase):
+    """Tests the CommitGraph class."""
+
+    def entry(self, sha1, parents, summary, tags=''):
+        fields = (' '.join(parents), tags, 'A U Thor', 'date',
+                  'author@example.com', summary)
+        return sha1 + dag.logsep + dag.logsep.join(fields)
+
+    def test_graph(self):
+        graph = dag.CommitGraph()
+        root = graph.add(self.entry('a' * 40, [], 'root'))
+        left = graph.add(self.entry('b' * 40, ['a' * 40], 'left',
+                                    ' (tag: v1.0, refs/heads/left)'))
+        right = graph.add(self.entry('c' * 40, ['a' * 40], 'right'))
+        merge = graph.add(self.entry('d' * 40, ['b' * 40, 'c' * 40], 'merge'))
+
+        commit = graph.commit(merge)
+        self.assertEqual(commit.summary, 'merge')
+        self.assertEqual(commit.parents,
+                         [graph.commit(left), graph.commit(right)])
+        self.assertTrue(commit.is_merge())
+        self.assertEqual(commit.generation, 2)
+
+        commit = graph.commit(root)
+        self.assertEqual(commit.children,
+                         [graph.commit(left), graph.commit(right)])
+        self.assertTrue(commit.is_fork())
+        self.assertEqual(graph.commit(left).tags, set(['v1.0', 'left']))
+        self.assertEqual(graph.commit(right).tags, set())
+        # Authors are stored once
+        self.assertEqual(graph.strings.count('A U Thor'), 1)
+
+    def test_stub(self):
+        graph = dag.CommitGraph()
+        child = graph.add(self.entry('b' * 40, ['a' * 40], 'child'))
+        parent = graph.commit(graph.ids['a' * 40])
+        self.assertFalse(parent.parsed)
+        self.assertEqual(parent.author, None)
+        self.assertEqual(parent.children, [graph.commit(child)])
+        self.assertEqual(graph.commit(child).generation, parent.generation + 1)
+
+
+class SpatialIndexTestCase(unittest.TestCase):
+    """Tests the SpatialIndex class."""
+
+    def setUp(self):
+        # A linear history of ten commits with a merge of 1 into 9
+        self.graph = graph = dag.CommitGraph()
+        for idx in range(10):
+            parents = []
+            if idx:
+                parents.append('%040x' % (idx - 1))
+            if idx == 9:
+                parents.append('%040x' % 1)
+            fields = (' '.join(parents), '', 'A U Thor', 'date',
+                      'author@example.com', 'commit %d' % idx)
+            graph.add('%040x' % idx + dag.logsep + dag.logsep.join(fields))
+        self.index = dag.SpatialIndex(max_span=4)
+        for idx in range(10):
+            self.index.add(graph.commit(idx), 0, -idx * 10)
+
+    def test_row_range(self):
+        self.assertEqual(self.index.row_range(-35, -15), (2, 4))
+        self.assertEqual(self.index.row_range(-30, -10), (1, 4))
+        self.assertEqual(self.index.row_range(100, 200), (0, 0))
+        self.assertEqual(self.index.rows['%040x' % 3], 3)
+        self.assertEqual(self.index.position(3), (0, -30))
+
+    def test_edges(self):
+        self.assertEqual(sorted(self.index.edges(2, 4)),
+                         [(1, 2), (1, 9), (2, 3), (3, 4)])
+        # The long edge is only found where it is crossed
+        self.assertEqual(self.index.long_edges, [(1, 9)])
+        self.assertEqual(self.index.edges(0, 1), [(0, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+
+import os
+import random
+import unittest
+
+import helper
+from cola.models import dictionary
+
+
+WORDS = ['spelling', 'spell', 'spill', 'dictionary', 'diction', 'commit',
+         'comet', 'comment', 'Ærøskøbing', 'a', 'an', 'and']
+
+
+class DictionaryTestCase(unittest.TestCase):
+    """Tests the Dictionary class."""
+
+    def setUp(self):
+        self.words = dictionary.Dictionary(
+                dictionary.Dictionary.compile(WORDS, key='test'))
+
+    def test_contains(self):
+        self.assertEqual(len(self.words), len(WORDS))
+        self.assertEqual(self.words.key, 'test')
+        for word in WORDS:
+            self.assertTrue(word in self.words)
+        self.assertFalse('spel' in self.words)
+        self.assertFalse('zzz' in self.words)
+        self.assertFalse('' in self.words)
+
+    def test_suggest(self):
+        self.assertEqual(self.words.suggest('spelling'), [(0, 'spelling')])
+        self.assertEqual(self.words.suggest('speling'), [(1, 'spelling')])
+        self.assertEqual(self.words.suggest('spel'), [(1, 'spell')])
+        self.assertEqual(self.words.suggest('comit'),
+                         [(1, 'comet'), (1, 'commit')])
+        self.assertEqual(self.words.suggest('Ærøskøbnig'),
+                         [(1, 'Ærøskøbing')])
+        self.assertEqual(self.words.suggest('dictoinray'),
+                         [(2, 'dictionary')])
+        self.assertEqual(self.words.suggest('xyzzy'), [])
+
+    def test_suggest_agrees_with_distance(self):
+        rand = random.Random(0)
+        letters = 'abcde'
+        words = set()
+        while len(words) < 500:
+            words.add(''.join([rand.choice(letters)
+                               for idx in range(rand.randrange(1, 10))]))
+        compiled = dictionary.Dictionary(dictionary.Dictionary.compile(words))
+        for idx in range(100):
+            query = ''.join([rand.choice(letters)
+                             for idx in range(rand.randrange(1, 10))])
+            found = compiled.suggest(query)
+            expect = [(dictionary.distance(query, word, 2), word)
+                      for word in words]
+            expect = [pair for pair in expect if pair[0] <= 2]
+            if expect:
+                best = min(expect)[0]
+                expect = sorted([pair for pair in expect if pair[0] == best])
+            self.assertEqual(found, expect)
+
+    def test_distance(self):
+        self.assertEqual(dictionary.distance('abc', 'abc', 2), 0)
+        self.assertEqual(dictionary.distance('abc', 'acb', 2), 1)
+        self.assertEqual(dictionary.distance('abc', 'xbcd', 2), 2)
+        self.assertEqual(dictionary.distance('abc', 'xyz', 2), 3)
+        self.assertEqual(dictionary.distance('a', 'abcd', 2), 3)
+
+    def test_invalid(self):
+        data = dictionary.Dictionary.compile(WORDS)
+        self.assertRaises(ValueError, dictionary.Dictionary, b'nope')
+        self.assertRaises(ValueError, dictionary.Dictionary, data[:-1])
+
+
+class CompiledDictionaryTestCase(helper.TmpPathTestCase):
+    """Tests compiling and loading dictionary files."""
+
+    def test_load_or_compile(self):
+        words_path = self.test_path('words')
+        with open(words_path, 'wb') as fh:
+            fh.write('spelling\ncommit\n'.encode('utf-8'))
+        dictionaries = ((words_path, True),
+                        (self.test_path('missing'), False))
+        path = self.test_path('cache', 'dictionary')
+
+        words = dictionary.load_or_compile(path, dictionaries=dictionaries)
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue('Spelling' in words)
+        self.assertTrue('commit' in words)
+        self.assertEqual(words.key, dictionary.source_key(dictionaries))
+
+        # The compiled file is used as long as the sources are unchanged
+        key = dictionary.source_key(dictionaries)
+        self.assertTrue(dictionary.load(path, key) is not None)
+        self.assertTrue(dictionary.load(path, 'other') is None)
+
+        with open(words_path, 'ab') as fh:
+            fh.write('dictionary\n'.encode('utf-8'))
+        self.assertTrue(dictionary.load(path, key) is not None)
+        self.assertTrue(dictionary.load(
+                path, dictionary.source_key(dictionaries)) is None)
+        words = dictionary.load_or_compile(path, dictionaries=dictionaries)
+        self.assertTrue('dictionary' in words)
+
+
+if __name__ == '__main__':
+    unittest.main()
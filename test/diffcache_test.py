@@ -0,0 +1,84 @@
+from __future__ import unicode_literals
+
+import sys
+import threading
+import unittest
+
+import helper
+from cola import gitcmds
+from cola.models import diffcache
+
+
+class DiffCacheTestCase(helper.GitRepositoryTestCase):
+    """Tests the DiffCache class."""
+
+    def setUp(self):
+        helper.GitRepositoryTestCase.setUp(self)
+        self.cache = diffcache.DiffCache()
+
+    def tearDown(self):
+        gitcmds._diff_overrides.clear()
+        helper.GitRepositoryTestCase.tearDown(self)
+
+    def test_lru(self):
+        size = sys.getsizeof('a' * 100)
+        cache = diffcache.DiffCache(max_bytes=size * 2)
+        cache.put('a', 'a' * 100)
+        cache.put('b', 'b' * 100)
+        self.assertEqual(cache.get('a'), 'a' * 100)
+        # "b" is now the least recently used
+        cache.put('c', 'c' * 100)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, size * 2)
+        # Diffs that do not fit are not kept
+        cache.put('a', 'a' * 1000)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.size, size)
+
+    def test_diff_info(self):
+        sha1 = helper.pipe('git rev-parse HEAD')
+        diff = self.cache.diff_info(sha1)
+        self.assertEqual(diff, gitcmds.diff_info(sha1))
+        self.assertTrue(self.cache.key(sha1) in self.cache)
+        self.assertFalse(self.cache.key(sha1, filename='A') in self.cache)
+
+        # The diff options are part of the key
+        gitcmds.update_diff_overrides(True, False, False, False)
+        self.assertFalse(self.cache.key(sha1) in self.cache)
+
+    def test_pending(self):
+        sha1 = helper.pipe('git rev-parse HEAD')
+        calls = []
+        diff_info = gitcmds.diff_info
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_diff_info(*args, **kwargs):
+            calls.append(args)
+            started.set()
+            release.wait()
+            return diff_info(*args, **kwargs)
+
+        results = []
+        gitcmds.diff_info = slow_diff_info
+        try:
+            first = threading.Thread(
+                    target=lambda: results.append(self.cache.diff_info(sha1)))
+            first.start()
+            started.wait()
+            second = threading.Thread(
+                    target=lambda: results.append(self.cache.diff_info(sha1)))
+            second.start()
+            release.set()
+            first.join()
+            second.join()
+        finally:
+            gitcmds.diff_info = diff_info
+        # The second caller waited for the first one's result
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [diff_info(sha1)] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
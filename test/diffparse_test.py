@@ -27,6 +27,7 @@ class DiffParseModel(object):
     def apply_diff(self, path):
         if os.path.exists(path):
             self.last_diff = core.read(path)
+        return 0, '', ''
 
 
 class DiffSource(object):
@@ -154,6 +155,123 @@ class DiffParseTestCase(unittest.TestCase):
         self.assertEqual(parser.ranges()[0].end, [0, 0])
         self.assertEqual(parser.ranges()[0].make(), '@@ -1,2 +0,0 @@')
 
+    def test_diff_subset(self):
+        fwd = helper.fixture('diff-start.txt')
+        reverse = helper.fixture('diff-start-reverse.txt')
+        source = DiffSource(fwd, reverse)
+        parser = DiffParser(DiffParseModel(), filename='',
+                            cached=False, reverse=False,
+                            diff_source=source)
+        # Select the "+b" line
+        self.assertEqual(parser.diff_subset(0, 22, 24),
+                         parser.header + '\n'
+                         '@@ -1 +1,2 @@\n bar\n+b\n\n\n')
+
+    def test_derived_reverse(self):
+        fwd = helper.fixture('diff.txt')
+        reverse = helper.fixture('diff-reverse.txt')
+        source = DiffSource(fwd, reverse)
+        parser = DiffParser(DiffParseModel(), filename='',
+                            cached=True, reverse=False,
+                            diff_source=source)
+        self.assertTrue(parser.reversed)
+        self.assertEqual(parser.header, source.parse(source.reverse)[0])
+        self.assertEqual(parser.spans(),
+                [[0, 916], [916, 1798], [1798, 2550]])
+
+        diffs = parser.diffs()
+        self.assertEqual(diffs[0][0],
+                '@@ -6,21 +6,10 @@ from cola import gitcmds')
+        self.assertEqual(diffs[0][4],
+                '-class DiffSource(object):')
+        self.assertEqual(parser.ranges()[0].begin, [6, 21])
+        self.assertEqual(parser.ranges()[0].end, [6, 10])
+
+        # Select the "+b" line and unstage it
+        fwd = helper.fixture('diff-start.txt')
+        reverse = helper.fixture('diff-start-reverse.txt')
+        source = DiffSource(fwd, reverse)
+        parser = DiffParser(DiffParseModel(), filename='',
+                            cached=True, reverse=False,
+                            diff_source=source)
+        self.assertEqual(parser.diff_subset(0, 22, 24),
+                         parser.header + '\n'
+                         '@@ -1,4 +1,3 @@\n bar\n a\n-b\n c\n\n\n')
+
+    def test_reverse_header(self):
+        for name in ('diff', 'diff-start'):
+            fwd = helper.fixture(name + '.txt')
+            reverse = helper.fixture(name + '-reverse.txt')
+            source = DiffSource(fwd, reverse)
+            self.assertEqual(diffparse.reverse_header(source.get(
+                                None, False, '', False, False)[0]),
+                             source.get(None, False, '', False, True)[0])
+
+        header = '\n'.join(['diff --git a/new b/new',
+                            'new file mode 100644',
+                            'index 0000000..e69de29',
+                            '--- /dev/null',
+                            '+++ b/new'])
+        self.assertEqual(diffparse.reverse_header(header),
+                         '\n'.join(['diff --git b/new a/new',
+                                    'deleted file mode 100644',
+                                    'index e69de29..0000000',
+                                    '--- b/new',
+                                    '+++ /dev/null']))
+
+        header = '\n'.join(['diff --git a/old b/new',
+                            'similarity index 90%',
+                            'rename from old',
+                            'rename to new',
+                            'index 5716ca5..5934e89 100644',
+                            '--- a/old',
+                            '+++ b/new'])
+        self.assertEqual(diffparse.reverse_header(header),
+                         '\n'.join(['diff --git b/new a/old',
+                                    'similarity index 90%',
+                                    'rename from new',
+                                    'rename to old',
+                                    'index 5934e89..5716ca5 100644',
+                                    '--- b/new',
+                                    '+++ a/old']))
+
+        header = '\n'.join(['diff --git a/a b/b',
+                            'similarity index 90%',
+                            'copy from a',
+                            'copy to b'])
+        self.assertEqual(diffparse.reverse_header(header), None)
+
+
+class DiffSelectionTestCase(helper.GitRepositoryTestCase):
+    """Tests applying selections with DiffParser"""
+
+    def test_repeated_selection(self):
+        source = DiffSource(helper.fixture('diff-start.txt'),
+                            helper.fixture('diff-start-reverse.txt'))
+        source.fwd = ('diff --git a/x b/x\n'
+                      '--- a/x\n'
+                      '+++ b/x\n'
+                      '@@ -1,2 +1,4 @@\n x\n+a\n x\n+a\n')
+        model = DiffParseModel()
+        parser = DiffParser(model, filename='',
+                            cached=False, reverse=False,
+                            diff_source=source)
+        # Select the second "+a" with the cursor at either end
+        for offset in (25, 28):
+            parser.process_diff_selection(True, offset, '+a\n')
+            self.assertEqual(model.last_diff,
+                             parser.header + '\n'
+                             '@@ -1,2 +1,3 @@\n x\n x\n+a\n\n\n')
+
+
+    def test_staged_deletion(self):
+        self.shell('printf "a\\nb\\n" > C && git add C && '
+                   'git commit -q -m"Add C" && git rm -q C')
+        parser = DiffParser(DiffParseModel(), filename='C', cached=True)
+        self.assertFalse(parser.reversed)
+        self.assertTrue('new file mode' in parser.header)
+        self.assertEqual(parser.diffs()[0][:3], ['@@ -0,0 +1,2 @@', '+a', '+b'])
+
 
 class RangeTestCase(unittest.TestCase):
 
@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from cola.models.diffstore import DiffStore
+
+
+DIFF = '\n'.join([
+    '@@ -1,2 +1,2 @@',
+    ' first',
+    '-second',
+    '+2nd',
+    '@@ -10,3 +10,2 @@ context',
+    ' tenth',
+    '-eleventh',
+    ' twelfth',
+    '@@ -20 +19,2 @@',
+    ' twentieth',
+    '+é',
+    '',
+])
+
+
+class DiffStoreTestCase(unittest.TestCase):
+    """Tests the DiffStore class."""
+
+    def test_chunks(self):
+        expect_lines = DIFF.split('\n')
+        # Feed the text in chunks that split lines and hunk headers
+        for size in (1, 2, 3, 7, len(DIFF)):
+            store = DiffStore()
+            for idx in range(0, len(DIFF), size):
+                store.append(DIFF[idx:idx+size])
+            self.assertEqual(len(store), len(DIFF))
+            self.assertEqual(store.line_count(), len(expect_lines))
+            self.assertEqual(list(store.hunks), [0, 4, 8])
+            self.assertEqual(store.text(), DIFF)
+            for first in range(len(expect_lines)):
+                for last in range(first, len(expect_lines) + 1):
+                    self.assertEqual(store.lines(first, last),
+                                     '\n'.join(expect_lines[first:last]))
+            for offset in range(len(DIFF)):
+                self.assertEqual(store.line_at(offset),
+                                 DIFF[:offset].count('\n'))
+                self.assertEqual(store.text(offset, offset + 5),
+                                 DIFF[offset:offset+5])
+
+    def test_hunks(self):
+        store = DiffStore(DIFF)
+        self.assertEqual(store.hunk_start(0), 0)
+        self.assertEqual(store.hunk_start(6), 4)
+        self.assertEqual(store.hunk_end(6), 8)
+        self.assertEqual(store.hunk_end(9), store.line_count())
+        self.assertEqual(store.offset(4), DIFF.index('@@ -10'))
+
+    def test_window(self):
+        store = DiffStore(DIFF)
+        # Windows start at a hunk and end at one
+        self.assertEqual(store.window(5, 4), (4, 8))
+        self.assertEqual(store.window(0, 100), (0, store.line_count()))
+        # Hunks too large for the window are entered part way through
+        self.assertEqual(store.window(7, 2), (7, 9))
+
+
+if __name__ == '__main__':
+    unittest.main()
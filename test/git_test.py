@@ -3,13 +3,20 @@
 """
 from __future__ import unicode_literals
 
+import os
 import time
 import signal
+import threading
 import unittest
 
+from cola import compat
+from cola import core
 from cola import git
+from cola import gitcmds
 from cola.git import STDOUT
 
+import helper
+
 
 class GitCommandTest(unittest.TestCase):
     """Runs tests using a git.Git instance"""
@@ -92,5 +99,130 @@ class GitCommandTest(unittest.TestCase):
         signal.signal(signal.SIGALRM, prev_handler)
 
 
+class IndexLockTestCase(helper.TmpPathTestCase):
+    """Tests the scheduling of index-writing and read-only commands"""
+
+    def setUp(self):
+        helper.TmpPathTestCase.setUp(self)
+        # A fake "git" that records when it starts and stops
+        bindir = self.test_path('bin')
+        os.mkdir(bindir)
+        fake_git = os.path.join(bindir, 'git')
+        core.write(fake_git,
+                   '#!/bin/sh\n'
+                   'python -c "import time; print(time.time())"\n'
+                   'sleep 0.5\n'
+                   'python -c "import time; print(time.time())"\n')
+        os.chmod(fake_git, 0o755)
+        self.path = os.environ.get('PATH', '')
+        compat.setenv('PATH', bindir + os.pathsep + self.path)
+        self.git = git.Git()
+
+    def tearDown(self):
+        compat.setenv('PATH', self.path)
+        helper.TmpPathTestCase.tearDown(self)
+
+    def run_concurrently(self, *cmds):
+        """Run git commands in threads and return their (start, end) times"""
+        results = {}
+        def run(idx, cmd):
+            out = self.git.git(cmd)[STDOUT]
+            results[idx] = [float(x) for x in out.split()]
+        threads = [threading.Thread(target=run, args=(idx, cmd))
+                   for idx, cmd in enumerate(cmds)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[idx] for idx in range(len(cmds))]
+
+    def test_read_only_commands_overlap(self):
+        (start_a, end_a), (start_b, end_b) = self.run_concurrently('log',
+                                                                   'grep')
+        self.assertTrue(start_a < end_b and start_b < end_a)
+
+    def test_index_writers_are_serialized(self):
+        (start_a, end_a), (start_b, end_b) = self.run_concurrently('add',
+                                                                   'reset')
+        self.assertTrue(end_a <= start_b or end_b <= start_a)
+
+    def test_optional_locks(self):
+        core.write(self.test_path('bin', 'git'),
+                   '#!/bin/sh\necho "$GIT_OPTIONAL_LOCKS"\n')
+        # Read-only commands must not take index.lock to refresh the index
+        self.assertEqual(self.git.git('diff')[STDOUT], '0')
+        self.assertEqual(self.git.git('describe', dirty=True)[STDOUT], '0')
+        self.assertEqual(self.git.git('add')[STDOUT],
+                         os.environ.get('GIT_OPTIONAL_LOCKS', ''))
+
+    def test_is_index_writer(self):
+        self.assertFalse(git.is_index_writer(['git', 'log', '-S', 'x']))
+        self.assertFalse(git.is_index_writer(['git', 'diff-index', 'HEAD']))
+        self.assertFalse(git.is_index_writer(['git', 'config', '--list']))
+        self.assertFalse(git.is_index_writer(['git', 'apply', 'patch']))
+        self.assertTrue(git.is_index_writer(['git', 'apply', '--cached']))
+        self.assertTrue(git.is_index_writer(['git', 'config', 'a.b', 'c']))
+        self.assertTrue(git.is_index_writer(['git', 'update-index']))
+        self.assertTrue(git.is_index_writer(['git', 'stash']))
+        self.assertTrue(git.is_index_writer(['git', 'checkout', 'x']))
+
+
+class CatFileTestCase(helper.GitRepositoryTestCase):
+    """Tests the persistent "git cat-file --batch" object reader"""
+
+    def setUp(self):
+        helper.GitRepositoryTestCase.setUp(self, commit=False)
+        self.shell("""
+            mkdir -p sub &&
+            echo hello > A &&
+            echo world > sub/C &&
+            git add A sub/C &&
+            git commit -m'subject' -m'body text' > /dev/null
+        """)
+        self.git = git.instance()
+
+    def test_read_object(self):
+        sha1, objtype, data = self.git.read_object('HEAD:A')
+        self.assertEqual(objtype, 'blob')
+        self.assertEqual(data, b'hello\n')
+        self.assertEqual(sha1, self.git.rev_parse('HEAD:A')[STDOUT])
+
+    def test_read_object_missing(self):
+        self.assertEqual(self.git.read_object('HEAD:missing'), None)
+        self.assertEqual(self.git.read_object('HEAD:no such file'), None)
+        # The process is still usable after a miss
+        self.assertEqual(self.git.read_object('HEAD:sub/C')[2], b'world\n')
+
+    def test_object_info(self):
+        sha1, objtype, size = self.git.object_info('HEAD')
+        self.assertEqual(objtype, 'commit')
+        self.assertEqual(sha1, self.git.rev_parse('HEAD')[STDOUT])
+        self.assertEqual(self.git.object_info('HEAD:A')[2], 6)
+
+    def test_tree_entries(self):
+        entries = self.git.tree_entries('HEAD')
+        names = [(objtype, name) for mode, objtype, sha1, name in entries]
+        self.assertEqual(names, [('blob', 'A'), ('blob', 'B'),
+                                 ('tree', 'sub')])
+
+    def test_commit_body(self):
+        self.assertEqual(gitcmds.commit_body('HEAD'), 'body text\n')
+
+    def test_set_worktree_restarts(self):
+        self.git.read_object('HEAD')
+        self.shell("""
+            mkdir other &&
+            cd other &&
+            git init > /dev/null &&
+            echo other > D &&
+            git add D &&
+            git commit -m'other' > /dev/null
+        """)
+        core.chdir('other')
+        self.git.set_worktree(core.getcwd())
+        self.assertEqual(self.git.read_object('HEAD:D')[2], b'other\n')
+        self.assertEqual(self.git.read_object('HEAD:A'), None)
+
+
 if __name__ == '__main__':
     unittest.main()
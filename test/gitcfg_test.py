@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import os
+import time
 import unittest
 
 import helper
@@ -12,6 +14,11 @@ class GitConfigTestCase(helper.GitRepositoryTestCase):
         helper.GitRepositoryTestCase.setUp(self)
         self.config = gitcfg.instance()
 
+    def tearDown(self):
+        self.config.__dict__.pop('check_interval', None)
+        self.config.__dict__.pop('attr_cache_size', None)
+        helper.GitRepositoryTestCase.tearDown(self)
+
     def test_string(self):
         """Test string values in get()."""
         self.shell('git config test.value test')
@@ -66,6 +73,61 @@ class GitConfigTestCase(helper.GitRepositoryTestCase):
         names = self.config.get_guitool_names()
         self.assertTrue('hello meow' in names)
 
+    def test_include(self):
+        self.shell('printf "[include]\n\tpath = included\n" >> .git/config')
+        self.shell('printf "[test]\n\tincluded = yes\n" > .git/included')
+        self.assertEqual(self.config.get('test.included'), True)
+        self.assertEqual(self.config.get_repo('test.included'), True)
+        self.assertEqual(self.config.get_user('test.included'), None)
+
+    def test_origin(self):
+        self.shell('git config test.value test')
+        category, origin = self.config.origin('test.value')
+        self.assertEqual(category, 'repo')
+        self.assertEqual(os.path.realpath(origin),
+                         os.path.realpath(self.test_path('.git', 'config')))
+        self.assertEqual(self.config.origin('does.not.exist'), None)
+
+    def test_check_interval(self):
+        self.shell('git config test.value old')
+        self.assertEqual(self.config.get('test.value'), 'old')
+        # Lookups within the interval do not look at the files again
+        self.config.check_interval = 60
+        self.shell('git config test.value new && git config test.size bigger')
+        self.assertEqual(self.config.get('test.value'), 'old')
+        self.config._checked = time.time() - 60
+        self.assertEqual(self.config.get('test.value'), 'new')
+
+    def test_set_repo(self):
+        self.config.check_interval = 60
+        self.assertEqual(self.config.get('test.value'), None)
+        self.config.set_repo('test.value', 'set')
+        self.assertEqual(self.config.get('test.value'), 'set')
+
+    def test_file_encodings(self):
+        self.shell('git config cola.fileattributes true')
+        self.shell('mkdir sub && '
+                   'echo "*.txt encoding=iso-8859-1" > sub/.gitattributes')
+        encodings = self.config.file_encodings(['sub/a.txt', 'b.txt', 'c.py'])
+        self.assertEqual(encodings, {'sub/a.txt': 'iso-8859-1',
+                                     'b.txt': 'utf-8',
+                                     'c.py': 'utf-8'})
+        self.assertEqual(self.config.file_encoding('sub/a.txt'), 'iso-8859-1')
+
+        # Changing a .gitattributes file forgets the cached attributes
+        self.shell('echo "*.txt encoding=utf-16le" > sub/.gitattributes')
+        self.config._attr_checked = 0.0
+        self.assertEqual(self.config.file_encoding('sub/a.txt'), 'utf-16le')
+
+    def test_file_encoding_cache_size(self):
+        self.shell('git config cola.fileattributes true')
+        self.config.attr_cache_size = 2
+        self.config.file_encodings(['a', 'b', 'c'])
+        self.assertEqual(list(self.config._attr_cache), ['b', 'c'])
+        self.config.file_encoding('b')
+        self.config.file_encoding('d')
+        self.assertEqual(list(self.config._attr_cache), ['b', 'd'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -121,5 +121,137 @@ class GitCmdsTestCase(helper.GitRepositoryTestCase):
         self.assertEqual(tags, ['d', 'e', 'f'])
 
 
+class StatusTestCase(helper.GitRepositoryTestCase):
+    """Tests the "git status --porcelain=v2" status backend."""
+
+    def assert_same_state(self):
+        v1 = [sorted(x) for x in gitcmds.diff_state()]
+        v2 = [sorted(x) for x in gitcmds.status_v2()]
+        self.assertEqual(v1, v2)
+        return v2
+
+    def test_status_v2_clean(self):
+        self.assertEqual(self.assert_same_state(), [[]] * 6)
+
+    def test_status_v2_changes(self):
+        self.shell("""
+            mkdir -p "sub dir" &&
+            echo change > A &&
+            echo staged > "sub dir/with space" &&
+            git add "sub dir/with space" &&
+            git mv B C &&
+            echo untracked > "sub dir/untracked"
+        """)
+        staged, modified, unmerged, untracked, _, _ = self.assert_same_state()
+        self.assertEqual(staged, ['B', 'C', 'sub dir/with space'])
+        self.assertEqual(modified, ['A'])
+        self.assertEqual(unmerged, [])
+        self.assertEqual(untracked, ['sub dir/untracked'])
+
+    def test_status_v2_unmerged(self):
+        self.shell("""
+            git checkout -q -b other &&
+            echo other > A &&
+            git commit -q -a -m other &&
+            git checkout -q master &&
+            echo master > A &&
+            git commit -q -a -m master &&
+            git merge other > /dev/null 2>&1 || true
+        """)
+        staged, modified, unmerged, untracked, _, _ = self.assert_same_state()
+        self.assertEqual(unmerged, ['A'])
+        self.assertEqual(modified, [])
+
+    def test_status_v2_display_untracked(self):
+        self.shell('touch C')
+        state = gitcmds.status_v2(display_untracked=False)
+        self.assertEqual(state[3], [])
+
+    def test_parse_status_v2(self):
+        tokens = [
+            '# branch.oid (initial)',
+            '1 M. N... 100644 100644 100644 %s %s staged' % ('0' * 40,
+                                                             '1' * 40),
+            '1 .M S.M. 160000 160000 160000 %s %s submodule' % ('0' * 40,
+                                                                '0' * 40),
+            '2 R. N... 100644 100644 100644 %s %s R100 new name' % ('0' * 40,
+                                                                   '0' * 40),
+            'old name',
+            'u UU N... 100644 100644 100644 100644 %s %s %s conflict' % (
+                '0' * 40, '1' * 40, '2' * 40),
+            '? untracked',
+            '! ignored',
+        ]
+        state = gitcmds.parse_status_v2(tokens)
+        self.assertEqual(state, (['staged', 'new name', 'old name'], [],
+                                 ['conflict'], ['untracked'],
+                                 set(), set(['submodule'])))
+
+
+class LastCommitsTestCase(helper.GitRepositoryTestCase):
+    """Tests the batched last-commit lookup."""
+
+    def setUp(self):
+        helper.GitRepositoryTestCase.setUp(self)
+        self.shell("""
+            mkdir -p sub/deeper &&
+            echo one > sub/C &&
+            echo two > sub/deeper/D &&
+            git add sub &&
+            git commit -q -m'add sub' &&
+            echo change > A &&
+            git commit -q -a -m'change A' &&
+            touch untracked
+        """)
+
+    def summaries(self, paths):
+        return dict((path, info and info[1])
+                    for path, info in gitcmds.last_commits(paths))
+
+    def test_last_commits(self):
+        summaries = self.summaries(['A', 'B', 'sub', 'untracked'])
+        self.assertEqual(summaries, {
+            'A': 'change A',
+            'B': 'Initial commit',
+            'sub': 'add sub',
+            'untracked': None,
+        })
+
+    def test_last_commits_subdirectory(self):
+        summaries = self.summaries(['sub/C', 'sub/deeper'])
+        self.assertEqual(summaries, {
+            'sub/C': 'add sub',
+            'sub/deeper': 'add sub',
+        })
+
+    def test_walk_stops_early(self):
+        results = list(gitcmds.walk_last_commits(['A']))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][0], 'A')
+        self.assertEqual(results[0][1][1], 'change A')
+
+    def test_walk_reports_untracked_paths_first(self):
+        results = list(gitcmds.walk_last_commits(['untracked', 'B']))
+        self.assertEqual(results[0], ('untracked', None))
+        self.assertEqual(results[1][0], 'B')
+        self.assertEqual(results[1][1][1], 'Initial commit')
+
+    def test_walk_without_pathspecs(self):
+        max_pathspecs = gitcmds.MAX_PATHSPECS
+        gitcmds.MAX_PATHSPECS = 1
+        try:
+            results = dict(gitcmds.walk_last_commits(['A', 'untracked']))
+        finally:
+            gitcmds.MAX_PATHSPECS = max_pathspecs
+        self.assertEqual(results['A'][1], 'change A')
+        self.assertEqual(results['untracked'], None)
+
+    def test_cache_follows_head(self):
+        self.summaries(['A'])
+        self.assertTrue('A' in gitcmds._last_commits.commits)
+        self.shell("echo again > A && git commit -q -a -m'again'")
+        self.assertEqual(self.summaries(['A']), {'A': 'again'})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,138 @@
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+import helper
+from cola.models import graphlayout
+
+
+def sha1(name):
+    return name * 40
+
+
+# A history with a topic branch that is merged back and a second
+# branch that stays unmerged:
+#
+#   f       (merge of d and e)
+#   |\
+#   | e     (topic)
+#   | | b   (unmerged)
+#   | c |   (topic)
+#   d | |
+#   |/ /
+#   a
+history = (
+    ('a', ''),
+    ('d', 'a'),
+    ('c', 'a'),
+    ('b', 'a'),
+    ('e', 'c'),
+    ('f', 'de'),
+)
+
+
+def layout_history(layout, entries=history):
+    return [layout.add(sha1(name), [sha1(p) for p in parents])
+            for name, parents in entries]
+
+
+class GraphLayoutTestCase(unittest.TestCase):
+    """Tests the GraphLayout class."""
+
+    def test_linear(self):
+        layout = graphlayout.GraphLayout()
+        layout_history(layout, (('a', ''), ('b', 'a'), ('c', 'b')))
+        self.assertEqual(list(layout.lanes), [0, 0, 0])
+        self.assertEqual(layout.position(2), (0, -48))
+        self.assertEqual(layout.width, 1)
+
+    def test_lanes(self):
+        layout = graphlayout.GraphLayout()
+        rows = layout_history(layout)
+        self.assertEqual(rows, list(range(len(history))))
+        # d continues a, so c and b branch out to the right
+        self.assertEqual(list(layout.lanes), [0, 0, 1, 2, 1, 0])
+        # The merge closed the topic branch's lane
+        self.assertEqual(list(layout.owners), [5, -1, 3])
+
+    def test_free_lane_is_reused(self):
+        layout = graphlayout.GraphLayout()
+        layout_history(layout, history + (('g', 'f'), ('h', 'f')))
+        # h branches from f after the topic lane was closed
+        self.assertEqual(layout.lanes[-1], 1)
+
+    def test_missing_parents_are_ignored(self):
+        layout = graphlayout.GraphLayout()
+        layout_history(layout, (('b', 'a'), ('c', 'b')))
+        self.assertEqual(list(layout.lanes), [0, 0])
+
+    def test_rewind_reuses_rows(self):
+        layout = graphlayout.GraphLayout()
+        layout_history(layout)
+        layout.rewind()
+        layout_history(layout, history[:3])
+        self.assertFalse(layout.changed)
+        self.assertEqual(layout.placed, 3)
+
+    def test_rewind_diverges(self):
+        layout = graphlayout.GraphLayout()
+        layout_history(layout)
+        layout.rewind()
+        entries = history[:3] + (('x', 'c'),)
+        layout_history(layout, entries)
+        self.assertTrue(layout.changed)
+
+        expect = graphlayout.GraphLayout()
+        layout_history(expect, entries)
+        self.assertEqual(layout.sha1s, expect.sha1s)
+        self.assertEqual(list(layout.lanes), list(expect.lanes))
+        self.assertEqual(list(layout.owners), list(expect.owners))
+
+    def test_truncate(self):
+        layout = graphlayout.GraphLayout()
+        layout_history(layout)
+        layout.truncate(3)
+        expect = graphlayout.GraphLayout()
+        layout_history(expect, history[:3])
+        self.assertEqual(layout.sha1s, expect.sha1s)
+        self.assertEqual(list(layout.lanes), list(expect.lanes))
+        self.assertEqual(list(layout.owners), list(expect.owners))
+        self.assertEqual(list(layout.lane_end), list(expect.lane_end))
+
+    def test_dumps_and_loads(self):
+        layout = graphlayout.GraphLayout(x_off=10, y_off=20)
+        layout_history(layout, history[:4])
+        copy = graphlayout.GraphLayout.loads(layout.dumps())
+        self.assertEqual((copy.x_off, copy.y_off), (10, 20))
+        self.assertEqual(copy.sha1s, layout.sha1s)
+
+        # Resuming gives the same result as laying out in one go
+        copy.rewind()
+        layout_history(copy)
+        expect = graphlayout.GraphLayout(x_off=10, y_off=20)
+        layout_history(expect)
+        self.assertEqual([copy.position(row) for row in range(len(copy))],
+                         [expect.position(row) for row in range(len(expect))])
+
+    def test_loads_invalid(self):
+        self.assertEqual(graphlayout.GraphLayout.loads(b'garbage'), None)
+        self.assertEqual(graphlayout.GraphLayout.loads(b'COLALAY1xx'), None)
+
+
+class GraphLayoutFileTestCase(helper.TmpPathTestCase):
+    """Tests storing layouts on disk."""
+
+    def test_save_and_load(self):
+        path = self.test_path('layout.cache')
+        self.assertEqual(graphlayout.load(path), None)
+        layout = graphlayout.GraphLayout()
+        layout_history(layout)
+        graphlayout.save(path, layout)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        self.assertEqual(list(graphlayout.load(path).lanes),
+                         list(layout.lanes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+
+import sys
+import unittest
+
+import helper
+from cola import version
+from cola.models import grep
+
+
+class GrepTestCase(helper.GitRepositoryTestCase):
+    """Tests the GrepProcess class."""
+
+    def setUp(self):
+        helper.GitRepositoryTestCase.setUp(self)
+        with open('big.txt', 'w') as fh:
+            for idx in range(20000):
+                fh.write('match %d\n' % idx)
+        self.shell('mkdir dir && echo "match in dir" > dir/C && '
+                   'git add big.txt dir/C')
+
+    def test_command(self):
+        cmd = grep.grep_command(['pattern'], pathspecs=['dir'], threads=3)
+        self.assertEqual(cmd[:5], ['git', 'grep', '-n', '--no-color',
+                                   '--basic-regexp'])
+        self.assertEqual(cmd[-3:], ['pattern', '--', 'dir'])
+        if version.check('grep-threads', version.git_version()):
+            self.assertTrue('--threads=3' in cmd)
+        # Shell arguments can hold their own separator
+        cmd = grep.grep_command(['-i', 'pattern', '--', 'A'],
+                                pathspecs=['dir'])
+        self.assertEqual(cmd[-5:], ['-i', 'pattern', '--', 'A', 'dir'])
+
+    def test_chunks(self):
+        process = grep.GrepProcess(['match'])
+        process.chunk_size = 4096
+        chunks = list(process.chunks())
+        self.assertTrue(len(chunks) > 1)
+        lines = [line for chunk in chunks for line in chunk]
+        self.assertEqual(len(lines), 20001)
+        self.assertEqual(lines[0], 'big.txt:1:match 0')
+        self.assertEqual(lines[-1], 'dir/C:1:match in dir')
+        self.assertEqual(process.status, 0)
+
+    def test_pathspecs(self):
+        process = grep.GrepProcess(['match'], pathspecs=['dir'])
+        self.assertEqual(list(process.chunks()), [['dir/C:1:match in dir']])
+
+    def test_no_match(self):
+        process = grep.GrepProcess(['nothing-matches-this'])
+        self.assertEqual(list(process.chunks()), [])
+        self.assertEqual(process.status, 1)
+
+    def test_streaming(self):
+        process = grep.GrepProcess(['match'])
+        # Output that arrives slowly is returned as soon as it is read
+        process.cmd = [sys.executable, '-c',
+                       'import sys, time; print("first"); '
+                       'sys.stdout.flush(); time.sleep(5); print("second")']
+        chunks = process.chunks()
+        self.assertEqual(next(chunks), ['first'])
+        self.assertEqual(process.proc.poll(), None)
+        process.kill()
+        list(chunks)
+
+    def test_kill(self):
+        process = grep.GrepProcess(['match'])
+        process.chunk_size = 4096
+        chunks = process.chunks()
+        next(chunks)
+        process.kill()
+        # The rest of the output is not waited for
+        remaining = list(chunks)
+        self.assertTrue(process.proc.poll() is not None)
+        self.assertTrue(len(remaining) < 20000)
+
+        # Killing before starting stops it from starting
+        process = grep.GrepProcess(['match'])
+        process.kill()
+        self.assertEqual(list(process.chunks()), [])
+        self.assertEqual(process.proc, None)
+
+    def test_abandon(self):
+        process = grep.GrepProcess(['match'])
+        process.chunk_size = 4096
+        chunks = process.chunks()
+        next(chunks)
+        chunks.close()
+        self.assertTrue(process.killed)
+        self.assertTrue(process.proc.poll() is not None)
+
+
+if __name__ == '__main__':
+    unittest.main()
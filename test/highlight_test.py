@@ -0,0 +1,75 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from cola.models import highlight
+
+if highlight.have_pygments:
+    from pygments.token import Token
+
+
+TEXT = '''def f(x):
+    """Doc
+
+    string"""
+    return x
+'''
+
+
+@unittest.skipIf(not highlight.have_pygments, 'pygments is not installed')
+class HighlightTestCase(unittest.TestCase):
+    """Tests the cola.models.highlight module."""
+
+    def test_blob_sha1(self):
+        # git hash-object of "hello\\n"
+        self.assertEqual(highlight.blob_sha1('hello\n'),
+                         'ce013625030ba8dba906f756967f9e9ca394464a')
+
+    def test_tokenize(self):
+        lexer = highlight.lexer_for_filename('test.py')
+        lines = highlight.tokenize(TEXT, lexer)
+        text_lines = TEXT.split('\n')
+        self.assertEqual(len(lines), len(text_lines))
+        # The runs of each line cover it without overlapping
+        for runs, text in zip(lines, text_lines):
+            column = 0
+            for start, length, token in runs:
+                self.assertTrue(start >= column)
+                column = start + length
+            self.assertTrue(column <= len(text))
+        self.assertEqual(lines[0][0], (0, 3, Token.Keyword))
+        # Multi-line tokens are split at each line
+        self.assertEqual(lines[2], ())
+        self.assertEqual(lines[3][-1][2], Token.Literal.String.Doc)
+        self.assertEqual(lines[3][-1][:2], (0, 13))
+
+    def test_cancel(self):
+        lexer = highlight.lexer_for_filename('test.py')
+        self.assertEqual(highlight.tokenize(TEXT, lexer, lambda: True), None)
+
+    def test_cache(self):
+        cache = highlight.TokenCache()
+        self.assertEqual(cache.tokens(TEXT, 'README.unknown-extension'), None)
+        lines = cache.tokens(TEXT, 'test.py')
+        self.assertEqual(len(cache), 1)
+        # The cached runs are returned without lexing again
+        self.assertTrue(cache.tokens(TEXT, 'other.py',
+                                     cancel=lambda: True) is lines)
+        self.assertTrue(cache.tokens('', 'test.py', cancel=lambda: True,
+                                     sha1=highlight.blob_sha1(TEXT)) is lines)
+
+    def test_eviction(self):
+        cache = highlight.TokenCache(max_runs=10)
+        cache.put('a', [(), ()])
+        cache.put('b', [((0, 1, Token),)] * 4)
+        self.assertEqual(cache.size, 10)
+        cache.get('a')
+        cache.put('c', [()])
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.size, 3)
+        cache.put('d', [()] * 11)
+        self.assertFalse('d' in cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
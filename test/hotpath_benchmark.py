@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+"""Time git-cola's hot paths against a synthetic repository
+
+Usage: python test/hotpath_benchmark.py [options] [--output results.json]
+                                        [--compare old-results.json]
+
+A deterministic repository is generated with "git fast-import" using the
+shape given on the command line: the number of files and how deeply they
+are nested, the length of the history and how often it merges, and the
+number of branches and tags.  The status backends, refs, DAG, graph
+layout, diff parser and completion code paths are then timed against it.
+The commit graph is also built from --graph-commits synthetic "git log"
+entries to time it and, with tracemalloc, to measure its memory.
+
+The results are written as JSON with --output so that runs from
+different commits can be compared with --compare.  No display is
+needed; the completion model uses a QApplication without a GUI and is
+skipped when PyQt4 is unavailable.
+
+"""
+from __future__ import division, absolute_import, unicode_literals
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, srcdir)
+
+from cola import core
+from cola import diffparse
+from cola import git
+from cola import gitcmds
+from cola import version
+from cola.models import dag
+from cola.models import graphlayout
+from cola.models.main import model as main_model
+
+
+BENCHMARK_ENV = {
+    'GIT_AUTHOR_NAME': 'Benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+    'GIT_COMMITTER_NAME': 'Benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@example.com',
+}
+
+DIFF_FILE = 'large-diff.txt'
+
+
+def file_path(idx, depth, per_dir=64, fanout=8):
+    """Return the path of the idx-th file for a tree `depth` levels deep"""
+    number = idx // per_dir
+    parts = []
+    for level in range(depth - 1):
+        parts.append('d%d' % (number % fanout))
+        number //= fanout
+    if depth:
+        parts.append('top%d' % number)
+    parts.reverse()
+    parts.append('file%06d.txt' % idx)
+    return '/'.join(parts)
+
+
+def fast_import_stream(args):
+    """Generate the "git fast-import" commands for a synthetic history"""
+    rand = random.Random(args.seed)
+    paths = [file_path(idx, args.depth) for idx in range(args.files)]
+    stamp = 1400000000
+
+    def data(text):
+        text = text.encode('utf-8')
+        return b'data ' + str(len(text)).encode('ascii') + b'\n' + text + b'\n'
+
+    def commit(mark, parent, message, merge=None):
+        lines = ['commit refs/heads/master',
+                 'mark :%d' % mark,
+                 'author Benchmark <benchmark@example.com> %d +0000'
+                 % (stamp + mark),
+                 'committer Benchmark <benchmark@example.com> %d +0000'
+                 % (stamp + mark)]
+        out = '\n'.join(lines).encode('ascii') + b'\n' + data(message)
+        if parent:
+            out += ('from :%d\n' % parent).encode('ascii')
+        if merge:
+            out += ('merge :%d\n' % merge).encode('ascii')
+        return out
+
+    def modify(path, text):
+        return ('M 100644 inline %s\n' % path).encode('utf-8') + data(text)
+
+    # The first commit adds every file
+    yield commit(1, None, 'Initial commit')
+    for idx, path in enumerate(paths):
+        yield modify(path, 'file %d\nline two\nline three\n' % idx)
+    yield modify(DIFF_FILE, ''.join('line %d\n' % idx
+                                    for idx in range(args.diff_lines)))
+
+    # Later commits change one file each.  Topic branches fork from the
+    # mainline and are merged back at a rate of --merge-density.
+    mainline = 1
+    topics = []
+    marks = [1]
+    for mark in range(2, args.commits + 1):
+        choice = rand.random()
+        path = paths[rand.randrange(len(paths))] if paths else DIFF_FILE
+        if topics and choice < args.merge_density:
+            topic = topics.pop(rand.randrange(len(topics)))
+            yield commit(mark, mainline, 'Merge topic %d' % topic, topic)
+            mainline = mark
+        elif choice < 0.5:
+            if topics and rand.random() < 0.7:
+                pos = rand.randrange(len(topics))
+                parent = topics[pos]
+                topics[pos] = mark
+            else:
+                parent = mainline
+                topics.append(mark)
+            yield commit(mark, parent, 'Topic commit %d' % mark)
+            yield modify(path, 'topic change %d\n' % mark)
+        else:
+            yield commit(mark, mainline, 'Commit %d' % mark)
+            yield modify(path, 'change %d\n' % mark)
+            mainline = mark
+        marks.append(mark)
+
+    yield ('reset refs/heads/master\nfrom :%d\n\n' % mainline).encode('ascii')
+    for idx in range(args.branches):
+        mark = marks[rand.randrange(len(marks))]
+        yield ('reset refs/heads/branch%04d\nfrom :%d\n\n'
+               % (idx, mark)).encode('ascii')
+    for idx in range(args.tags):
+        mark = marks[rand.randrange(len(marks))]
+        yield ('reset refs/tags/v%d.%d\nfrom :%d\n\n'
+               % (idx // 10, idx % 10, mark)).encode('ascii')
+
+
+def start(path, *cmd):
+    env = os.environ.copy()
+    env.update(BENCHMARK_ENV)
+    proc = subprocess.Popen(cmd, cwd=path, env=env, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return proc
+
+
+def check(proc, out, err):
+    if proc.returncode != 0:
+        raise SystemExit(core.decode(err))
+    return out
+
+
+def create_repo(path, args):
+    """Create the synthetic repository and leave its worktree dirty"""
+    proc = start(path, 'git', 'init', '-q')
+    check(proc, *proc.communicate())
+
+    proc = start(path, 'git', 'fast-import', '--quiet')
+    try:
+        for chunk in fast_import_stream(args):
+            proc.stdin.write(chunk)
+    finally:
+        proc.stdin.close()
+    out, err = proc.stdout.read(), proc.stderr.read()
+    proc.wait()
+    check(proc, out, err)
+
+    proc = start(path, 'git', 'reset', '-q', '--hard', 'master')
+    check(proc, *proc.communicate())
+
+    # A few files in every state, and a large diff for the diff parser
+    rand = random.Random(args.seed)
+    for idx in range(min(args.files, 50)):
+        filename = os.path.join(path, file_path(idx, args.depth))
+        core.write(filename, 'changed\n')
+        if idx % 2:
+            proc = start(path, 'git', 'add', '--', file_path(idx, args.depth))
+            check(proc, *proc.communicate())
+    for idx in range(50):
+        core.write(os.path.join(path, 'untracked%02d.txt' % idx), 'new\n')
+    lines = []
+    for idx in range(args.diff_lines):
+        if rand.random() < 0.05:
+            lines.append('changed line %d\n' % idx)
+        else:
+            lines.append('line %d\n' % idx)
+    core.write(os.path.join(path, DIFF_FILE), ''.join(lines))
+
+
+def log_entries(count, authors=50):
+    """Generate "git log" entries in the format read by RepoReader
+
+    Every tenth commit is a merge.
+
+    """
+    names = ['Author %d' % idx for idx in range(authors)]
+    for idx in range(count):
+        parents = []
+        if idx:
+            parents.append('%040x' % (idx - 1))
+        if idx > 10 and idx % 10 == 0:
+            parents.append('%040x' % (idx - 7))
+        name = names[idx % authors]
+        email = name.lower().replace(' ', '') + '@example.com'
+        yield dag.logsep.join(('%040x' % idx, ' '.join(parents), '', name,
+                               '2014-01-01 12:00:%02d' % (idx % 60), email,
+                               'Commit summary number %d' % idx))
+
+
+def build_graph(entries):
+    graph = dag.CommitGraph()
+    for log_entry in entries:
+        graph.add(log_entry)
+    return graph
+
+
+def graph_memory(entries):
+    """Return the bytes allocated for a CommitGraph, or None"""
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        # The graph is kept alive while it is measured
+        graph = build_graph(entries)
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func, repeat, setup=None):
+    """Return the wall times for calling func() `repeat` times"""
+    times = []
+    for idx in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+
+class CachedDiffSource(object):
+    """Serves one diff so that DiffParser is timed without git"""
+
+    def __init__(self, header, diff):
+        self.header = header
+        self.diff = diff
+
+    def get(self, head, amending, filename, cached, reverse):
+        return (self.header, self.diff)
+
+
+def benchmarks(args):
+    """Generate (name, func, setup) tuples for every benchmark"""
+    model = main_model()
+    reader_cache = git.instance().git_path('cola-dag.cache')
+
+    def remove_reader_cache():
+        if core.exists(reader_cache):
+            os.remove(reader_cache)
+
+    def read_dag():
+        reader = dag.RepoReader(dag.DAG('HEAD', args.commits), cache=True)
+        reader.reset()
+        return list(reader)
+
+    yield ('gitcmds.worktree_state_dict',
+           lambda: gitcmds.worktree_state_dict(), None)
+    # Refresh the index once so that neither backend pays for it
+    git.instance().update_index(refresh=True)
+    yield ('gitcmds.diff_state', lambda: gitcmds.diff_state(), None)
+    yield ('gitcmds.status_v2', lambda: gitcmds.status_v2(), None)
+    yield ('gitcmds.all_refs', lambda: gitcmds.all_refs(), None)
+    yield ('RepoReader (cold)', read_dag, remove_reader_cache)
+    yield ('RepoReader (cached)', read_dag, None)
+
+    entries = list(log_entries(args.graph_commits))
+    yield ('CommitGraph.add', lambda: build_graph(entries), None)
+
+    commits = read_dag()
+    yield ('GraphLayout.add_commits',
+           lambda: graphlayout.GraphLayout().add_commits(commits), None)
+
+    layout = graphlayout.GraphLayout()
+    layout.add_commits(commits)
+    data = layout.dumps()
+
+    def resume_layout():
+        resumed = graphlayout.GraphLayout.loads(data)
+        resumed.rewind()
+        resumed.add_commits(commits)
+
+    yield ('GraphLayout.dumps', layout.dumps, None)
+    yield ('GraphLayout.loads (resumed)', resume_layout, None)
+
+    header, diff = gitcmds.diff_helper(filename=DIFF_FILE, cached=False,
+                                       with_diff_header=True)
+    source = CachedDiffSource(header, diff)
+    yield ('DiffParser.parse_diff',
+           lambda: diffparse.DiffParser(model, filename=DIFF_FILE,
+                                        diff_source=source), None)
+
+    # Stage a few lines from the middle of the largest hunk
+    parser = diffparse.DiffParser(model, filename=DIFF_FILE,
+                                  diff_source=source)
+    spans = parser.spans()
+    if spans:
+        hunk = max(range(len(spans)),
+                   key=lambda idx: spans[idx][1] - spans[idx][0])
+        middle = (spans[hunk][0] + spans[hunk][1]) // 2
+        yield ('DiffParser.diff_subset',
+               lambda: parser.diff_subset(hunk, middle, middle + 200), None)
+
+    completion = completion_benchmark(model)
+    if completion is not None:
+        yield completion
+
+
+def completion_benchmark(model):
+    """Return the completion benchmark, or None without PyQt4"""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt4 import QtGui
+        from cola.widgets import completion
+    except ImportError:
+        sys.stdout.write('skipping completion: PyQt4 is not available\n')
+        return None
+    # A QApplication without a GUI does not need a display
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv, False)
+    completer = completion.GitLogCompletionModel(None)
+    # Keep the application alive for as long as the benchmark
+    gather = lambda: (app, completer.gather_matches('file00', False))
+    return ('GitLogCompletionModel.gather_matches', gather, None)
+
+
+def source_revision():
+    proc = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=srcdir,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return core.decode(out).strip() or None
+
+
+def compare(results, path):
+    """Print the change in the median time relative to an earlier run"""
+    with open(path) as fh:
+        old = json.load(fh)
+    old_results = old.get('results', {})
+    sys.stdout.write('\ncompared to %s (%s):\n'
+                     % (path, old.get('revision') or 'unknown revision'))
+    for name, result in sorted(results.items()):
+        before = old_results.get(name)
+        if not before or not before['median']:
+            sys.stdout.write('%-40s n/a\n' % name)
+            continue
+        change = (result['median'] / before['median'] - 1.0) * 100.0
+        sys.stdout.write('%-40s %8.3fs -> %8.3fs  %+6.1f%%\n'
+                         % (name, before['median'], result['median'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=10000,
+                        help='number of files in the repository')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='directory depth of the files')
+    parser.add_argument('--commits', type=int, default=5000,
+                        help='number of commits in the history')
+    parser.add_argument('--merge-density', type=float, default=0.1,
+                        help='fraction of commits that merge a topic branch')
+    parser.add_argument('--branches', type=int, default=200,
+                        help='number of branches')
+    parser.add_argument('--tags', type=int, default=200,
+                        help='number of tags')
+    parser.add_argument('--diff-lines', type=int, default=20000,
+                        help='length of the file used for the diff parser')
+    parser.add_argument('--graph-commits', type=int, default=100000,
+                        help='number of synthetic commits for CommitGraph')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the repository generator')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed runs per benchmark')
+    parser.add_argument('--output', metavar='<path>',
+                        help='write the results to <path> as JSON')
+    parser.add_argument('--compare', metavar='<path>',
+                        help='compare with the results from an earlier run')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated repository')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp('_cola_benchmark')
+    results = {}
+    try:
+        sys.stdout.write('creating repository in %s\n' % path)
+        start = time.time()
+        create_repo(path, args)
+        sys.stdout.write('created in %.1fs\n' % (time.time() - start))
+
+        os.chdir(path)
+        model = main_model()
+        model.set_worktree(path)
+        model.update_status()
+
+        for name, func, setup in benchmarks(args):
+            times = sorted(measure(func, args.repeat, setup=setup))
+            results[name] = {
+                'best': times[0],
+                'median': times[len(times) // 2],
+                'mean': sum(times) / len(times),
+                'runs': times,
+            }
+            sys.stdout.write('%-40s best %8.3fs  median %8.3fs\n'
+                             % (name, times[0], times[len(times) // 2]))
+        memory = graph_memory(log_entries(args.graph_commits))
+        if memory is not None:
+            sys.stdout.write('%-40s %8.1f MB\n'
+                             % ('CommitGraph memory', memory / 1e6))
+    finally:
+        os.chdir(srcdir)
+        if args.keep:
+            sys.stdout.write('kept %s\n' % path)
+        else:
+            shutil.rmtree(path)
+
+    shape = dict((key, getattr(args, key))
+                 for key in ('files', 'depth', 'commits', 'merge_density',
+                             'branches', 'tags', 'diff_lines',
+                             'graph_commits', 'seed', 'repeat'))
+    data = {
+        'revision': source_revision(),
+        'version': version.version(),
+        'git_version': version.git_version_str(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'shape': shape,
+        'results': results,
+        'memory': {'CommitGraph': memory},
+    }
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(json.dumps(data, indent=1, sort_keys=True))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
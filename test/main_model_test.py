@@ -1,11 +1,14 @@
 from __future__ import unicode_literals
 
 import os
+import threading
 import unittest
 
 import helper
 from cola import core
 from cola.models.main import MainModel
+from cola.models.main import RefreshRequest
+from cola.models.main import RefreshScheduler
 
 
 class MainModelTestCase(helper.GitRepositoryTestCase):
@@ -74,6 +77,148 @@ class MainModelTestCase(helper.GitRepositoryTestCase):
         self.model.update_status()
         self.assertEqual(self.model.tags, ['test'])
 
+    def test_update_paths(self):
+        """Test refreshing a subset of paths."""
+        self.shell('echo change > A')
+        self.model.update_status()
+        self.shell("""
+            echo change > B &&
+            : > A &&
+            mkdir D &&
+            echo D > D/E
+        """)
+        # Only the given paths are refreshed; "A" is left as-is
+        self.model.update_paths(['B', 'D'])
+        self.assertEqual(self.model.modified, ['A', 'B'])
+        self.assertEqual(self.model.untracked, ['D/E'])
+
+        self.shell('rm -r D')
+        self.model.update_paths(['D/E'])
+        self.assertEqual(self.model.untracked, [])
+
+    def test_update_paths_gitignore(self):
+        """Test that update_paths() rescans everything for .gitignore."""
+        self.shell('echo x > C.log && echo x > D.log')
+        self.model.update_status()
+        self.assertEqual(self.model.untracked, ['C.log', 'D.log'])
+        self.shell('echo "*.log" > .gitignore')
+        self.model.update_paths(['.gitignore'])
+        self.assertEqual(self.model.untracked, ['.gitignore'])
+
+        self.shell('rm .gitignore')
+        self.model.update_paths(['.gitignore'])
+        self.assertEqual(self.model.untracked, ['C.log', 'D.log'])
+
+    def test_update_paths_index_changed(self):
+        """Test that update_paths() rescans everything when the index changes."""
+        self.model.update_status()
+        self.shell("""
+            echo change > A &&
+            git add A &&
+            echo change > B
+        """)
+        self.model.update_paths(['B'])
+        self.assertEqual(self.model.staged, ['A'])
+        self.assertEqual(self.model.modified, ['B'])
+
+    def test_update_file_status_only_reads_files(self):
+        self.model.update_file_status()
+        self.assertEqual(self.model.scheduler.stats()['parts'],
+                         {MainModel.refresh_files: 1})
+
+    def test_dispatcher(self):
+        dispatched = []
+        seen = []
+
+        def dispatcher(fn, *args, **kwargs):
+            dispatched.append(fn)
+            fn(*args, **kwargs)
+
+        def observe(message):
+            seen.append((message, bool(dispatched), list(self.model.modified)))
+
+        self.model.dispatcher = dispatcher
+        self.model.add_observer(self.model.message_about_to_update,
+                                lambda: observe('about_to_update'))
+        self.model.add_observer(self.model.message_updated,
+                                lambda: observe('updated'))
+        self.shell('echo change > A')
+        self.model.refresh()
+        self.model.scheduler.wait()
+        # The model is only changed by the dispatched call, between
+        # the two notifications
+        self.assertEqual(seen, [('about_to_update', True, []),
+                                ('updated', True, ['A'])])
+
+
+class RefreshSchedulerTestCase(unittest.TestCase):
+    """Tests the RefreshScheduler class."""
+
+    def setUp(self):
+        self.requests = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.scheduler = RefreshScheduler(self.refresh)
+
+    def refresh(self, request):
+        self.requests.append(request)
+        self.started.set()
+        self.release.wait()
+
+    def test_overlapping_requests_are_merged(self):
+        files = MainModel.refresh_files
+        refs = MainModel.refresh_refs
+        self.scheduler.request(RefreshRequest([files], paths=['a']))
+        self.started.wait()
+        # A refresh is in flight so these are merged into one
+        self.scheduler.request(RefreshRequest([files], paths=['b']))
+        self.scheduler.request(RefreshRequest([refs], update_index=True))
+        self.scheduler.request(RefreshRequest([files], paths=['c']))
+        self.release.set()
+        self.scheduler.wait()
+
+        self.assertEqual(len(self.requests), 2)
+        pending = self.requests[1]
+        self.assertEqual(pending.parts, set([files, refs]))
+        self.assertEqual(pending.paths, set(['b', 'c']))
+        self.assertTrue(pending.update_index)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['requests'], 4)
+        self.assertEqual(stats['refreshes'], 2)
+        self.assertEqual(stats['coalesced'], 2)
+
+    def test_synchronous_request(self):
+        self.release.set()
+        self.scheduler.request(RefreshRequest([MainModel.refresh_refs]),
+                               wait=True)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_pending_request_survives_error(self):
+        requests = []
+
+        def refresh(request):
+            requests.append(request)
+            if len(requests) == 1:
+                self.started.set()
+                self.release.wait()
+                raise ValueError('refresh failed')
+
+        scheduler = RefreshScheduler(refresh)
+        scheduler.request(RefreshRequest([MainModel.refresh_files]))
+        self.started.wait()
+        scheduler.request(RefreshRequest([MainModel.refresh_refs]))
+        self.release.set()
+        scheduler.wait()
+        # The request merged while the failing refresh ran was serviced
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[1].parts, set([MainModel.refresh_refs]))
+
+    def test_full_refresh_wins(self):
+        files = MainModel.refresh_files
+        request = RefreshRequest([files], paths=['a'])
+        request.merge(RefreshRequest([files]))
+        self.assertEqual(request.paths, None)
+
 
 if __name__ == '__main__':
     unittest.main()
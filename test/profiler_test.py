@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import threading
+import time
+import unittest
+
+import helper
+from cola import git
+from cola import profiler
+
+
+def run(command):
+    git.Git.execute(command)
+    for record in reversed(profiler.instance().records):
+        if record['command'] == command:
+            return record
+    return None
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """Tests the profiler helpers."""
+
+    def test_subcommand(self):
+        self.assertEqual(profiler.subcommand(['git', 'status']), 'status')
+        self.assertEqual(profiler.subcommand(
+            ['git', '-c', 'core.quotepath=false', '--no-pager', 'log', '-1']),
+            'log')
+        self.assertEqual(profiler.subcommand(['/usr/bin/git', 'diff']), 'diff')
+        self.assertEqual(profiler.subcommand(['python', '-c', 'x']), 'python')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(profiler.percentile(values, 50), 50)
+        self.assertEqual(profiler.percentile(values, 95), 95)
+        self.assertEqual(profiler.percentile(values, 99), 99)
+        self.assertEqual(profiler.percentile([7], 99), 7)
+        self.assertEqual(profiler.percentile([], 50), 0.0)
+
+    def test_ring_is_bounded(self):
+        prof = profiler.Profiler(size=3)
+
+        class Proc(object):
+            returncode = 0
+
+        for idx in range(5):
+            proc = Proc()
+            prof.started(proc, ['git', 'log', '-%d' % idx])
+            prof.finished(proc, b'out', b'')
+        self.assertEqual(len(prof.records), 3)
+        self.assertEqual(prof.count, 5)
+        summary = prof.summary()['log']
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['stdout'], 9)
+        self.assertEqual(summary['failed'], 0)
+
+
+class ExecuteProfileTestCase(unittest.TestCase):
+    """Tests that commands run by Git.execute() are recorded."""
+
+    def test_execute(self):
+        record = run(['python', '-c', 'import sys; sys.stdout.write("abc")'])
+        self.assertEqual(record['status'], 0)
+        self.assertEqual(record['stdout'], 3)
+        self.assertEqual(record['stderr'], 0)
+        self.assertTrue(record['elapsed'] >= 0.0)
+        self.assertTrue(record['index_writer'])
+        self.assertFalse(record.get('lock_contended'))
+        self.assertEqual(record['caller'], __name__ + '.run')
+
+    def test_exit_status(self):
+        record = run(['python', '-c', 'import sys; sys.exit(3)'])
+        self.assertEqual(record['status'], 3)
+
+    def test_lock_contention(self):
+        command = ['python', '-c', 'pass']
+        result = []
+        git.INDEX_LOCK.acquire()
+        try:
+            thread = threading.Thread(target=lambda: result.append(run(command)))
+            thread.start()
+            time.sleep(0.1)
+        finally:
+            git.INDEX_LOCK.release()
+        thread.join()
+        record = result[0]
+        self.assertTrue(record['lock_contended'])
+        self.assertTrue(record['lock_wait'] > 0.05)
+        self.assertTrue(profiler.instance().summary()['python']
+                        ['lock_contended'] >= 1)
+
+
+class DumpTestCase(helper.TmpPathTestCase):
+    """Tests writing the profile as JSON."""
+
+    def test_dump(self):
+        prof = profiler.Profiler()
+
+        class Proc(object):
+            returncode = 1
+
+        proc = Proc()
+        prof.started(proc, ['git', 'status'] + ['path'] * 20)
+        prof.finished(proc)
+        path = self.test_path('profile.json')
+        prof.dump(path)
+        with open(path) as fh:
+            data = json.load(fh)
+        self.assertEqual(data['pid'], os.getpid())
+        self.assertEqual(data['summary']['status']['failed'], 1)
+        record = data['records'][0]
+        self.assertEqual(len(record['command']), profiler.MAX_ARGS + 1)
+        self.assertEqual(record['stdout'], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
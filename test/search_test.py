@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+import helper
+from cola.git import git
+from cola.models import search
+
+
+class CommitIndexTestCase(helper.GitRepositoryTestCase):
+    """Tests the CommitIndex class."""
+
+    def setUp(self):
+        helper.GitRepositoryTestCase.setUp(self)
+        self.commit('Fix the frobnicator', 'Handles widgets too',
+                    'Alice A <alice@example.com>', '2010-01-01T00:00:00')
+        self.commit('Add widgets', 'The frobnicator is unchanged',
+                    'Bob B <bob@example.com>', '2012-01-01T00:00:00')
+
+    def commit(self, summary, body, author, date):
+        self.shell('echo "%s" >> A && git add A && '
+                   'GIT_COMMITTER_DATE=%s git commit -q -m"%s" -m"%s" '
+                   '--author="%s" --date=%s' %
+                   (summary, date, summary, body, author, date))
+
+    def index(self):
+        return search.CommitIndex(self.test_path('index'))
+
+    def sha1(self, rev):
+        return git.rev_parse(rev)[1].strip()
+
+    def test_not_ready(self):
+        index = self.index()
+        self.assertEqual(index.search_messages('widgets'), None)
+        self.assertEqual(index.search_authors('alice'), None)
+
+    def test_search_messages(self):
+        index = self.index()
+        self.assertTrue(index.update())
+        self.assertEqual(len(index), 3)
+
+        results = index.search_messages('widgets')
+        # Commits with the words in their summary come first
+        self.assertEqual([sha1 for sha1, summary in results],
+                         [self.sha1('HEAD'), self.sha1('HEAD~')])
+        self.assertTrue(results[0][1].startswith('Bob B - Add widgets - '))
+
+        results = index.search_messages('frob')
+        self.assertEqual([sha1 for sha1, summary in results],
+                         [self.sha1('HEAD~'), self.sha1('HEAD')])
+
+        results = index.search_messages('Frobnicator UNCHANGED')
+        self.assertEqual([sha1 for sha1, summary in results],
+                         [self.sha1('HEAD')])
+        self.assertEqual(index.search_messages('missing'), [])
+        self.assertEqual(len(index.search_messages('widgets',
+                                                   max_count=1)), 1)
+
+    def test_search_people_and_dates(self):
+        index = self.index()
+        index.update()
+        results = index.search_authors('ALICE@example')
+        self.assertEqual([sha1 for sha1, summary in results],
+                         [self.sha1('HEAD~')])
+        results = index.search_committers('@')
+        self.assertEqual(len(results), 3)
+
+        start = time.mktime((2011, 1, 1, 0, 0, 0, 0, 0, -1))
+        end = time.mktime((2013, 1, 1, 0, 0, 0, 0, 0, -1))
+        results = index.search_dates(start, end)
+        self.assertEqual([sha1 for sha1, summary in results],
+                         [self.sha1('HEAD')])
+
+    def test_incremental(self):
+        index = self.index()
+        index.update()
+        self.assertFalse(index.update())
+
+        self.commit('Remove gadgets', '', 'Carol C <carol@example.com>',
+                    '2013-01-01T00:00:00')
+        # A new instance reads the saved index and adds the new commit
+        index = self.index()
+        self.assertTrue(index.update())
+        self.assertEqual(len(index), 4)
+        self.assertEqual(len(index.search_messages('widgets')), 2)
+        self.assertEqual(index.search_messages('gadgets')[0][0],
+                         self.sha1('HEAD'))
+
+    def test_rewritten_history(self):
+        index = self.index()
+        index.update()
+        self.shell('git reset -q --hard HEAD~ && git reflog expire '
+                   '--expire=now --all && git gc -q --prune=now')
+        self.commit('Add gizmos', '', 'Bob B <bob@example.com>',
+                    '2012-01-01T00:00:00')
+        self.assertTrue(index.update())
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.search_messages('unchanged'), [])
+        self.assertEqual(len(index.search_messages('gizmos')), 1)
+
+    def test_corrupt_index(self):
+        with open(self.test_path('index'), 'wb') as fh:
+            fh.write(search.CommitIndex.magic + b'garbage')
+        index = self.index()
+        self.assertTrue(index.update())
+        self.assertEqual(len(index), 3)
+
+
+class PickaxeSearchTestCase(helper.GitRepositoryTestCase):
+    """Tests the PickaxeSearch class."""
+
+    def test_results(self):
+        self.shell('echo needle > B && git commit -q -a -m"Add a needle"')
+        results = list(search.PickaxeSearch('needle').results())
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][0], git.rev_parse('HEAD')[1].strip())
+        self.assertTrue(' - Add a needle - ' in results[0][1])
+
+    def test_kill(self):
+        pickaxe = search.PickaxeSearch('needle')
+        pickaxe.kill()
+        self.assertEqual(list(pickaxe.results()), [])
+
+
+class RelativeDateTestCase(unittest.TestCase):
+
+    def test_relative_date(self):
+        now = 1000000000
+        day = 24 * 60 * 60
+        self.assertEqual(search.relative_date(now - 1, now), '1 second ago')
+        self.assertEqual(search.relative_date(now - 120, now),
+                         '2 minutes ago')
+        self.assertEqual(search.relative_date(now - 3 * 3600, now),
+                         '3 hours ago')
+        self.assertEqual(search.relative_date(now - 3 * day, now),
+                         '3 days ago')
+        self.assertEqual(search.relative_date(now - 21 * day, now),
+                         '3 weeks ago')
+        self.assertEqual(search.relative_date(now - 100 * day, now),
+                         '3 months ago')
+        self.assertEqual(search.relative_date(now - 400 * day, now),
+                         '1 year, 1 month ago')
+        self.assertEqual(search.relative_date(now - 730 * day, now),
+                         '2 years ago')
+        self.assertEqual(search.relative_date(now - 3650 * day, now),
+                         '10 years ago')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+import helper
+from cola.models import storage
+
+
+class StorageTestCase(helper.TmpPathTestCase):
+    """Tests the binary storage helpers."""
+
+    def test_round_trip(self):
+        sha1s = ['a' * 40, '0123456789abcdef0123456789abcdef01234567']
+        parts = [storage.sha1s_to_bytes(sha1s),
+                 storage.array_to_bytes([1, -2, 3]),
+                 storage.array_to_bytes([2 ** 40], 'd'),
+                 storage.strings_to_bytes(['one', '', 'thr\xe9e']),
+                 b'']
+        data = storage.pack(parts)
+        self.assertEqual(storage.unpack(data), parts)
+
+        sha1s_data, ints, doubles, strings, empty = storage.unpack(data)
+        self.assertEqual(storage.sha1s_from_bytes(sha1s_data), sha1s)
+        self.assertEqual(list(storage.array_from_bytes(ints)), [1, -2, 3])
+        self.assertEqual(list(storage.array_from_bytes(doubles, 'd')),
+                         [2 ** 40])
+        self.assertEqual(storage.strings_from_bytes(strings),
+                         ['one', '', 'thr\xe9e'])
+        self.assertEqual(storage.strings_from_bytes(empty), [])
+
+    def test_truncated(self):
+        data = storage.pack([b'abc', b'defg'])
+        self.assertRaises(ValueError, storage.unpack, data[:-1])
+        self.assertRaises(ValueError, storage.unpack, data[:2])
+
+    def test_write(self):
+        path = self.test_path('dir', 'file')
+        self.assertTrue(storage.write(path, b'first'))
+        self.assertTrue(storage.write(path, b'second'))
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), b'second')
+        self.assertEqual(os.listdir(self.test_path('dir')), ['file'])
+        self.assertFalse(storage.write(self.test_path('dir', 'file', 'x'), b''))
+        # A failed write leaves no temporary file behind
+        os.mkdir(self.test_path('dir', 'subdir'))
+        self.assertFalse(storage.write(self.test_path('dir', 'subdir'), b''))
+        self.assertEqual(sorted(os.listdir(self.test_path('dir'))),
+                         ['file', 'subdir'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,16 @@ class ColaUtilsTestCase(unittest.TestCase):
         self.assertEqual(utils.dirname('//foo//bar'), '/foo')
         self.assertEqual(utils.dirname('///foo///bar'), '/foo')
 
+    def test_path_index(self):
+        """Test the utils.path_index() function."""
+        index = utils.path_index(['b', 'a/y', 'a/x', 'a/c/d/e', 'f/g'])
+        self.assertEqual(index[''], (['a', 'f'], ['b']))
+        self.assertEqual(index['a'], (['a/c'], ['a/x', 'a/y']))
+        self.assertEqual(index['a/c'], (['a/c/d'], []))
+        self.assertEqual(index['a/c/d'], ([], ['a/c/d/e']))
+        self.assertEqual(index['f'], ([], ['f/g']))
+        self.assertEqual(len(index), 5)
+
     def test_add_parents(self):
         """Test the utils.add_parents() function."""
         path_set = set(['foo///bar///baz'])